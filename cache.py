@@ -0,0 +1,135 @@
+"""
+A persistent cache of timeseries extracted from multifile NetCDF datasets.
+
+Each cached timeseries is stored in a single .npz file, holding one .npy array
+for the time index and one for each column, so that it can be read back in
+milliseconds rather than being extracted from the archive again.  Alongside
+the data, each entry records the files it was extracted from, with their
+modification times and sizes, so that an entry is only used while the
+archive is unchanged.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from glob import glob
+import numpy as np
+import pandas as pd
+
+
+def file_signature(file_list):
+    '''
+    Records the modification time and size of each file of a dataset, so
+    that changes to the files can be detected.
+
+    :param file_list: A list of the paths of the files
+    :return:          A list of [path, modification time in ns, size in bytes]
+    '''
+    signature = []
+    for filename in file_list:
+        stat = os.stat(filename)
+        signature.append([os.path.abspath(filename), stat.st_mtime_ns, stat.st_size])
+    return signature
+
+
+def glob_files(path):
+    '''
+    Lists the files matching a glob expression, in alphanumeric order
+
+    :param path: A glob expression specifying the location of the data
+    :return:     A sorted list of the paths of the files
+    '''
+    return sorted(glob(path))
+
+
+def cache_key(*parts):
+    '''
+    Creates a key for a cache entry from anything which can be written as JSON
+
+    :return: A hexadecimal string
+    '''
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def signature_hash(signature):
+    '''
+    Summarises a file signature (see file_signature) as a single string
+
+    :param signature: A file signature
+    :return:          A hexadecimal string
+    '''
+    return cache_key(signature)
+
+
+def entry_path(cache_dir, kind, key):
+    '''
+    The path of a cache entry
+
+    :param cache_dir: The directory containing the cache
+    :param kind:      The kind of timeseries, e.g. 'points'
+    :param key:       The key of the entry (see cache_key)
+    :return:          The path of the .npz file
+    '''
+    return os.path.join(cache_dir, kind, key + '.npz')
+
+
+def load_frame(filename, signature=None):
+    '''
+    Reads a DataFrame from the cache
+
+    :param filename:  The path of the cache entry
+    :param signature: The current signature of the files the entry was extracted
+                      from (see file_signature).  If this does not match that
+                      stored with the entry, the entry is out of date.
+                      Optional - if not specified, the entry is not checked
+    :return:          A tuple (DataFrame, metadata dict), or (None, None) if the
+                      entry does not exist or is out of date
+    '''
+    if not os.path.exists(filename):
+        return None, None
+    with np.load(filename, allow_pickle=False) as entry:
+        meta = json.loads(str(entry['meta']))
+        if signature is not None and meta['files_hash'] != signature_hash(signature):
+            return None, None
+        index = pd.DatetimeIndex(entry['index'], name=meta['index_name'])
+        columns = [entry['column_%d' % i] for i in range(len(meta['columns']))]
+    frame = pd.DataFrame(dict(zip(meta['columns'], columns)), index=index,
+                         columns=meta['columns'])
+    return frame, meta
+
+
+def save_frame(filename, frame, signature, **meta):
+    '''
+    Writes a DataFrame with a time index to the cache.  The file is replaced
+    atomically, so readers never see a partly written entry.
+
+    :param filename:  The path of the cache entry
+    :param frame:     The DataFrame
+    :param signature: The signature of the files it was extracted from (see file_signature)
+    :param meta:      Any other metadata to store with the entry, which must be
+                      serialisable as JSON
+    '''
+    meta = dict(meta)
+    meta['columns'] = [str(column) for column in frame.columns]
+    meta['index_name'] = frame.index.name
+    meta['files'] = signature
+    meta['files_hash'] = signature_hash(signature)
+
+    arrays = {'meta': np.array(json.dumps(meta)),
+              'index': np.asarray(frame.index.values, dtype='datetime64[ns]')}
+    for i, column in enumerate(frame.columns):
+        arrays['column_%d' % i] = np.asarray(frame[column].values)
+
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temporary = tempfile.mkstemp(suffix='.npz', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
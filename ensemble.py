@@ -0,0 +1,217 @@
+"""
+A compact container for the ensemble members used by the TAMSAT alert code.
+
+Every ensemble member consists of the same spinup data, followed by a
+continuation taken from a different year of the historical data.  Rather than
+storing a pandas DataFrame for each member, the spinup is stored once and the
+continuations are stored as a single (members, days) numpy array.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+from tamsat_alert.noleap import noleap_dates, reduce_windows
+
+
+def find_window(months, days, start_day, start_month, end_day, end_month):
+    '''
+    Finds the position of the first occurrence of (start_day, start_month) in
+    a sequence of dates, and the position of the next occurrence of
+    (end_day, end_month) from there.
+
+    :param months:      A numpy array of the months of the dates
+    :param days:        A numpy array of the days of the month of the dates
+    :param start_day:   The day of the month of the start of the window
+    :param start_month: The month of the year of the start of the window
+    :param end_day:     The day of the month of the end of the window
+    :param end_month:   The month of the year of the end of the window
+    :return:            A tuple (start_index, end_index).  Either is 0 if the
+                        date is not found.
+    '''
+    start_index = 0
+    end_index = 0
+    matches = np.flatnonzero((months == start_month) & (days == start_day))
+    if len(matches) > 0:
+        start_index = matches[0]
+    matches = np.flatnonzero((months[start_index:] == end_month) &
+                             (days[start_index:] == end_day))
+    if len(matches) > 0:
+        end_index = matches[0] + start_index
+    return start_index, end_index
+
+
+class EnsembleArray(Mapping):
+    '''
+    A set of ensemble members which share the same spinup data.
+
+    The spinup is stored once, and the continuation of each member is stored
+    as a row of a single (members, days[, columns]) numpy array.  Days beyond
+    the end of a member, or outside the historical data, are NaN.
+
+    For backward compatibility this behaves as a read only mapping of ensemble
+    years to pandas objects containing the spinup followed by the member, as
+    init_ensemble_data previously returned.
+    '''
+
+    def __init__(self, spinup, no_leap_data, years, starts, stops):
+        '''
+        :param spinup:       A pandas Series or DataFrame containing the spinup
+                             data shared by all of the members
+        :param no_leap_data: A YearDoyMatrix from which the member continuations are taken
+        :param years:        The ensemble member years
+        :param starts:       The flat indices in no_leap_data of the first day of
+                             each member continuation
+        :param stops:        The flat indices in no_leap_data after the last day
+                             of each member continuation
+        '''
+        self.spinup = spinup
+        self.years = np.asarray(years)
+        self.first_year = no_leap_data.first_year
+        self.columns = no_leap_data.columns
+        self.name = no_leap_data.name
+
+        starts = np.asarray(starts)
+        stops = np.asarray(stops)
+
+        # Days outside the historical data are not part of the member
+        view_starts = np.maximum(starts, no_leap_data.first_index)
+        view_stops = np.maximum(view_starts,
+                                np.minimum(stops, no_leap_data.last_index + 1))
+        self.starts = starts
+        self.stops = stops
+        self.offsets = view_starts - starts
+        self.lengths = view_stops - view_starts
+
+        n_days = int(np.max(stops - starts)) if len(starts) > 0 else 0
+        members = no_leap_data.take_windows(starts, n_days)
+        positions = np.arange(n_days)
+        outside = ((positions < self.offsets[:, np.newaxis]) |
+                   (positions >= (self.offsets + self.lengths)[:, np.newaxis]))
+        members[outside] = np.nan
+        self.members = members
+
+        self.spinup_values = np.asarray(spinup.values, dtype=float)
+        self._spinup_months = np.asarray(spinup.index.month)
+        self._spinup_days = np.asarray(spinup.index.day)
+
+        # Every member starts on the same day of the year, so they all
+        # share the same sequence of months and days
+        first_start = starts[0] if len(starts) > 0 else 0
+        template = noleap_dates(self.first_year, first_start, first_start + n_days)
+        self._months = np.asarray(template.month)
+        self._days = np.asarray(template.day)
+
+        self._positions = dict((year, i) for i, year in enumerate(self.years))
+
+    def __getitem__(self, year):
+        i = self._positions[year]
+        offset = self.offsets[i]
+        length = self.lengths[i]
+        start = self.starts[i] + offset
+        index = noleap_dates(self.first_year, start, start + length)
+        values = self.members[i, offset:offset + length]
+        if self.columns is not None:
+            member = pd.DataFrame(values, index=index, columns=self.columns)
+        else:
+            member = pd.Series(values, index=index, name=self.name)
+        return pd.concat([self.spinup, member])
+
+    def __iter__(self):
+        return iter(self.years)
+
+    def __len__(self):
+        return len(self.years)
+
+    def member_values(self, year):
+        '''
+        The continuation of a single ensemble member.  This is a view onto the
+        ensemble data, not a copy.
+
+        :param year: The ensemble member year
+        :return:     A numpy array of shape (days[, columns])
+        '''
+        return self.members[self._positions[year]]
+
+    def window_values(self, start_day, start_month, end_day, end_month):
+        '''
+        Extracts the values of every ensemble member ranging from the first
+        occurrence of (start_day, start_month) to the next occurrence of
+        (end_day, end_month), exclusive.  The window may include spinup data.
+
+        :param start_day:   The day of the month of the start of the window
+        :param start_month: The month of the year of the start of the window
+        :param end_day:     The day of the month at whose next occurrence to end the window
+        :param end_month:   The month of the year at whose next occurrence to end the window
+        :return:            A numpy array of shape (members, days[, columns]).
+                            Members with shorter windows are padded with NaN.
+        '''
+        windows = self._windows(start_day, start_month, end_day, end_month)
+        n_days = max([(hi - lo) + (member_hi - member_lo)
+                      for _, lo, hi, member_lo, member_hi in windows] + [0])
+        out = np.full((len(self.years), n_days) + self.members.shape[2:], np.nan)
+        for group, lo, hi, member_lo, member_hi in windows:
+            spinup = self.spinup_values[lo:hi]
+            out[group, :len(spinup)] = spinup
+            block = self.members[group, member_lo:member_hi]
+            out[group, len(spinup):len(spinup) + block.shape[1]] = block
+        return out
+
+    def window_total(self, start_day, start_month, end_day, end_month, operation=np.sum):
+        '''
+        Performs the operation on every ensemble member over the window ranging
+        from the first occurrence of (start_day, start_month) to the next
+        occurrence of (end_day, end_month), exclusive.
+
+        np.sum and np.mean are calculated with one array reduction for all the
+        members, ignoring missing data, and the shared spinup part of the
+        window is only reduced once.
+
+        :param start_day:   The day of the month of the start of the window
+        :param start_month: The month of the year of the start of the window
+        :param end_day:     The day of the month at whose next occurrence to end the window
+        :param end_month:   The month of the year at whose next occurrence to end the window
+        :param operation:   The operation to perform.  Should be a function (e.g. np.sum)
+                            Optional, defaults to np.sum
+        :return:            A numpy array of shape (members[, columns])
+        '''
+        if operation not in (np.sum, np.nansum, np.mean, np.nanmean):
+            return reduce_windows(
+                self.window_values(start_day, start_month, end_day, end_month),
+                operation, self.columns)
+
+        sums = np.zeros((len(self.years),) + self.members.shape[2:])
+        counts = np.zeros_like(sums)
+        for group, lo, hi, member_lo, member_hi in self._windows(
+                start_day, start_month, end_day, end_month):
+            spinup = self.spinup_values[lo:hi]
+            block = self.members[group, member_lo:member_hi]
+            sums[group] = np.nansum(spinup, axis=0) + np.nansum(block, axis=1)
+            counts[group] = (np.sum(~np.isnan(spinup), axis=0) +
+                             np.sum(~np.isnan(block), axis=1))
+
+        if operation in (np.sum, np.nansum):
+            return sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+    def _windows(self, start_day, start_month, end_day, end_month):
+        # Members only differ in their sequence of dates if they have been
+        # truncated by the end of the data, so the window is found once for
+        # each distinct (offset, length) of member
+        n_spinup = len(self.spinup_values)
+        windows = []
+        for offset, length in set(zip(self.offsets, self.lengths)):
+            group = (self.offsets == offset) & (self.lengths == length)
+            months = np.concatenate([self._spinup_months,
+                                     self._months[offset:offset + length]])
+            days = np.concatenate([self._spinup_days,
+                                   self._days[offset:offset + length]])
+            start_index, end_index = find_window(months, days,
+                                                 start_day, start_month,
+                                                 end_day, end_month)
+            lo = min(start_index, n_spinup)
+            hi = max(lo, min(end_index, n_spinup))
+            member_lo = offset + max(start_index - n_spinup, 0)
+            member_hi = max(member_lo, offset + max(end_index - n_spinup, 0))
+            windows.append((group, lo, hi, member_lo, member_hi))
+        return windows
@@ -4,60 +4,222 @@ This module contains functions for extracting data from multifile NetCDF
 datasets, for use in conjunction with the TAMSAT alert system.
 """
 
+import os
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import numpy as np
 import xarray as xr
 import pandas as pd
-from glob import glob
+from tamsat_alert.cache import (cache_key, entry_path, glob_files, load_frame, save_frame,
+                                signature_hash)
+from tamsat_alert.manifest import find_lon_lat, load_manifest
+from tamsat_alert.store import open_store, update_store
+from tamsat_alert.summed_area import box_means, open_summed_area_cube, update_summed_area_cube
+from tamsat_alert.zonal import region_weights, zonal_means
 
+logger = logging.getLogger(__name__)
 
-def _get_dataset(path):
+
+def _get_dataset(path, start_date=None, end_date=None, variables=None):
     """
     Creates an xarray dataset from a glob expression
 
     :param path: A glob expression specifying the location of the data.
                  When full paths are listed, the alphanumeric order of
-                 the files must match the time order
+                 the files must match the time order, unless start_date
+                 or end_date is given
+    :param start_date: The first date to include
+                       Optional, defaults to the start of the data
+    :param end_date: The last date to include
+                     Optional, defaults to the end of the data
+    :param variables: A list of the names of the variables to include
+                      Optional, defaults to all of the variables
     :return: An tuple containing (xarray dataset, name of lon dim, name of lat dim)
     """
-    # Construct list of files to use.  These should be alphanumerically ordered
-    file_list = sorted(glob(path))
+    file_list, _ = _list_files(path, None, start_date, end_date)
+    dataset, lon_name, lat_name = _open_files(file_list, _dropped_variables(file_list, variables))
+    return _select_period(dataset, start_date, end_date), lon_name, lat_name
+
+
+def _list_files(path, cache_dir=None, start_date=None, end_date=None):
+    """
+    Lists the files of a dataset in time order
+
+    :param path: A glob expression specifying the location of the data
+    :param cache_dir: A directory in which to keep a manifest of the files
+                      Optional - if not specified, the files are globbed, or if
+                      start_date or end_date is given, a manifest is built in memory
+    :param start_date: The first date needed.  Only the files overlapping
+                       the period are listed.
+                       Optional, defaults to the start of the data
+    :param end_date: The last date needed
+                     Optional, defaults to the end of the data
+    :return: A tuple containing (list of files, their signature (see
+             cache.file_signature) or None if cache_dir is not given).  A
+             ValueError is raised if there are no files.
+    """
+    if cache_dir is None and start_date is None and end_date is None:
+        # Construct list of files to use.  These should be alphanumerically ordered
+        file_list, signature = glob_files(path), None
+    else:
+        manifest = load_manifest(path, cache_dir)
+        entries = manifest.select(start_date, end_date)
+        signature = manifest.signature(entries) if cache_dir is not None else None
+        file_list = [entry['path'] for entry in entries]
+    if not file_list:
+        if start_date is None and end_date is None:
+            raise ValueError('No files match %s' % path)
+        raise ValueError('No files matching %s overlap the period from %s to %s'
+                         % (path, 'the start' if start_date is None else start_date,
+                            'the end' if end_date is None else end_date))
+    return file_list, signature
+
+
+def _dropped_variables(file_list, variables):
+    """
+    Finds the variables to drop when opening the files, so that only the
+    variables needed are decoded and read
+
+    :param file_list: A list of the files of the dataset
+    :param variables: A list of the names of the variables needed, or None for all
+    :return: A list of the names of the variables to drop, or None
+    """
+    if variables is None:
+        return None
+    with xr.open_dataset(file_list[0], decode_times=False, decode_cf=False) as first:
+        present = list(first.data_vars)
+    unknown = [name for name in variables if name not in present]
+    if unknown:
+        raise ValueError('Variables %s are not in the dataset.  It contains %s'
+                         % (', '.join(unknown), ', '.join(present)))
+    return [name for name in present if name not in variables]
 
+
+def _select_period(dataset, start_date=None, end_date=None):
+    """
+    Selects the times in a period from a dataset
+
+    :param dataset: An xarray dataset
+    :param start_date: The first date to include, or None
+    :param end_date: The last date to include, or None
+    :return: An xarray dataset
+    """
+    if start_date is None and end_date is None:
+        return dataset
+    return dataset.sel(time=slice(start_date, end_date))
+
+
+def _open_files(file_list, drop_variables=None):
+    """
+    Creates an xarray dataset from a list of files
+
+    :param file_list: A list of files, in time order
+    :param drop_variables: A list of the names of variables not to read
+                           Optional, defaults to reading all of the variables
+    :return: An tuple containing (xarray dataset, name of lon dim, name of lat dim)
+    """
     # Construct an xarray dataset with all of the files
     dataset = xr.open_mfdataset(file_list,
                                 decode_times=True,
                                 autoclose=True,
                                 decode_cf=True,
                                 cache=False,
-                                concat_dim='time')
-
-    # Determine the name of the lat / lon dimensions
-    lon_name = None
-    lat_name = None
-    for coord_name in dataset.coords:
-        try:
-            units = dataset.coords[coord_name].attrs['units']
-            if(units in ['degrees_north',
-                         'degree_north',
-                         'degree_N',
-                         'degrees_N',
-                         'degreeN',
-                         'degreesN']):
-                lat_name = coord_name
-            elif(units in ['degrees_east',
-                           'degree_east',
-                           'degree_E',
-                           'degrees_E',
-                           'degreeE',
-                           'degreesE']):
-                lon_name = coord_name
-        except KeyError:
-            # Ignore this - it means the units attribute is not present
-            pass
+                                combine='nested',
+                                concat_dim='time',
+                                drop_variables=drop_variables)
+
+    lon_name, lat_name = find_lon_lat(dataset)
 
     # Decode CF metadata (this is quick, but creates a new dataset)
     return dataset, lon_name, lat_name
 
 
-def extract_point_timeseries(path, lon, lat):
+def _nearest_indices(file_list, lons, lats):
+    """
+    Snaps locations to the nearest cells of the grid, using the first file only
+
+    :param file_list: A list of the files of the dataset
+    :param lons: An array of the longitudes of the locations
+    :param lats: An array of the latitudes of the locations
+    :return: A tuple containing (name of lon dim, name of lat dim,
+             array of lon indices, array of lat indices)
+    """
+    with xr.open_dataset(file_list[0], decode_times=False, decode_cf=False) as first:
+        lon_name, lat_name = find_lon_lat(first)
+        lon_indices = first.indexes[lon_name].get_indexer(np.atleast_1d(lons), method='nearest')
+        lat_indices = first.indexes[lat_name].get_indexer(np.atleast_1d(lats), method='nearest')
+    return lon_name, lat_name, lon_indices, lat_indices
+
+
+def _iso_date(date):
+    """
+    Converts a date to a string for use in a cache key
+
+    :param date: Anything pandas can convert to a Timestamp, or None
+    :return: An ISO 8601 string, or None
+    """
+    return None if date is None else pd.Timestamp(date).isoformat()
+
+
+def _map_files(file_list, function, drop_variables=None, workers=None, use_processes=True):
+    """
+    Opens each file of a dataset, and applies a function to it
+
+    The files may be read in a pool of workers, since decompressing and
+    decoding them is CPU bound.  Each worker opens one file at a time.
+
+    :param file_list: A list of files, in time order
+    :param function: A function taking an xarray dataset of a single file, which
+                     should return its result in memory, since the file is closed
+                     afterwards.  If processes are used, it must be picklable,
+                     e.g. a module level function or a partial of one.
+    :param drop_variables: A list of the names of variables not to read
+                           Optional, defaults to reading all of the variables
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
+    :return: A list of the results for each file, in time order
+    """
+    if workers is None or workers <= 1 or len(file_list) <= 1:
+        return [_apply_to_file(filename, function, drop_variables) for filename in file_list]
+
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        # Sending several files to a process at a time reduces the overhead
+        chunksize = max(1, len(file_list) // (workers * 8))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        chunksize = 1
+    with executor:
+        return list(executor.map(partial(_apply_to_file, function=function,
+                                         drop_variables=drop_variables),
+                                 file_list, chunksize=chunksize))
+
+
+def _apply_to_file(filename, function, drop_variables=None):
+    """
+    Opens a file and applies a function to it (see _map_files)
+
+    :param filename: The path of the file
+    :param function: A function taking an xarray dataset
+    :param drop_variables: A list of the names of variables not to read
+    :return: The result of the function
+    """
+    with xr.open_dataset(filename, decode_times=True, decode_cf=True, cache=False,
+                         drop_variables=drop_variables) as dataset:
+        return function(dataset)
+
+
+def extract_point_timeseries(path, lon, lat, cache_dir=None,
+                             start_date=None, end_date=None, variables=None,
+                             workers=None, use_processes=True):
     """
     Extracts a timeseries from a set of NetCDF files at a specified location.
 
@@ -66,10 +228,36 @@ def extract_point_timeseries(path, lon, lat):
                  the files must match the time order
     :param lon: The longitude at which to extract a timeseries
     :param lat: The latitude at which to extract a timeseries
+    :param cache_dir: A directory in which to cache extracted timeseries.  Repeat
+                      extractions for the same grid cell are read from the cache,
+                      for as long as the files matching path are unchanged.
+                      Optional - if not specified, nothing is cached
+    :param start_date: The first date to extract.  Only the files overlapping the
+                       period from start_date to end_date are read.  Without
+                       cache_dir, every file is still opened once to find their
+                       times, so this saves little reading.
+                       Optional, defaults to the start of the data
+    :param end_date: The last date to extract
+                     Optional, defaults to the end of the data
+    :param variables: A list of the names of the variables to extract
+                      Optional, defaults to all of the variables
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
     :return: A pandas DataFrame containing all variables present in the NetCDF dataset
     """
+    if cache_dir is not None or workers is not None:
+        timeseries = extract_points_timeseries(path, [lon], [lat], cache_dir=cache_dir,
+                                               start_date=start_date, end_date=end_date,
+                                               variables=variables, workers=workers,
+                                               use_processes=use_processes)
+        return timeseries[0]
 
-    dataset, lon_name, lat_name = _get_dataset(path)
+    dataset, lon_name, lat_name = _get_dataset(path, start_date, end_date, variables)
 
     # Select nearest neighbour to co-ordinate of interest, for all variables
     timeseries = dataset.sel({
@@ -92,10 +280,167 @@ def extract_point_timeseries(path, lon, lat):
     return df
 
 
-def extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat):
+def extract_points_timeseries(path, lons, lats, names=None, cache_dir=None,
+                              start_date=None, end_date=None, variables=None,
+                              workers=None, use_processes=True):
+    """
+    Extracts timeseries from a set of NetCDF files at a number of locations,
+    e.g. a table of stations, reading each file only once.
+
+    Every location is snapped to the nearest cell of the grid, and the cells
+    are read from each file together, with pointwise indexing.
+
+    :param path: A glob expression specifying the location of the data.
+                 When full paths are listed, the alphanumeric order of
+                 the files must match the time order
+    :param lons: An array of the longitudes at which to extract timeseries
+    :param lats: An array of the latitudes at which to extract timeseries
+    :param names: The names of the locations, e.g. the station names
+                  Optional, defaults to their positions in lons and lats
+    :param cache_dir: A directory in which to cache extracted timeseries (see
+                      extract_point_timeseries).  Locations in cached cells are
+                      read from the cache, and only the other cells are extracted.
+                      Optional - if not specified, nothing is cached
+    :param start_date: The first date to extract.  Only the files overlapping the
+                       period from start_date to end_date are read.  Without
+                       cache_dir, every file is still opened once to find their
+                       times, so this saves little reading.
+                       Optional, defaults to the start of the data
+    :param end_date: The last date to extract
+                     Optional, defaults to the end of the data
+    :param variables: A list of the names of the variables to extract
+                      Optional, defaults to all of the variables
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
+    :return: An OrderedDict of the names of the locations to pandas DataFrames,
+             each as extract_point_timeseries returns
+    """
+    if names is None:
+        names = range(len(lons))
+    file_list, signature = _list_files(path, cache_dir, start_date, end_date)
+    lon_name, lat_name, lon_indices, lat_indices = _nearest_indices(file_list, lons, lats)
+    if variables is not None:
+        variables = sorted(variables)
+
+    # Locations in the same cell share a timeseries
+    cells = OrderedDict()
+    for lon_index, lat_index in zip(lon_indices, lat_indices):
+        cells[(int(lon_index), int(lat_index))] = None
+
+    if cache_dir is not None:
+        filenames = {}
+        for cell in cells:
+            filenames[cell] = entry_path(cache_dir, 'points',
+                                         cache_key(os.path.abspath(path), lon_name, cell[0],
+                                                   lat_name, cell[1], variables,
+                                                   _iso_date(start_date), _iso_date(end_date)))
+            cells[cell], _ = load_frame(filenames[cell], signature)
+
+    missing = [cell for cell, df in cells.items() if df is None]
+    store = None
+    if missing and cache_dir is not None:
+        store = open_store(path, cache_dir, variables)
+    if store is not None:
+        # The store is chunked for reading timeseries, so the cells are read
+        # from it directly
+        points = {lon_name: xr.DataArray([cell[0] for cell in missing], dims='points'),
+                  lat_name: xr.DataArray([cell[1] for cell in missing], dims='points')}
+        timeseries = _select_period(store, start_date, end_date).isel(points).load()*1.0
+    elif missing:
+        # The block of the grid containing all of the cells is read from each
+        # file with a single slice, and the cells are selected from it in
+        # memory, since pointwise indexing of the files themselves is slow
+        lon_points = np.array([cell[0] for cell in missing])
+        lat_points = np.array([cell[1] for cell in missing])
+        block = {lon_name: slice(lon_points.min(), lon_points.max() + 1),
+                 lat_name: slice(lat_points.min(), lat_points.max() + 1)}
+        points = {lon_name: xr.DataArray(lon_points - lon_points.min(), dims='points'),
+                  lat_name: xr.DataArray(lat_points - lat_points.min(), dims='points')}
+        parts = _map_files(file_list, partial(_read_cells, block=block, points=points),
+                           _dropped_variables(file_list, variables), workers, use_processes)
+        timeseries = _select_period(xr.concat(parts, dim='time'), start_date, end_date)
+    if missing:
+        for i, cell in enumerate(missing):
+            cells[cell] = _point_frame(timeseries.isel(points=i))
+            if cache_dir is not None:
+                save_frame(filenames[cell], cells[cell], signature,
+                           path=os.path.abspath(path),
+                           indices={lon_name: cell[0], lat_name: cell[1]},
+                           variables=variables, start_date=_iso_date(start_date),
+                           end_date=_iso_date(end_date))
+
+    result = OrderedDict()
+    for name, lon_index, lat_index in zip(names, lon_indices, lat_indices):
+        result[name] = cells[(int(lon_index), int(lat_index))]
+    return result
+
+
+def _read_cells(dataset, block, points):
+    """
+    Reads a block of the grid from a dataset, and selects cells from it
+
+    :param dataset: An xarray dataset
+    :param block: The indexers of the block
+    :param points: The pointwise indexers of the cells in the block
+    :return: An xarray dataset, in memory
+    """
+    return dataset.isel(block).load().isel(points)*1.0
+
+
+def _point_frame(timeseries):
+    """
+    Converts the timeseries of a single cell to a DataFrame
+
+    :param timeseries: An xarray dataset with scalar lon / lat coordinates
+    :return: A pandas DataFrame, with the columns in the same order as
+             extract_point_timeseries
+    """
+    df = timeseries.to_dataframe()
+    return df[[name for name in timeseries.coords if name in df.columns] +
+              [name for name in timeseries.data_vars]]
+
+
+def _area_mean(dataset, minlon, maxlon, minlat, maxlat):
+    """
+    Calculates the mean of a dataset over a region
+
+    :param dataset: An xarray dataset
+    :param minlon: The minimum longitude of the region
+    :param maxlon: The maximum longitude of the region
+    :param minlat: The minimum latitude of the region
+    :param maxlat: The maximum latitude of the region
+    :return: An xarray dataset of the means, in memory
+    """
+    lon_name, lat_name = find_lon_lat(dataset)
+    ln = dataset.coords[lon_name].values
+    lt = dataset.coords[lat_name].values
+    subset = dataset.isel({
+        lon_name: _positions((ln >= minlon) & (ln <= maxlon)),
+        lat_name: _positions((lt >= minlat) & (lt <= maxlat))
+    })
+    # Take the mean over the lon/lat dimensions
+    return subset.mean(dim=(lon_name, lat_name), skipna=True).load()
+
+
+def extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat, cache_dir=None,
+                                 start_date=None, end_date=None, variables=None,
+                                 workers=None, use_processes=True):
     """
     Extracts a timeseries from a set of NetCDF files averaged over a specified region.
 
+    The files are read one at a time, and each is reduced to its mean over
+    the region straight away, so only the region of one file is in memory at
+    a time.  The number of files read per second is logged.
+
+    If a summed-area cube (see summed_area.update_summed_area_cube) without
+    block aggregation has been built in cache_dir, the means are calculated
+    from the corners of the region in the cube instead.
+
     :param path: A glob expression specifying the location of the data.
                  When full paths are listed, the alphanumeric order of
                  the files must match the time order
@@ -103,22 +448,320 @@ def extract_area_mean_timeseries(path, minlon, maxlon, minlat, maxlat):
     :param maxlat: The maximum latitude of the region over which to extract a timeseries
     :param minlon: The minimum longitude of the region over which to extract a timeseries
     :param maxlon: The maximum longitude of the region over which to extract a timeseries
+    :param cache_dir: A directory in which to keep a manifest of the files (see
+                      manifest.Manifest), which orders them by time, and to cache
+                      extracted timeseries.  If the rechunked store (see
+                      store.update_store) has been built there, the data are read
+                      from the store instead.
+                      Optional - if not specified, nothing is cached
+    :param start_date: The first date to extract.  Only the files overlapping the
+                       period from start_date to end_date are read.  Without
+                       cache_dir, every file is still opened once to find their
+                       times, so this saves little reading.
+                       Optional, defaults to the start of the data
+    :param end_date: The last date to extract
+                     Optional, defaults to the end of the data
+    :param variables: A list of the names of the variables to extract
+                      Optional, defaults to all of the variables
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
     :return: A pandas DataFrame containing all variables present in the NetCDF dataset
     """
-    dataset, lon_name, lat_name = _get_dataset(path)
+    box = (minlon, maxlon, minlat, maxlat)
+    filename = None
+    if cache_dir is not None:
+        file_list, signature = _list_files(path, cache_dir, start_date, end_date)
+        filename = entry_path(cache_dir, 'areas',
+                              cache_key(os.path.abspath(path), box,
+                                        None if variables is None else sorted(variables),
+                                        _iso_date(start_date), _iso_date(end_date)))
+        df, _ = load_frame(filename, signature)
+        if df is not None:
+            return df
 
-    ln = dataset.coords[lon_name]
-    lt = dataset.coords[lat_name]
+    cube = None
+    store = None
+    if cache_dir is not None:
+        # Block aggregated cubes would snap the box, so they are not used
+        cube = open_summed_area_cube(path, cache_dir, variables, block=1)
+        if cube is None:
+            store = open_store(path, cache_dir, variables)
+    if cube is not None:
+        df = box_means(_select_period(cube, start_date, end_date), *(box + (variables,)))
+    elif store is not None:
+        # The store is read a chunk at a time by dask
+        df = _area_mean(_select_period(store, start_date, end_date), *box).to_dataframe()
+    else:
+        if cache_dir is None:
+            file_list, _ = _list_files(path, cache_dir, start_date, end_date)
+        start_time = time.time()
+        parts = _map_files(file_list, partial(_area_mean, minlon=minlon, maxlon=maxlon,
+                                              minlat=minlat, maxlat=maxlat),
+                           _dropped_variables(file_list, variables), workers, use_processes)
+        timeseries = _select_period(xr.concat(parts, dim='time'), start_date, end_date)
+        elapsed = time.time() - start_time
+        logger.info('Averaged %d files (%d times) in %.1f s, %.1f files/s',
+                    len(file_list), timeseries.sizes.get('time', 0), elapsed,
+                    len(file_list) / max(elapsed, 1e-9))
 
-    subset = dataset.loc[{
-        lon_name: ln[(ln >= minlon) & (ln <= maxlon)],
-        lat_name: lt[(lt >= minlat) & (lt <= maxlat)]
-        }]
-    # Take the mean over the lon/lat dimensions
-    timeseries = subset.mean(dim=(lon_name, lat_name), skipna=True)
-
-    # Create a pandas DataFrame from the selected data
-    # This is where the extraction happens
-    df = timeseries.to_dataframe()
+        # Create a pandas DataFrame from the selected data
+        df = timeseries.to_dataframe()
+    for dataset in (cube, store):
+        if dataset is not None:
+            dataset.close()
 
+    if filename is not None:
+        save_frame(filename, df, signature, path=os.path.abspath(path), box=list(box),
+                   variables=variables, start_date=_iso_date(start_date),
+                   end_date=_iso_date(end_date))
     return df
+
+
+def extract_zonal_timeseries(path, regions, cache_dir=None,
+                             start_date=None, end_date=None, variables=None,
+                             workers=None, use_processes=True):
+    """
+    Extracts timeseries from a set of NetCDF files averaged over each of a
+    number of regions, such as the admin units of a country.
+
+    The means are weighted by the area of each cell, i.e. the cosine of its
+    latitude.  The weights of the cells in all of the regions are held in a
+    sparse matrix (see zonal.region_weights), which is cached in cache_dir.
+    The files are read one at a time, and every time step is reduced to the
+    means over all of the regions with a single sparse matrix product.
+
+    :param path: A glob expression specifying the location of the data.
+                 When full paths are listed, the alphanumeric order of
+                 the files must match the time order
+    :param regions: The regions, either a mapping of region names to boxes
+                    (minlon, maxlon, minlat, maxlat) or masks, or a single raster
+                    of region labels (see zonal.region_masks)
+    :param cache_dir: A directory in which to keep a manifest of the files (see
+                      manifest.Manifest) and the weights of the regions.  If the
+                      rechunked store (see store.update_store) has been built
+                      there, the data are read from the store instead.
+                      Optional - if not specified, nothing is cached
+    :param start_date: The first date to extract.  Only the files overlapping the
+                       period from start_date to end_date are read.  Without
+                       cache_dir, every file is still opened once to find their
+                       times, so this saves little reading.
+                       Optional, defaults to the start of the data
+    :param end_date: The last date to extract
+                     Optional, defaults to the end of the data
+    :param variables: A list of the names of the variables to extract
+                      Optional, defaults to all of the variables
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
+    :return: An OrderedDict of the region names to pandas DataFrames, each
+             containing the variables on the grid
+    """
+    store = None if cache_dir is None else open_store(path, cache_dir, variables)
+    if store is not None:
+        grid = store
+    else:
+        file_list, _ = _list_files(path, cache_dir, start_date, end_date)
+        grid = xr.open_dataset(file_list[0], decode_times=False, decode_cf=False)
+    lon_name, lat_name = find_lon_lat(grid)
+    lons = grid[lon_name].values
+    lats = grid[lat_name].values
+    if grid is not store:
+        # The store is still needed for the means
+        grid.close()
+    names, weights = region_weights(lons, lats, regions, lon_name, lat_name, cache_dir)
+
+    # Only the block of the grid containing the regions is read
+    cells = np.unique(weights.indices)
+    lat_indices = np.arange(cells.min() // len(lons), cells.max() // len(lons) + 1) \
+        if len(cells) > 0 else np.arange(0)
+    lon_indices = np.arange((cells % len(lons)).min(), (cells % len(lons)).max() + 1) \
+        if len(cells) > 0 else np.arange(0)
+    block = {lat_name: _positions(np.isin(np.arange(len(lats)), lat_indices)),
+             lon_name: _positions(np.isin(np.arange(len(lons)), lon_indices))}
+    block_weights = weights[:, (lat_indices[:, np.newaxis] * len(lons) +
+                                lon_indices[np.newaxis, :]).ravel()]
+
+    zonal_mean = partial(_zonal_mean, block=block, weights=block_weights,
+                         lon_name=lon_name, lat_name=lat_name)
+
+    start_time = time.time()
+    if store is not None:
+        # The store is read a chunk of time at a time
+        period = _select_period(store, start_date, end_date)
+        n_times = period.sizes['time']
+        step = period.chunks['time'][0] if period.chunks else n_times
+        parts = [zonal_mean(period.isel(time=slice(i, i + step)))
+                 for i in range(0, n_times, step)]
+        store.close()
+    else:
+        parts = _map_files(file_list, zonal_mean, _dropped_variables(file_list, variables),
+                           workers, use_processes)
+        logger.info('Averaged %d files over %d regions in %.1f s',
+                    len(file_list), len(names), time.time() - start_time)
+
+    index = pd.DatetimeIndex(np.concatenate([part[0].values for part in parts]), name='time')
+    means = OrderedDict()
+    for name in (parts[0][1] if parts else []):
+        means[name] = np.concatenate([part[1][name] for part in parts])
+
+    result = OrderedDict()
+    for i, region in enumerate(names):
+        df = pd.DataFrame(OrderedDict((name, values[:, i]) for name, values in means.items()),
+                          index=index)
+        if start_date is not None or end_date is not None:
+            df = df.loc[start_date:end_date]
+        result[region] = df
+    return result
+
+
+def _zonal_mean(dataset, block, weights, lon_name, lat_name):
+    """
+    Calculates the means of a dataset over regions (see zonal.zonal_means)
+
+    :param dataset: An xarray dataset
+    :param block: The indexers of the block of the grid containing the regions
+    :param weights: The sparse matrix of the weights of the cells of the block
+    :param lon_name: The name of the lon dim
+    :param lat_name: The name of the lat dim
+    :return: A tuple (DatetimeIndex of the times, OrderedDict of the names of the
+             variables to numpy arrays of shape (times, regions))
+    """
+    subset = dataset.isel(block)
+    means = OrderedDict()
+    for name, variable in subset.data_vars.items():
+        if set(variable.dims) == set(['time', lat_name, lon_name]):
+            values = variable.transpose('time', lat_name, lon_name).values
+            means[name] = zonal_means(values.reshape((values.shape[0], -1)), weights)
+    return pd.DatetimeIndex(subset['time'].values), means
+
+
+def update_cached_timeseries(path, cache_dir, workers=None, use_processes=True):
+    """
+    Brings everything cached for a dataset up to date with its files, e.g.
+    after a new daily file has been published.
+
+    The files which are new or have changed since each point and area mean
+    timeseries was cached are found from the manifest.  Each of these files
+    is read once, and the rows for its times are added to every cached
+    timeseries, replacing any rows for the same times.  The rechunked store
+    and the summed-area cube are updated first, if they have been built,
+    which drops the days of files which have been removed.  Cached
+    timeseries which include a file which has since been removed are
+    deleted, so that they are extracted again when next needed.
+
+    :param path: A glob expression specifying the location of the data
+    :param cache_dir: The directory containing the cache
+    :param workers: The number of files to read at once, in a pool of workers.
+                    Each worker has one file open at a time, so this also
+                    bounds the number of open files.
+                    Optional - if not specified, the files are read one at a time
+    :param use_processes: If True, the files are read in a pool of processes,
+                          otherwise in a pool of threads
+                          Optional, defaults to True
+    :return: A dict of the numbers of cached timeseries 'updated' and 'removed',
+             and of 'files' read
+    """
+    manifest = load_manifest(path, cache_dir)
+    current = dict((entry['path'], entry) for entry in manifest.entries)
+    for update, location in ((update_store, open_store),
+                             (update_summed_area_cube, open_summed_area_cube)):
+        existing = location(path, cache_dir, update=False)
+        if existing is not None:
+            existing.close()
+            update(path, cache_dir)
+
+    # Find the cached timeseries which are out of date, and the files each needs
+    stale = []
+    removed = 0
+    for kind in ('points', 'areas'):
+        for filename in glob_files(os.path.join(cache_dir, kind, '*.npz')):
+            df, meta = load_frame(filename)
+            if meta.get('path') != os.path.abspath(path):
+                continue
+            entries = manifest.select(meta.get('start_date'), meta.get('end_date'))
+            signature = manifest.signature(entries)
+            if meta['files_hash'] == signature_hash(signature):
+                continue
+            known = dict((name, [mtime, size]) for name, mtime, size in meta['files'])
+            if any(name not in current for name in known):
+                os.remove(filename)
+                removed += 1
+                continue
+            changed = [entry['path'] for entry in entries
+                       if known.get(entry['path']) != [entry['mtime'], entry['size']]]
+            stale.append((kind, filename, df, meta, signature, set(changed)))
+
+    # Read each file once, for all of the timeseries which need it
+    needed = set()
+    for _, _, _, _, _, changed in stale:
+        needed |= changed
+    file_list = [entry['path'] for entry in manifest.entries if entry['path'] in needed]
+
+    requests = [(kind, dict((key, meta.get(key)) for key in
+                            ('variables', 'start_date', 'end_date', 'indices', 'box')), changed)
+                for kind, _, _, meta, _, changed in stale]
+    parts = _map_files(file_list, partial(_new_rows, requests=requests),
+                       workers=workers, use_processes=use_processes)
+
+    for i, (kind, filename, df, meta, signature, changed) in enumerate(stale):
+        rows = [part[i] for part in parts if part[i] is not None]
+        if rows:
+            rows = pd.concat(rows)[df.columns]
+            df = pd.concat([df.drop(rows.index, errors='ignore'), rows]).sort_index()
+        save_frame(filename, df, signature,
+                   **dict((key, value) for key, value in meta.items()
+                          if key not in ('columns', 'index_name', 'files', 'files_hash')))
+
+    logger.info('Updated %d cached timeseries from %d files, and removed %d',
+                len(stale), len(file_list), removed)
+    return {'updated': len(stale), 'removed': removed, 'files': len(file_list)}
+
+
+def _new_rows(dataset, requests):
+    """
+    Extracts the rows of a number of cached timeseries from a single file
+
+    :param dataset: An xarray dataset of the file
+    :param requests: A list of tuples (kind of timeseries, metadata of the cache
+                     entry, set of the paths of the files it needs)
+    :return: A list of a DataFrame, or None if the file is not needed, for each request
+    """
+    rows = []
+    for kind, meta, changed in requests:
+        if dataset.encoding['source'] not in changed:
+            rows.append(None)
+            continue
+        if meta['variables'] is not None:
+            subset = dataset[meta['variables']]
+        else:
+            subset = dataset
+        subset = _select_period(subset, meta['start_date'], meta['end_date'])
+        if kind == 'points':
+            rows.append(_point_frame((subset.isel(meta['indices'])*1.0).load()))
+        else:
+            rows.append(_area_mean(subset, *meta['box']).to_dataframe())
+    return rows
+
+
+def _positions(mask):
+    """
+    Converts a mask along a dimension to an indexer, which is a slice if the
+    selected positions are contiguous, so that it can be read efficiently
+
+    :param mask: A boolean numpy array
+    :return: A slice or an array of positions
+    """
+    positions = np.flatnonzero(mask)
+    if len(positions) == 0 or np.all(np.diff(positions) == 1):
+        start = positions[0] if len(positions) > 0 else 0
+        return slice(start, start + len(positions))
+    return positions
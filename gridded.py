@@ -0,0 +1,173 @@
+"""
+The cumulative rainfall part of TAMSAT alert for every cell of a grid.
+
+Rather than running tamsat_alert for one point timeseries at a time, the
+grid is processed in tiles.  Each tile is treated as a multi-column timeseries,
+so that the ensemble members, the climatology and the probabilities for every
+cell of the tile are calculated together, as arrays with a trailing cell axis.
+"""
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tamsat_alert.metrics import get_metric
+from tamsat_alert.noleap import YearDoyMatrix
+from tamsat_alert.probability import forecast_weights, risk_probabilities, weight_forecasts
+from tamsat_alert.tamsat_alert import (QUINTILE_CATEGORIES, default_run_period, ensemble_timeseries,
+                                       forecast_timeseries, init_ensemble_data,
+                                       sum_ensemble_members)
+
+
+def gridded_alert(rainfall,
+                  fc_data,
+                  met_ts_varname,
+                  cast_date,
+                  poi_start_day, poi_start_month,
+                  poi_end_day, poi_end_month,
+                  fc_start_day, fc_start_month,
+                  fc_end_day, fc_end_month,
+                  precipitation_rate_str='pr',
+                  temperature_str='temp',
+                  tercile_weights=[1,1,1],
+                  clim_start_year=None, clim_end_year=None,
+                  poi_start_year=None, poi_end_year=None,
+                  stat_type='normal',
+                  cum_not_mean=True,
+                  metric=None,
+                  tile_size=(20, 20),
+                  output_path=None,
+                  time_dim='time'):
+    '''
+    Runs the cumulative rainfall part of TAMSAT Alert for every cell of a grid.
+
+    :param rainfall:        An xarray DataArray of daily rainfall, with a time dimension
+                            and two spatial dimensions, e.g. (time, lat, lon).
+                            This may be backed by dask or by files, since only one
+                            tile is loaded at a time.
+    :param fc_data:         A pandas DataFrame containing the meteorological forecast
+                            time series used to weight the ensemble members.  This is
+                            area averaged, so the weighting is the same for every cell.
+    :param tile_size:       The number of cells along each spatial dimension in each tile
+                            Optional, defaults to (20, 20)
+    :param output_path:     The path of a NetCDF file to write the results to
+                            Optional - if not specified, no file is written
+    :param time_dim:        The name of the time dimension of rainfall
+                            Optional, defaults to 'time'
+
+    All other parameters are as for tamsat_alert.
+
+    :return:                An xarray Dataset on the spatial grid of rainfall, with the
+                            variables ensemble_mean, ensemble_sd, clim_mean and the
+                            probability of each quintile category.  Cells with no data
+                            are NaN.
+    '''
+    cast_date = pd.Timestamp(cast_date)
+    time_index = pd.DatetimeIndex(rainfall[time_dim].values)
+    spatial_dims = [dim for dim in rainfall.dims if dim != time_dim]
+    if len(spatial_dims) != 2:
+        raise ValueError('rainfall must have a time dimension and two spatial dimensions')
+    rainfall = rainfall.transpose(time_dim, *spatial_dims)
+
+    if clim_start_year is None:
+        clim_start_year = time_index[0].year
+    if clim_end_year is None:
+        clim_end_year = time_index[-1].year
+    if poi_start_year is None:
+        poi_start_year = time_index[0].year
+    if poi_end_year is None:
+        poi_end_year = time_index[-1].year
+    n_clim_years = clim_end_year - clim_start_year + 1
+
+    run_start, run_end = default_run_period(cast_date,
+                                            poi_start_day, poi_start_month,
+                                            poi_end_day, poi_end_month)
+
+    if cum_not_mean:
+        operation = np.sum
+    else:
+        operation = np.mean
+    if metric is None:
+        poi_operation, member_operation = operation, np.sum
+    else:
+        poi_operation = member_operation = get_metric(metric)
+
+    # The weighting metric is shared by every cell
+    if met_ts_varname == "precipitation":
+        tmp = fc_data[precipitation_rate_str]
+    if met_ts_varname == "temperature":
+        tmp = fc_data[temperature_str]
+    forecast_sums = forecast_timeseries(YearDoyMatrix.from_pandas(tmp),
+                                        fc_start_day, fc_start_month,
+                                        fc_end_day, fc_end_month,
+                                        poi_start_year, poi_end_year,
+                                        cast_date, operation)
+    Wmetric = forecast_sums.values.T[0]
+
+    shape = tuple(rainfall.sizes[dim] for dim in spatial_dims)
+    outputs = dict((name, np.full(shape, np.nan))
+                   for name in ['ensemble_mean', 'ensemble_sd', 'clim_mean'] + QUINTILE_CATEGORIES)
+
+    for y0 in range(0, shape[0], tile_size[0]):
+        for x0 in range(0, shape[1], tile_size[1]):
+            tile = (slice(y0, y0 + tile_size[0]), slice(x0, x0 + tile_size[1]))
+            values = np.asarray(rainfall[(slice(None),) + tile].values, dtype=float)
+            tile_shape = values.shape[1:]
+            tile_outputs = _tile_alert(values.reshape((len(time_index), -1)), time_index,
+                                       cast_date, run_start, run_end,
+                                       (poi_start_day, poi_start_month, poi_end_day, poi_end_month),
+                                       Wmetric, tercile_weights,
+                                       clim_start_year, clim_end_year, n_clim_years,
+                                       poi_start_year, poi_end_year, stat_type,
+                                       poi_operation, member_operation)
+            for name, cell_values in tile_outputs.items():
+                outputs[name][tile] = cell_values.reshape(tile_shape)
+
+    coords = dict((dim, rainfall[dim]) for dim in spatial_dims if dim in rainfall.coords)
+    result = xr.Dataset(dict((name, (spatial_dims, values)) for name, values in outputs.items()),
+                        coords=coords)
+    result.attrs['cast_date'] = str(cast_date.date())
+    result.attrs['period_of_interest'] = '%02d-%02d to %02d-%02d' % (
+        poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+    result.attrs['stat_type'] = stat_type
+
+    if output_path is not None:
+        result.to_netcdf(output_path)
+    return result
+
+
+def _tile_alert(values, time_index, cast_date, run_start, run_end, poi, Wmetric,
+                tercile_weights, clim_start_year, clim_end_year, n_clim_years,
+                poi_start_year, poi_end_year, stat_type, poi_operation, member_operation):
+    # Runs the alert for a (time, cells) array of rainfall.  The cells are the
+    # columns of the timeseries, so every step works on all of them at once.
+    outputs = dict((name, np.full(values.shape[1], np.nan))
+                   for name in ['ensemble_mean', 'ensemble_sd', 'clim_mean'] + QUINTILE_CATEGORIES)
+    has_data = ~np.all(np.isnan(values), axis=0)
+    if not np.any(has_data):
+        return outputs
+
+    data = pd.DataFrame(values[:, has_data], index=time_index)
+    data_no_leaps = YearDoyMatrix.from_pandas(data)
+    ensemble_members = init_ensemble_data(data, data_no_leaps, cast_date, run_start,
+                                          run_end, clim_start_year, clim_end_year)
+
+    # These are of shape (cells, members) and (cells, years)
+    forecametric = sum_ensemble_members(ensemble_members, *(poi + (member_operation,))).values.T
+    climametric = ensemble_timeseries(data_no_leaps, *(poi + (poi_start_year, poi_end_year,
+                                                              poi_operation))).values.T
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        projmean, projsd = weight_forecasts(forecametric, Wmetric, tercile_weights,
+                                            clim_start_year, clim_end_year)
+        projsd = np.maximum(projsd, 0.001)  # avoid division by zero
+        forecametric, memberweights = forecast_weights(forecametric, Wmetric, tercile_weights,
+                                                       clim_start_year, clim_end_year)
+        _, _, val = risk_probabilities(climametric, forecametric, projmean, projsd,
+                                       stat_type, n_clim_years, memberweights)
+
+    cell_outputs = [('ensemble_mean', projmean), ('ensemble_sd', projsd),
+                    ('clim_mean', np.mean(climametric, axis=-1))]
+    cell_outputs += [(name, val[:, i]) for i, name in enumerate(QUINTILE_CATEGORIES)]
+    for name, cell_values in cell_outputs:
+        outputs[name][has_data] = cell_values
+    return outputs
@@ -0,0 +1,236 @@
+"""
+A persistent manifest of the files of a multifile NetCDF dataset.
+
+Rather than globbing the files and opening every one of them to find out
+what they contain, the manifest records the time range, variables and grid
+of each file.  It is refreshed incrementally, so only files which have been
+added or changed since it was last saved are opened.  The files are kept in
+the order of their times, rather than in alphanumeric order, and those
+overlapping a period of interest can be found without opening any files.
+"""
+
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tamsat_alert.cache import cache_key, file_signature, glob_files
+
+# The version of the format of saved manifests.  Saved manifests with a
+# different version are rebuilt.
+MANIFEST_VERSION = 1
+
+
+def find_lon_lat(dataset):
+    """
+    Determines the names of the lon / lat dimensions of a dataset from their units
+
+    :param dataset: An xarray dataset
+    :return: A tuple containing (name of lon dim, name of lat dim)
+    """
+    lon_name = None
+    lat_name = None
+    for coord_name in dataset.coords:
+        try:
+            units = dataset.coords[coord_name].attrs['units']
+            if(units in ['degrees_north',
+                         'degree_north',
+                         'degree_N',
+                         'degrees_N',
+                         'degreeN',
+                         'degreesN']):
+                lat_name = coord_name
+            elif(units in ['degrees_east',
+                           'degree_east',
+                           'degree_E',
+                           'degrees_E',
+                           'degreeE',
+                           'degreesE']):
+                lon_name = coord_name
+        except KeyError:
+            # Ignore this - it means the units attribute is not present
+            pass
+    return lon_name, lat_name
+
+
+def describe_file(filename, mtime=None, size=None):
+    """
+    Reads the metadata of a single file for the manifest
+
+    :param filename: The path of the file
+    :param mtime: The modification time of the file in ns
+                  Optional, defaults to reading it from the file system
+    :param size: The size of the file in bytes
+                 Optional, defaults to reading it from the file system
+    :return: A dict describing the file
+    """
+    if mtime is None or size is None:
+        _, mtime, size = file_signature([filename])[0]
+    with xr.open_dataset(filename, decode_times=True, decode_cf=True, cache=False) as dataset:
+        lon_name, lat_name = find_lon_lat(dataset)
+        entry = {
+            'path': os.path.abspath(filename),
+            'mtime': mtime,
+            'size': size,
+            'time_start': None,
+            'time_end': None,
+            'n_times': 0,
+            'variables': [str(name) for name in dataset.data_vars],
+            'lon_name': lon_name,
+            'lat_name': lat_name,
+            'grid': {},
+        }
+        if 'time' in dataset.coords and dataset.sizes.get('time', 0) > 0:
+            times = pd.DatetimeIndex(dataset['time'].values)
+            entry['time_start'] = times.min().isoformat()
+            entry['time_end'] = times.max().isoformat()
+            entry['n_times'] = len(times)
+        for name in (lon_name, lat_name):
+            if name is not None:
+                values = np.asarray(dataset[name].values, dtype=float)
+                entry['grid'][name] = {'size': len(values),
+                                       'first': float(values[0]),
+                                       'last': float(values[-1]),
+                                       'hash': cache_key(values.tolist())}
+    return entry
+
+
+def _time_order(entry):
+    # Files without times go last, in alphanumeric order
+    return (entry['time_start'] is None, entry['time_start'] or '', entry['path'])
+
+
+class Manifest(object):
+    '''
+    A manifest of the files matching a glob expression.
+
+        manifest = load_manifest('/data/rfe/*.nc', cache_dir)
+        file_list = manifest.files(start='2015-01-01')
+
+    The manifest is saved as JSON, and refreshed with refresh(), which only
+    opens files which are new or have changed.
+    '''
+
+    def __init__(self, path, filename=None):
+        '''
+        :param path:     A glob expression specifying the location of the data
+        :param filename: The path of the JSON file in which the manifest is saved.
+                         If this exists, the saved manifest is read.
+                         Optional - if not specified, the manifest is not saved
+        '''
+        self.path = os.path.abspath(path)
+        self.filename = filename
+        self.entries = []
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                saved = json.load(f)
+            if saved.get('version') == MANIFEST_VERSION and saved.get('path') == self.path:
+                self.entries = saved['files']
+
+    def refresh(self):
+        '''
+        Brings the manifest up to date with the files matching the glob
+        expression.  Only files which are new, or whose modification time or
+        size has changed, are opened.  The manifest is saved if it has changed.
+
+        :return: A tuple (list of entries for files which are new or have
+                 changed, list of paths of files which have been removed)
+        '''
+        known = dict((entry['path'], entry) for entry in self.entries)
+        entries = []
+        changed = []
+        for filename, mtime, size in file_signature(glob_files(self.path)):
+            entry = known.pop(filename, None)
+            if entry is None or entry['mtime'] != mtime or entry['size'] != size:
+                entry = describe_file(filename, mtime, size)
+                changed.append(entry)
+            entries.append(entry)
+        entries.sort(key=_time_order)
+        removed = sorted(known)
+
+        self.entries = entries
+        if (changed or removed) and self.filename is not None:
+            self.save()
+        return changed, removed
+
+    def save(self):
+        '''
+        Saves the manifest.  The file is replaced atomically.
+        '''
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, temporary = tempfile.mkstemp(suffix='.json', dir=directory)
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'path': self.path,
+                           'files': self.entries}, f)
+            os.replace(temporary, self.filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def select(self, start=None, end=None):
+        '''
+        The entries for the files which overlap a period, in time order
+
+        :param start: The start of the period (anything pandas can convert to a Timestamp)
+                      Optional, defaults to the start of the data
+        :param end:   The end of the period, inclusive
+                      Optional, defaults to the end of the data
+        :return:      A list of manifest entries
+        '''
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+        entries = []
+        for entry in self.entries:
+            if entry['time_start'] is not None:
+                if end is not None and pd.Timestamp(entry['time_start']) > end:
+                    continue
+                if start is not None and pd.Timestamp(entry['time_end']) < start:
+                    continue
+            entries.append(entry)
+        return entries
+
+    def files(self, start=None, end=None):
+        '''
+        The paths of the files which overlap a period, in time order.  The
+        arguments are as for select.
+
+        :return: A list of paths
+        '''
+        return [entry['path'] for entry in self.select(start, end)]
+
+    def signature(self, entries=None):
+        '''
+        The signature of the files (see cache.file_signature), as recorded in
+        the manifest
+
+        :param entries: The entries to include
+                        Optional, defaults to all of the entries
+        :return:        A list of [path, modification time in ns, size in bytes]
+        '''
+        if entries is None:
+            entries = self.entries
+        return [[entry['path'], entry['mtime'], entry['size']] for entry in entries]
+
+
+def load_manifest(path, cache_dir=None):
+    '''
+    Loads the manifest of the files matching a glob expression, and brings
+    it up to date
+
+    :param path:      A glob expression specifying the location of the data
+    :param cache_dir: The directory in which manifests are saved
+                      Optional - if not specified, the manifest is built in
+                      memory, which requires every file to be opened
+    :return:          A Manifest
+    '''
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'manifests',
+                                cache_key(os.path.abspath(path)) + '.json')
+    manifest = Manifest(path, filename)
+    manifest.refresh()
+    return manifest
@@ -0,0 +1,188 @@
+"""
+Metrics of daily rainfall over a window, for use as the metric of the TAMSAT
+alert code in place of the total or mean over the period of interest.
+
+Every metric operates on all of the windows at once.  It takes a numpy array
+of shape (windows, days[, columns]), i.e. the ensemble members or the
+climatological years, in which missing days (including the padding after the
+end of a shorter window) are NaN.  It returns a numpy array of shape
+(windows[, columns]).
+"""
+
+import warnings
+import numpy as np
+
+# The daily rainfall (mm) at or above which a day counts as a rain day
+RAIN_DAY_THRESHOLD = 1.0
+
+
+def window_metric(function):
+    '''
+    Marks a function as a vectorized window metric, so that it is applied to
+    all of the windows at once (see noleap.reduce_windows), rather than to
+    each window in turn.
+    '''
+    function.window_metric = True
+    return function
+
+
+@window_metric
+def rain_days(windows, threshold=RAIN_DAY_THRESHOLD):
+    '''
+    The number of rain days in each window
+
+    :param windows:   A numpy array of shape (windows, days[, columns])
+    :param threshold: The daily rainfall at or above which a day is a rain day
+                      Optional, defaults to RAIN_DAY_THRESHOLD
+    :return:          A numpy array of shape (windows[, columns])
+    '''
+    with np.errstate(invalid='ignore'):
+        wet = np.asarray(windows) >= threshold
+    return _missing_to_nan(windows, np.sum(wet, axis=1).astype(float))
+
+
+@window_metric
+def longest_dry_spell(windows, threshold=RAIN_DAY_THRESHOLD):
+    '''
+    The length, in days, of the longest run of consecutive dry days in each
+    window.  Missing days end a dry spell.
+
+    :param windows:   A numpy array of shape (windows, days[, columns])
+    :param threshold: The daily rainfall below which a day is dry
+                      Optional, defaults to RAIN_DAY_THRESHOLD
+    :return:          A numpy array of shape (windows[, columns])
+    '''
+    windows = np.asarray(windows, dtype=float)
+    with np.errstate(invalid='ignore'):
+        dry = windows < threshold
+    # The length of the dry spell ending on each day is the distance back to
+    # the last day which was not dry
+    positions = _day_positions(windows)
+    last_not_dry = np.maximum.accumulate(np.where(dry, -1, positions), axis=1)
+    spells = np.where(dry, positions - last_not_dry, 0)
+    return _missing_to_nan(windows, np.max(spells, axis=1, initial=0).astype(float))
+
+
+def max_n_day_total(windows, n_days):
+    '''
+    The maximum total over n_days consecutive days in each window.  Missing
+    days count as zero, and a window shorter than n_days gives its total.
+
+    :param windows: A numpy array of shape (windows, days[, columns])
+    :param n_days:  The number of consecutive days
+    :return:        A numpy array of shape (windows[, columns])
+    '''
+    windows = np.asarray(windows, dtype=float)
+    cumulative = _prefix_sums(np.nan_to_num(windows))
+    n_days = max(1, min(n_days, windows.shape[1]))
+    totals = cumulative[:, n_days:] - cumulative[:, :-n_days]
+    return _missing_to_nan(windows, np.max(totals, axis=1, initial=0))
+
+
+@window_metric
+def max_5day_total(windows):
+    '''
+    The maximum total over 5 consecutive days in each window
+
+    :param windows: A numpy array of shape (windows, days[, columns])
+    :return:        A numpy array of shape (windows[, columns])
+    '''
+    return max_n_day_total(windows, 5)
+
+
+@window_metric
+def onset_day(windows, wet_total=20.0, wet_days=3, dry_spell=7, dry_window=30,
+              threshold=RAIN_DAY_THRESHOLD):
+    '''
+    The day of the onset of the rains in each window, counted from the start of
+    the window.  This is the first day on which the total over wet_days days
+    reaches wet_total, and which is not followed by a false start, i.e. a dry
+    spell of dry_spell days within dry_window days.
+
+    :param windows:    A numpy array of shape (windows, days[, columns])
+    :param wet_total:  The total rainfall (mm) needed over wet_days days
+                       Optional, defaults to 20
+    :param wet_days:   The number of days over which to accumulate the rainfall
+                       Optional, defaults to 3
+    :param dry_spell:  The length of dry spell after the onset which makes it a false start
+                       Optional, defaults to 7
+    :param dry_window: The number of days after the onset in which to look for a dry spell
+                       Optional, defaults to 30
+    :param threshold:  The daily rainfall below which a day is dry
+                       Optional, defaults to RAIN_DAY_THRESHOLD
+    :return:           A numpy array of shape (windows[, columns]).  Windows with
+                       no onset give the length of the window, i.e. the onset is
+                       after the end of the window, so that they can still be
+                       ranked.  Windows with no data give NaN.
+    '''
+    windows = np.asarray(windows, dtype=float)
+    n_days = windows.shape[1]
+    days = np.arange(n_days)
+
+    # The total over wet_days days starting on each day
+    cumulative = _prefix_sums(np.nan_to_num(windows))
+    wet = (cumulative[:, np.minimum(days + wet_days, n_days)] - cumulative[:, days]) >= wet_total
+    wet &= (days + wet_days <= n_days).reshape((1, -1) + (1,) * (windows.ndim - 2))
+
+    # Whether a dry spell starts on each day, and whether one starts within the
+    # dry_window days after each day
+    with np.errstate(invalid='ignore'):
+        dry = _prefix_sums((windows < threshold).astype(float))
+    spell_starts = (dry[:, np.minimum(days + dry_spell, n_days)] - dry[:, days]) >= dry_spell
+    spell_starts = _prefix_sums(spell_starts.astype(float))
+    lo = np.minimum(days + 1, n_days)
+    hi = np.clip(days + dry_window - dry_spell + 2, lo, n_days)
+    false_start = (spell_starts[:, hi] - spell_starts[:, lo]) > 0
+
+    onset = wet & ~false_start
+    found = np.any(onset, axis=1)
+    return _missing_to_nan(windows, np.where(found, np.argmax(onset, axis=1), n_days).astype(float))
+
+
+# The metrics which may be selected by name.  The total and mean are the numpy
+# functions, since these are calculated from the cached prefix sums.
+METRICS = {
+    'total': np.sum,
+    'mean': np.mean,
+    'rain_days': rain_days,
+    'longest_dry_spell': longest_dry_spell,
+    'max_5day_total': max_5day_total,
+    'onset_day': onset_day,
+}
+
+
+def get_metric(metric):
+    '''
+    Looks up a metric
+
+    :param metric: The name of a metric in METRICS, or a function, which is
+                   returned unchanged
+    :return:       The metric function
+    '''
+    if callable(metric):
+        return metric
+    try:
+        return METRICS[metric]
+    except KeyError:
+        raise ValueError('Unknown metric %r.  Please use one of %s, or a function'
+                         % (metric, ', '.join(sorted(METRICS))))
+
+
+def _prefix_sums(values):
+    # The cumulative sums along the days axis, starting from zero, so that the
+    # total over days [i, j) is element j minus element i
+    zeros = np.zeros((values.shape[0], 1) + values.shape[2:])
+    return np.concatenate([zeros, np.cumsum(values, axis=1)], axis=1)
+
+
+def _day_positions(windows):
+    # The position of each day in its window, broadcastable against the windows
+    return np.arange(windows.shape[1]).reshape((1, -1) + (1,) * (windows.ndim - 2))
+
+
+def _missing_to_nan(windows, values):
+    # Windows which contain no data at all give NaN, as pandas does for the mean
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        present = np.any(~np.isnan(np.asarray(windows, dtype=float)), axis=1)
+    return np.where(present, values, np.nan)
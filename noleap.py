@@ -0,0 +1,338 @@
+"""
+A representation of daily timeseries on a no-leap (365 day) calendar,
+stored as a dense (years, 365) numpy array.
+
+This allows all of the ensemble and window operations in the TAMSAT alert
+code to be expressed as integer slicing, rather than repeatedly building
+boolean masks over a pandas DatetimeIndex.
+"""
+
+import warnings
+import numpy as np
+import pandas as pd
+
+DAYS_PER_YEAR = 365
+
+
+def noleap_doy(month, day):
+    '''
+    Calculates the (zero based) day of the year on a no-leap calendar
+
+    The 29th February is treated as the 1st March, since on a no-leap calendar
+    the first day on or after the 29th February is the 1st March.
+
+    :param month: The month of the year
+    :param day:   The day of the month
+    :return:      The day of the year, from 0 to 364
+    '''
+    if month == 2 and day == 29:
+        month, day = 3, 1
+    return pd.Timestamp(2001, month, day).dayofyear - 1
+
+
+def noleap_doys(index):
+    '''
+    Calculates the (zero based) day of the year on a no-leap calendar for every
+    date in a pandas DatetimeIndex.  Leap days are given the day of year of
+    the 1st March.
+
+    :param index: A pandas DatetimeIndex
+    :return:      A numpy array of days of the year, from 0 to 364
+    '''
+    index = pd.DatetimeIndex(index)
+    after_feb = np.asarray(index.is_leap_year & ((index.month > 2) |
+                                                 ((index.month == 2) & (index.day == 29))))
+    return np.asarray(index.dayofyear) - 1 - after_feb
+
+
+def noleap_dates(first_year, start, stop):
+    '''
+    Constructs the dates between two flat indices (stop is exclusive) on a
+    no-leap calendar, where the flat index is the number of no-leap days since
+    the 1st January of first_year.
+
+    :param first_year: The year of flat index 0
+    :param start:      The flat index of the first date
+    :param stop:       The flat index after the last date
+    :return:           A pandas DatetimeIndex
+    '''
+    positions = np.arange(start, max(start, stop))
+    if len(positions) == 0:
+        return pd.DatetimeIndex([])
+    years = first_year + positions // DAYS_PER_YEAR
+    doys = positions % DAYS_PER_YEAR
+    # Skip over the 29th February in leap years
+    is_leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+    offsets = doys + (is_leap & (doys >= noleap_doy(3, 1)))
+    year_starts = (years - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    return pd.DatetimeIndex(year_starts + offsets.astype('timedelta64[D]'))
+
+
+class YearDoyMatrix(object):
+    '''
+    A daily timeseries on a no-leap calendar, stored as a dense numpy array of
+    shape (years, 365), or (years, 365, columns) for multiple variables.
+
+    Missing days are stored as NaN.  Days are addressed by a flat integer index,
+    which is the number of days since the 1st January of the first year.
+    '''
+
+    def __init__(self, values, first_year, first_index=None, last_index=None, columns=None, name=None):
+        '''
+        :param values:      A numpy array of shape (years, 365) or (years, 365, columns)
+        :param first_year:  The year of the first row of values
+        :param first_index: The flat index of the first date in the original data
+                            Optional, defaults to the first day of the first year
+        :param last_index:  The flat index of the last date in the original data
+                            Optional, defaults to the last day of the last year
+        :param columns:     The column names, if there is a columns dimension
+        :param name:        The name of the original pandas Series, if there was one
+        '''
+        self.values = values
+        self.first_year = int(first_year)
+        self.first_index = 0 if first_index is None else int(first_index)
+        self.last_index = values.shape[0] * DAYS_PER_YEAR - 1 if last_index is None else int(last_index)
+        self.columns = columns
+        self.name = name
+        # The prefix sums are built on first use, and cached
+        self._cumsum = None
+        self._cumcount = None
+
+    @classmethod
+    def from_pandas(cls, data):
+        '''
+        Converts a pandas Series or DataFrame with a DatetimeIndex into a
+        YearDoyMatrix.  Any leap days are dropped.
+
+        :param data: A pandas Series or DataFrame with a DatetimeIndex
+        :return:     A YearDoyMatrix containing the same data
+        '''
+        if isinstance(data, cls):
+            return data
+        index = data.index
+        keep = ~np.asarray((index.month == 2) & (index.day == 29))
+        index = index[keep]
+        raw = np.asarray(data.values, dtype=float)[keep]
+
+        first_year = index[0].year
+        n_years = index[-1].year - first_year + 1
+        flat_index = (np.asarray(index.year) - first_year) * DAYS_PER_YEAR + noleap_doys(index)
+
+        flat = np.full((n_years * DAYS_PER_YEAR,) + raw.shape[1:], np.nan)
+        flat[flat_index] = raw
+
+        columns = data.columns if isinstance(data, pd.DataFrame) else None
+        name = getattr(data, 'name', None)
+        return cls(flat.reshape((n_years, DAYS_PER_YEAR) + raw.shape[1:]),
+                   first_year, flat_index[0], flat_index[-1], columns, name)
+
+    @property
+    def years(self):
+        '''The years covered by the rows of the matrix'''
+        return np.arange(self.first_year, self.first_year + self.values.shape[0])
+
+    @property
+    def flat(self):
+        '''A view of the values as a single (days[, columns]) timeseries'''
+        return self.values.reshape((-1,) + self.values.shape[2:])
+
+    def index(self, year, month, day):
+        '''
+        Calculates the flat index of a date.  This may fall outside the matrix.
+
+        :param year:  The year
+        :param month: The month of the year
+        :param day:   The day of the month
+        :return:      The flat index
+        '''
+        return (year - self.first_year) * DAYS_PER_YEAR + noleap_doy(month, day)
+
+    def date_index(self, date):
+        '''
+        Calculates the flat index of a pandas Timestamp.  This may fall outside the matrix.
+        '''
+        return self.index(date.year, date.month, date.day)
+
+    def window_indices(self, years, start_day, start_month, end_day, end_month):
+        '''
+        Calculates the flat indices of a window in each of a number of years.
+        The window runs from the start date (inclusive) to the end date (exclusive).
+        If the end date is before the start date in the year, the window ends
+        in the following year.
+
+        :param years:       The years in which the windows start
+        :param start_day:   The day of the month of the start of the window
+        :param start_month: The month of the year of the start of the window
+        :param end_day:     The day of the month of the end of the window
+        :param end_month:   The month of the year of the end of the window
+        :return:            A tuple of numpy arrays (starts, stops)
+        '''
+        years = np.asarray(years)
+        start_doy = noleap_doy(start_month, start_day)
+        end_doy = noleap_doy(end_month, end_day)
+        crosses_year = (start_month, start_day) > (end_month, end_day)
+        starts = (years - self.first_year) * DAYS_PER_YEAR + start_doy
+        stops = (years + int(crosses_year) - self.first_year) * DAYS_PER_YEAR + end_doy
+        return starts, stops
+
+    def set_value(self, index, value):
+        '''
+        Sets the value of a single day, e.g. to append a new observation.  If the
+        day is after the last date of the data, it becomes the last date.
+
+        :param index: The flat index of the day, which must be within the matrix
+        :param value: The value
+        '''
+        self.values[index // DAYS_PER_YEAR, index % DAYS_PER_YEAR] = value
+        self.last_index = max(self.last_index, int(index))
+        self._cumsum = None
+        self._cumcount = None
+
+    def prefix_sums(self):
+        '''
+        The cumulative sums and counts of the non-missing values, so that the
+        sum over any window is the difference of two lookups.  These are built
+        on first use, and cached.
+
+        :return: A tuple of numpy arrays (sums, counts), each of shape
+                 (days + 1[, columns]), where element i is the total over
+                 the first i days
+        '''
+        if self._cumsum is None:
+            flat = self.flat
+            present = ~np.isnan(flat)
+            zeros = np.zeros((1,) + flat.shape[1:])
+            self._cumsum = np.concatenate(
+                [zeros, np.cumsum(np.where(present, flat, 0.0), axis=0)])
+            self._cumcount = np.concatenate(
+                [zeros, np.cumsum(present, axis=0)])
+        return self._cumsum, self._cumcount
+
+    def window_sum(self, starts, stops):
+        '''
+        Calculates the sums of the non-missing values between pairs of flat
+        indices (stops are exclusive).  Any days outside the matrix are ignored.
+
+        :param starts: The flat indices of the first day of each window
+        :param stops:  The flat indices after the last day of each window
+        :return:       A numpy array of shape (windows[, columns])
+        '''
+        cumsum, _ = self.prefix_sums()
+        starts, stops = self._clip_windows(starts, stops)
+        return cumsum[stops] - cumsum[starts]
+
+    def window_count(self, starts, stops):
+        '''
+        Calculates the number of non-missing values between pairs of flat
+        indices (stops are exclusive).
+
+        :return: A numpy array of shape (windows[, columns])
+        '''
+        _, cumcount = self.prefix_sums()
+        starts, stops = self._clip_windows(starts, stops)
+        return cumcount[stops] - cumcount[starts]
+
+    def window_mean(self, starts, stops):
+        '''
+        Calculates the means of the non-missing values between pairs of flat
+        indices (stops are exclusive).  Windows with no data give NaN.
+
+        :return: A numpy array of shape (windows[, columns])
+        '''
+        sums = self.window_sum(starts, stops)
+        counts = self.window_count(starts, stops)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+    def _clip_windows(self, starts, stops):
+        n_days = self.values.shape[0] * DAYS_PER_YEAR
+        starts = np.clip(np.asarray(starts), 0, n_days)
+        stops = np.clip(np.asarray(stops), 0, n_days)
+        return starts, np.maximum(starts, stops)
+
+    def take(self, start, stop):
+        '''
+        Extracts the values between two flat indices (stop is exclusive).
+        Any days outside the matrix are filled with NaN.
+
+        :param start: The flat index of the first day
+        :param stop:  The flat index after the last day
+        :return:      A numpy array of shape (days[, columns])
+        '''
+        return self.take_windows(np.array([start]), stop - start)[0]
+
+    def take_windows(self, starts, length):
+        '''
+        Extracts equal length windows of values starting at each of a number
+        of flat indices.  Any days outside the matrix are filled with NaN.
+
+        :param starts: A numpy array of flat indices of the first day of each window
+        :param length: The number of days in each window
+        :return:       A numpy array of shape (windows, length[, columns])
+        '''
+        flat = self.flat
+        positions = np.asarray(starts)[:, np.newaxis] + np.arange(max(length, 0))
+        valid = (positions >= 0) & (positions < flat.shape[0])
+        out = flat[np.clip(positions, 0, max(flat.shape[0] - 1, 0))]
+        out[~valid] = np.nan
+        return out
+
+    def dates(self, start, stop):
+        '''
+        Constructs the no-leap dates between two flat indices (stop is exclusive)
+
+        :return: A pandas DatetimeIndex
+        '''
+        return noleap_dates(self.first_year, start, stop)
+
+    def to_pandas(self, start=None, stop=None):
+        '''
+        Converts the values between two flat indices (stop is exclusive) back
+        into a pandas Series or DataFrame.  Days before the first, or after the
+        last, date of the original data are not included.
+
+        :param start: The flat index of the first day
+                      Optional, defaults to the first date of the original data
+        :param stop:  The flat index after the last day
+                      Optional, defaults to after the last date of the original data
+        :return:      A pandas Series or DataFrame
+        '''
+        start = self.first_index if start is None else max(start, self.first_index)
+        stop = self.last_index + 1 if stop is None else min(stop, self.last_index + 1)
+        stop = max(start, stop)
+        index = self.dates(start, stop)
+        values = self.flat[start:stop]
+        if self.columns is not None:
+            return pd.DataFrame(values, index=index, columns=self.columns)
+        return pd.Series(values, index=index, name=self.name)
+
+
+def reduce_windows(windows, operation, columns=None):
+    '''
+    Performs an operation on each of a number of windows of data, where
+    missing data is NaN.  np.sum and np.mean are vectorized, and ignore missing
+    data in the same way as the pandas sum and mean.  Vectorized window metrics
+    (see the metrics module) are applied to all of the windows at once.  Any
+    other operation is applied to each window in turn, as a pandas Series (or
+    DataFrame if there are columns).
+
+    :param windows:   A numpy array of shape (windows, days[, columns])
+    :param operation: The operation to perform.  Should be a function (e.g. np.sum)
+    :param columns:   The column names, if there is a columns dimension
+    :return:          A numpy array of the results, one for each window
+    '''
+    if getattr(operation, 'window_metric', False):
+        return operation(windows)
+
+    with warnings.catch_warnings():
+        # Windows containing only missing data give NaN, as they do in pandas
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        if operation in (np.sum, np.nansum):
+            return np.nansum(windows, axis=1)
+        if operation in (np.mean, np.nanmean):
+            return np.nanmean(windows, axis=1)
+
+    if columns is not None:
+        return np.array([operation(pd.DataFrame(window, columns=columns))
+                         for window in windows])
+    return np.array([operation(pd.Series(window)) for window in windows])
@@ -0,0 +1,426 @@
+"""
+Functions for calculating the TAMSAT alert probabilities.
+
+These were previously part of tamsat_alert_plots.  They have been moved here
+so that the probabilities can be calculated without plotting, and without
+importing matplotlib.
+
+The distributions are evaluated at all of the thresholds with single array
+calls, rather than one threshold at a time.  The metric arrays may be stacked,
+with the climatological years or ensemble members along the last axis, so
+that the probabilities for many locations or cast dates are calculated at once.
+"""
+
+import numpy as np
+import scipy.stats as sps
+
+# The climatological quantiles at which the normal distributions are compared
+THRESHOLDS = np.arange(0.01, 1.01, 0.01)
+
+
+def calc_risk_probabilities(climametric, forecametric, Wmetric, stat, weights,
+                            climastartyear, climaendyear):
+    """
+    Calculates the probability estimates for a given risk metric, without
+    producing any plots or output files.
+
+    :param climametric: array of climatological values of the metric
+    :param forecametric: array of ensemble forecast values of the metric
+    :param Wmetric: array of values of the metric being used for weighting
+    :param stat: statistical method to be used for probability distribution comparison (ecdf or normal)
+    :param weights: tercile forecast probabilities of the weighting metric used
+    :param climastartyear: the year climatology value start.
+    :param climaendyear: the year climatology value end.
+    :return: A tuple containing (the climatological probabilities, the projected
+             probabilities, the probabilities of each quintile category
+             [very low, low, average, high, very high], the projected mean,
+             the projected standard deviation)
+    """
+    climayears = np.arange(climastartyear, climaendyear + 1)
+
+    # calcualte the mean and sd of the the projected
+    # metric based on climatology weather data
+    # we need the weighted metric frorecast
+    projmean, projsd = weight_forecast(
+        forecametric, Wmetric, weights, climastartyear, climaendyear)
+    projsd = np.maximum(projsd, 0.001)  # avoid division by zero
+
+    # the ecdf of the projected metric is weighted in the same way as the
+    # projected mean and sd
+    forecametric, memberweights = forecast_weights(
+        forecametric, Wmetric, weights, climastartyear, climaendyear)
+
+    probabilityclim, probabilitymetric, val = risk_probabilities(
+        climametric, forecametric, np.ravel(projmean)[0], projsd, stat,
+        len(climayears), memberweights)
+
+    return probabilityclim, probabilitymetric, list(val), projmean, projsd
+
+
+def risk_probabilities(climametric, forecametric, projmean, projsd, stat, n_years=None,
+                       memberweights=None):
+    """
+    Calculates the climatological and projected probabilities of the metric
+    at each threshold, and the probabilities of each quintile category.
+
+    The inputs may be stacked for many locations or cast dates, with the
+    climatological years (or ensemble members) along the last axis, and the
+    projected means and standard deviations having the shape of the remaining
+    axes.
+
+    :param climametric:  array of climatological values of the metric, of shape (..., years)
+    :param forecametric: array of ensemble forecast values of the metric, of shape (..., members)
+    :param projmean:     the projected mean, of shape (...)
+    :param projsd:       the projected standard deviation, of shape (...)
+    :param stat:         statistical method to be used for probability distribution comparison (ecdf or normal)
+    :param n_years:      the number of climatological years used to find the
+                         quintiles of the ecdf
+                         Optional, defaults to the length of the last axis of climametric
+    :param memberweights: the weight of each ensemble member in the ecdf, broadcastable
+                          against forecametric, as returned by forecast_weights
+                          Optional, defaults to equal weights
+    :return:             A tuple containing (the climatological probabilities,
+                         the projected probabilities, the probabilities of each quintile
+                         category, of shape (..., 5))
+    """
+    climametric = np.asarray(climametric, dtype=float)
+    if n_years is None:
+        n_years = climametric.shape[-1]
+
+    if stat == 'normal':
+        probabilityclim, probabilitymetric = normal_probabilities(
+            climametric, projmean, projsd)
+        # the thresholds at the 20th, 40th, 60th and 80th percentiles
+        critical = np.array([19, 39, 59, 79])
+    elif stat == 'ecdf':
+        probabilityclim, probabilitymetric = ecdf_probabilities(
+            climametric, forecametric, memberweights)
+        # identifying the index for the critical points
+        nn = int(round(n_years / 5., 0))  # this should be an intiger
+        critical = nn * np.arange(1, 5)
+    else:
+        raise ValueError('Please use only "normal" or "ecdf" stat method')
+
+    return probabilityclim, probabilitymetric, quintile_probabilities(
+        probabilitymetric[..., critical])
+
+
+def climatological_thresholds(climametric, thresholds=THRESHOLDS):
+    """
+    Calculates the values of the metric at quantiles of a normal distribution
+    fitted to the climatology.
+
+    :param climametric: array of climatological values of the metric, of shape (..., years)
+    :param thresholds:  the quantiles
+                        Optional, defaults to THRESHOLDS
+    :return:            A numpy array of shape (..., thresholds)
+    """
+    climametric = np.asarray(climametric, dtype=float)
+    climamean = np.mean(climametric, axis=-1)[..., np.newaxis]
+    climasd = np.std(climametric, axis=-1)[..., np.newaxis]
+    return sps.norm.ppf(thresholds, climamean, climasd)
+
+
+def normal_probabilities(climametric, projmean, projsd, thresholds=THRESHOLDS):
+    """
+    Calculates the climatological and projected normal cumulative probabilities
+    at the climatological thresholds.
+
+    :param climametric: array of climatological values of the metric, of shape (..., years)
+    :param projmean:    the projected mean, of shape (...)
+    :param projsd:      the projected standard deviation, of shape (...)
+    :param thresholds:  the climatological quantiles at which to compare the distributions
+                        Optional, defaults to THRESHOLDS
+    :return:            A tuple of numpy arrays (climatological probabilities,
+                        projected probabilities), each of shape (..., thresholds)
+    """
+    climametric = np.asarray(climametric, dtype=float)
+    climamean = np.mean(climametric, axis=-1)[..., np.newaxis]
+    climasd = np.std(climametric, axis=-1)[..., np.newaxis]
+    projmean = np.asarray(projmean, dtype=float)[..., np.newaxis]
+    projsd = np.asarray(projsd, dtype=float)[..., np.newaxis]
+
+    thres = sps.norm.ppf(thresholds, climamean, climasd)
+    probabilityclim = sps.norm.cdf(thres, climamean, climasd)
+    probabilitymetric = sps.norm.cdf(thres, projmean, projsd)
+    return probabilityclim, probabilitymetric
+
+
+def ecdf_probabilities(climametric, forecametric, memberweights=None):
+    """
+    Calculates the climatological and projected empirical cumulative
+    probabilities, using the climatological values as the thresholds.
+
+    As with statsmodels' ECDF, the first threshold is -inf, followed by the
+    sorted climatological values.  The climatology may be shared by stacked
+    forecasts, e.g. a climametric of shape (years,) with a forecametric of
+    shape (cast dates, members).
+
+    :param climametric:   array of climatological values of the metric, of shape (..., years)
+    :param forecametric:  array of ensemble forecast values of the metric, of shape (..., members)
+    :param memberweights: the weight of each ensemble member, broadcastable against
+                          forecametric, e.g. of shape (scenarios, members)
+                          Optional, defaults to equal weights
+    :return:              A tuple of numpy arrays (climatological probabilities,
+                          projected probabilities), each of shape (..., years + 1)
+    """
+    climametric = np.sort(np.asarray(climametric, dtype=float), axis=-1)
+    thres = np.concatenate(
+        [np.full(climametric.shape[:-1] + (1,), -np.inf), climametric], axis=-1)
+    probabilityclim = ecdf(climametric, thres)
+    probabilitymetric = weighted_ecdf(forecametric, memberweights, thres)
+    return probabilityclim, probabilitymetric
+
+
+def ecdf(sorted_values, thres):
+    """
+    Evaluates the empirical cumulative distribution function of sorted samples,
+    i.e. the proportion of the samples less than or equal to each threshold.
+
+    :param sorted_values: array of samples, sorted along the last axis, of shape (..., samples)
+    :param thres:         array of thresholds, of shape (..., thresholds)
+    :return:              A numpy array of shape (..., thresholds)
+    """
+    sorted_values = np.asarray(sorted_values, dtype=float)
+    return count_not_greater(sorted_values, thres) / float(sorted_values.shape[-1])
+
+
+def weighted_ecdf(values, memberweights, thres):
+    """
+    Evaluates the weighted empirical cumulative distribution function of
+    samples, i.e. the total weight of the samples less than or equal to each
+    threshold.  The samples are sorted once, and the thresholds found in the
+    cumulative weights with a sorted search.
+
+    :param values:        array of samples, of shape (..., samples)
+    :param memberweights: the weight of each sample, broadcastable against values.
+                          These need not sum to one.  If None, the samples are
+                          equally weighted.
+    :param thres:         array of thresholds, of shape (..., thresholds)
+    :return:              A numpy array of shape (..., thresholds)
+    """
+    values = np.asarray(values, dtype=float)
+    if memberweights is None:
+        return ecdf(np.sort(values, axis=-1), thres)
+
+    values, memberweights = np.broadcast_arrays(values, np.asarray(memberweights, dtype=float))
+    order = np.argsort(values, axis=-1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=-1)
+    cumweights = np.cumsum(np.take_along_axis(memberweights, order, axis=-1), axis=-1)
+    cumweights = cumweights / cumweights[..., -1:]
+    # the total weight of no samples is zero
+    cumweights = np.concatenate(
+        [np.zeros(cumweights.shape[:-1] + (1,)), cumweights], axis=-1)
+
+    counts = count_not_greater(sorted_values, thres)
+    cumweights = np.broadcast_to(cumweights, counts.shape[:-1] + cumweights.shape[-1:])
+    return np.take_along_axis(cumweights, counts, axis=-1)
+
+
+def count_not_greater(sorted_values, thres):
+    """
+    Counts the number of sorted values less than or equal to each threshold,
+    with a sorted search along the last axis.
+
+    :param sorted_values: array sorted along the last axis, of shape (..., values)
+    :param thres:         array of thresholds, of shape (..., thresholds)
+    :return:              An integer numpy array of shape (..., thresholds)
+    """
+    sorted_values = np.asarray(sorted_values, dtype=float)
+    thres = np.asarray(thres, dtype=float)
+    if sorted_values.ndim == 1 and thres.ndim <= 1:
+        return np.searchsorted(sorted_values, thres, side='right')
+
+    # np.searchsorted only works on 1-D arrays, so for stacked inputs the values
+    # and thresholds are merged with a stable sort.  Values equal to a threshold
+    # come before it, so the number of values before each threshold in the
+    # merged order is the count of values less than or equal to it.
+    shape = np.broadcast_shapes(sorted_values.shape[:-1], thres.shape[:-1])
+    sorted_values = np.broadcast_to(sorted_values, shape + sorted_values.shape[-1:])
+    thres = np.broadcast_to(thres, shape + thres.shape[-1:])
+    n_values = sorted_values.shape[-1]
+    merged = np.concatenate([sorted_values, thres], axis=-1)
+    order = np.argsort(merged, axis=-1, kind='stable')
+    values_before = np.cumsum(order < n_values, axis=-1)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order,
+                      np.broadcast_to(np.arange(merged.shape[-1]), merged.shape), axis=-1)
+    return np.take_along_axis(values_before, ranks[..., n_values:], axis=-1)
+
+
+def quintile_probabilities(critical):
+    """
+    Calculates the probability of each quintile category from the projected
+    cumulative probabilities at the climatological quintiles.
+
+    :param critical: array of the projected cumulative probabilities at the 20th,
+                     40th, 60th and 80th climatological percentiles, of shape (..., 4)
+    :return:         A numpy array of the probabilities of
+                     [very low, low, average, high, very high], of shape (..., 5)
+    """
+    critical = np.asarray(critical, dtype=float)
+    edges = np.concatenate([np.zeros(critical.shape[:-1] + (1,)), critical,
+                            np.ones(critical.shape[:-1] + (1,))], axis=-1)
+    return np.diff(edges, axis=-1)
+
+
+def forecast_weights(forecametric, Wmetric, weights, climastartyear, climaendyear):
+    """
+    Calculates the weight of each ensemble member, with the ranking used by
+    weight_forecast.  The members are ranked by the weighting metric, and the
+    members in each tercile of the ranking are given the weight of that tercile.
+
+    Every member is kept.  When the number of members is not divisible by the
+    number of weights, the terciles differ in size by one member, and the
+    weights are normalised over all of the members, so that equal tercile
+    weights give every member the same weight.  The inputs may be stacked,
+    with the members along the last axis.
+
+    :param forecametric:   array of ensemble forecast values of the metric, of shape (..., members)
+    :param Wmetric:        array of values of the metric being used for weighting,
+                           broadcastable against forecametric
+    :param weights:        tercile forecast probabilities of the weighting metric used.
+                           This may be of shape (scenarios, 3), to weight the members
+                           for several scenarios at once.
+    :param climastartyear: the year climatology value start.
+    :param climaendyear:   the year climatology value end.
+    :return:               A tuple of numpy arrays (the members, of shape (..., members),
+                           and their weights, of the shape of the members broadcast
+                           against the scenarios)
+    """
+    weights = np.asarray(weights, dtype=float)
+    forecametric = np.asarray(forecametric, dtype=float)
+    Wmetric = np.asarray(Wmetric, dtype=float)
+    # the weighting metric may cover fewer years than the ensemble
+    n_members = min(forecametric.shape[-1], Wmetric.shape[-1])
+    forecametric, Wmetric = np.broadcast_arrays(forecametric[..., :n_members],
+                                                Wmetric[..., :n_members])
+
+    # the members are ranked as weight_forecast sorts them, by the weighting
+    # metric and then the forecast metric
+    order = np.lexsort((forecametric, Wmetric), axis=-1)
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(n_members), order.shape), axis=-1)
+    terciles = ranks * weights.shape[-1] // n_members
+
+    shape = np.broadcast_shapes(forecametric.shape, weights.shape[:-1] + (n_members,))
+    memberweights = np.take_along_axis(np.broadcast_to(weights, shape[:-1] + weights.shape[-1:]),
+                                       np.broadcast_to(terciles, shape), axis=-1)
+    memberweights = memberweights / np.sum(memberweights, axis=-1, keepdims=True)
+    return forecametric, memberweights
+
+
+# GG - Modified to take the data, rather than rereading the files
+def weight_forecast(forecametric, Wmetric, weights, climastartyear, climaendyear):
+    # Weights for the ecdf are implemented in forecast_weights and weighted_ecdf
+
+    # GG - Code calling np.genfromtxt again was removed, since it is unnecessary.
+
+    # the metric for ordering the true metric(forecametric)
+    # is total precipitation of JJA.
+
+    # ECB: Note that if we have fewer years for the weighting metric, which can happen if we go over the year boundary, zip will cut out the end of the ensembles time series. This should be sorted out now. The onus is on the user to specify the correct years.
+    # ECB: Note that when we cross the year boundary in either ensemble period of interest or weighting metric period of interest, we reference the FIRST year in the period. So if we are using a DJF weighting metric period of interest, for a MAM ensemble period of interest, we will be weighting a using a metric AFTER the period of interest.  This needs to be resolved. The user needs to specify whether our forecast period starts in the same year, the year before or the year after.
+
+    # The weighting is done by weight_forecast_scenarios, for a single scenario
+    fy_wmean, fy_wsd = weight_forecast_scenarios(
+        forecametric, Wmetric, [weights], climastartyear, climaendyear)
+    return fy_wmean, fy_wsd[0]
+
+
+def weight_forecast_scenarios(forecametric, Wmetric, weights, climastartyear, climaendyear):
+    """
+    Calculates the weighted mean and standard deviation of the ensemble
+    forecast for each of a number of tercile weight scenarios.  The members are
+    sorted once, and the statistics for all of the scenarios are calculated
+    together by weight_forecasts.
+
+    :param forecametric:   array of ensemble forecast values of the metric
+    :param Wmetric:        array of values of the metric being used for weighting
+    :param weights:        array of tercile forecast probabilities of the weighting
+                           metric, of shape (scenarios, 3)
+    :param climastartyear: the year climatology value start.
+    :param climaendyear:   the year climatology value end.
+    :return:               A tuple of numpy arrays (projected weighted means,
+                           projected weighted standard deviations), each of shape (scenarios,)
+    """
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    return weight_forecasts(forecametric, Wmetric, weights, climastartyear, climaendyear)
+
+
+def weight_forecasts(forecametric, Wmetric, weights, climastartyear, climaendyear):
+    """
+    Calculates the weighted mean and standard deviation of stacked ensemble
+    forecasts, e.g. for every cell of a grid, or for stacked tercile weight
+    scenarios, in the same way as weight_forecast.
+
+    :param forecametric:   array of ensemble forecast values of the metric, of shape (..., members)
+    :param Wmetric:        array of values of the metric being used for weighting,
+                           broadcastable against forecametric (e.g. of shape (members,)
+                           if it is shared by all of the forecasts)
+    :param weights:        tercile forecast probabilities of the weighting metric used,
+                           of shape (..., 3), broadcastable against the forecasts
+    :param climastartyear: the year climatology value start.
+    :param climaendyear:   the year climatology value end.
+    :return:               A tuple of numpy arrays (projected weighted means,
+                           projected weighted standard deviations), each of the shape
+                           of the forecasts broadcast against the weights, without
+                           the last axis
+    """
+    weights = np.asarray(weights, dtype=float)
+
+    # years are removed from the climatology to make the length
+    # divisible by the number of weights
+    n_years = climaendyear - climastartyear + 1
+    n_years -= n_years % weights.shape[-1]
+    forecametric = np.asarray(forecametric, dtype=float)[..., :n_years]
+    Wmetric = np.broadcast_to(np.asarray(Wmetric, dtype=float)[..., :n_years],
+                              forecametric.shape)
+
+    # sort in ascending order based on the metric, as sorting the
+    # (Wmetric, forecametric) pairs did
+    order = np.lexsort((forecametric, Wmetric), axis=-1)
+    allweights = np.repeat(weights, forecametric.shape[-1] // weights.shape[-1], axis=-1)
+    allweights = allweights / np.sum(allweights, axis=-1, keepdims=True)
+
+    # The weighted mean is of the forecast metric after being sorted by the
+    # metric.  As in the original code, the weighted variance is about the
+    # unsorted forecast metric.
+    fy_wmean = np.sum(np.take_along_axis(forecametric, order, axis=-1) * allweights, axis=-1)
+    variance = np.sum((forecametric - fy_wmean[..., np.newaxis])**2 * allweights, axis=-1)
+    return fy_wmean, np.sqrt(variance)
+
+
+def scenario_probabilities(climametric, forecametric, Wmetric, stat, weights,
+                           climastartyear, climaendyear):
+    """
+    Calculates the quintile probabilities for each of a number of tercile
+    weight scenarios, e.g. to compare several seasonal forecasts without
+    rerunning the ensemble.
+
+    :param climametric:    array of climatological values of the metric
+    :param forecametric:   array of ensemble forecast values of the metric
+    :param Wmetric:        array of values of the metric being used for weighting
+    :param stat:           statistical method to be used for probability distribution comparison (ecdf or normal)
+    :param weights:        array of tercile forecast probabilities of the weighting
+                           metric, of shape (scenarios, 3)
+    :param climastartyear: the year climatology value start.
+    :param climaendyear:   the year climatology value end.
+    :return:               A tuple of numpy arrays (the probabilities of each quintile
+                           category, of shape (scenarios, 5), the projected means
+                           and the projected standard deviations, of shape (scenarios,))
+    """
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    climayears = np.arange(climastartyear, climaendyear + 1)
+
+    projmean, projsd = weight_forecast_scenarios(
+        forecametric, Wmetric, weights, climastartyear, climaendyear)
+    projsd = np.maximum(projsd, 0.001)  # avoid division by zero
+
+    forecametric, memberweights = forecast_weights(
+        forecametric, Wmetric, weights, climastartyear, climaendyear)
+
+    _, _, val = risk_probabilities(
+        climametric, forecametric, projmean, projsd, stat, len(climayears),
+        memberweights)
+    return val, projmean, projsd
@@ -0,0 +1,248 @@
+"""
+Rendering of the TAMSAT alert plots, separated from the calculations.
+
+The figures are drawn with the object oriented matplotlib API (Figure and
+the Agg canvas) rather than pyplot, so that no global state is shared and
+they can be drawn safely in threads or processes.  A RenderQueue renders
+plots for many results in a pool of workers, so that the caller can
+continue with its calculations.
+"""
+
+import os
+import calendar
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import scipy.stats as sps
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def _poi_date(day, month):
+    return str(day).zfill(2)+'-'+calendar.month_name[month][0:3]
+
+
+def _ticks_style(ax):
+    # Equivalent of the seaborn "ticks" style, applied to a single axes
+    ax.grid(False)
+    ax.tick_params(direction='out', length=6)
+    ax.set_facecolor('white')
+
+
+def draw_quintile_figure(quintile_probabilities, f_date, poi_start_date, poi_end_date):
+    '''
+    Draws the bar plot of the probability of each quintile category
+
+    :param quintile_probabilities: The probabilities of the categories
+                                   [very low, low, average, high, very high]
+    :param f_date:                 The forecast date, as a string
+    :param poi_start_date:         The start of the period of interest, as a string
+    :param poi_end_date:           The end of the period of interest, as a string
+    :return:                       A matplotlib Figure
+    '''
+    val = np.asarray(quintile_probabilities, dtype=float)
+
+    fig = Figure(figsize=(5,5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    _ticks_style(ax)
+
+    pos = np.arange(5) + .5        # the bar centers on the y axis
+    for ptl in np.arange(0,5):
+        ax.barh(pos[ptl], val[ptl] * 100, align='center',
+                color='grey',edgecolor='black',linewidth=3)
+        ax.annotate(str(round(val[ptl] * 100, 1)) + '%', ((val[ptl] * 100) + 1,
+                    pos[ptl]), xytext=(0, 1), textcoords='offset points', fontsize=20)
+
+    ax.set_yticks(pos)
+    ax.set_yticklabels(('Very low\n(0-20%)', 'Low\n(20-40%)', 'Average\n(40-60%)',
+                        'High\n(60-80%)', 'Very high\n(80-100%)'), fontsize=14)
+    ax.tick_params(axis='x', labelsize=14)
+    ax.set_xlabel('Probability (%)', fontsize=14)
+    ax.set_ylabel('Quintile category',fontsize=14)
+    ax.set_title('Forecast date: ' + f_date + '\nPeriod of interest: '+poi_start_date+' to '+poi_end_date, loc='left', fontsize=14)
+    ax.set_xlim(0, 101)
+    fig.tight_layout()
+    return fig
+
+
+def draw_distribution_figure(climametric, forecametric, projmean, projsd,
+                             climastartyear, climaendyear,
+                             f_date, poi_start_date, poi_end_date):
+    '''
+    Draws the comparison of the predicted distribution against the climatological
+    distribution
+
+    :param climametric:    array of climatological values of the metric
+    :param forecametric:   array of ensemble forecast values of the metric
+    :param projmean:       the weighted mean of the ensemble
+    :param projsd:         the weighted standard deviation of the ensemble
+    :param climastartyear: the year climatology value start.
+    :param climaendyear:   the year climatology value end.
+    :param f_date:         The forecast date, as a string
+    :param poi_start_date: The start of the period of interest, as a string
+    :param poi_end_date:   The end of the period of interest, as a string
+    :return:               A matplotlib Figure
+    '''
+    climametric = np.asarray(climametric, dtype=float)
+    forecametric = np.asarray(forecametric, dtype=float)
+    climamean = np.mean(climametric)
+    climasd = np.std(climametric)
+
+    fig = Figure(figsize=(6,6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    _ticks_style(ax)
+
+    alldata = np.append(climametric, forecametric)
+    bins = np.linspace(min(alldata), max(alldata), 10)
+
+    y = sps.norm.pdf(bins, climamean, climasd)
+    ax.plot(bins, y, color="black",linewidth=3,label="Climatological distribution")
+    ax.fill_between(bins,y,np.zeros(len(y)),color="grey",alpha=0.8)
+
+    y3 = sps.norm.pdf(bins, np.ravel(projmean)[0], projsd)
+    ax.plot(bins, y3, color="black",ls="-",linewidth=3,marker="o",markersize=10,
+            label="Predicted distribution",alpha=0.9)
+
+    ax.set_xlabel('Metric value', fontsize=14)
+    ax.set_ylabel('Probability density', fontsize=14)
+    ax.set_title('Comparison of prediction against \n' + str(climastartyear) + '-' + str(climaendyear) +
+                 ' climatology'+'\nForecast date: ' + f_date+'\nPeriod of interest: '+poi_start_date+' to '+poi_end_date, loc='left', fontsize=14)
+    ax.tick_params(labelsize=14)
+    ax.set_xlim(min(alldata), max(alldata))
+    ax.set_ylim(bottom=0)
+    ax.legend(loc=8,fontsize=12,framealpha=0.5)
+    fig.tight_layout()
+    return fig
+
+
+def render_alert_plots(result, outdir, cast_date,
+                       poi_start_day, poi_start_month,
+                       poi_end_day, poi_end_month,
+                       climastartyear, climaendyear,
+                       dpi=300, fmt='png'):
+    '''
+    Renders the quintile and distribution plots for the results of a TAMSAT
+    alert run.
+
+    :param result:          An AlertResult, as returned by tamsat_alert
+    :param outdir:          The path at which to output the plots
+    :param cast_date:       The (fore/hind)cast date (pandas Timestamp)
+    :param poi_start_day:   The day of the month of the start of the period of interest
+    :param poi_start_month: The month of the year of the start of the period of interest
+    :param poi_end_day:     The day of the month of the end of the period of interest
+    :param poi_end_month:   The month of the year of the end of the period of interest
+    :param climastartyear:  The start year of the climatology
+    :param climaendyear:    The end year of the climatology
+    :param dpi:             The resolution of raster output
+                            Optional, defaults to 300
+    :param fmt:             The output format, e.g. 'png', or 'pdf' or 'svg' for
+                            vector output
+                            Optional, defaults to 'png'
+    :return:                A list of the paths of the files written
+    '''
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    f_date = cast_date.strftime('%d-%b-%Y')
+    poi_start_date = _poi_date(poi_start_day, poi_start_month)
+    poi_end_date = _poi_date(poi_end_day, poi_end_month)
+
+    figures = [
+        ('pentile_', draw_quintile_figure(result.quintile_probabilities,
+                                          f_date, poi_start_date, poi_end_date)),
+        ('hist_plot_', draw_distribution_figure(result.climatological_sums.values.T[0],
+                                                result.ensemble_totals.values.T[0],
+                                                result.projected_mean, result.projected_sd,
+                                                climastartyear, climaendyear,
+                                                f_date, poi_start_date, poi_end_date)),
+    ]
+
+    paths = []
+    for prefix, fig in figures:
+        path = os.path.join(outdir, prefix + f_date + '.' + fmt)
+        fig.savefig(path, dpi=dpi, format=fmt)
+        paths.append(path)
+    return paths
+
+
+class RenderQueue(object):
+    '''
+    Renders TAMSAT alert plots in a pool of workers.
+
+    Results are submitted as they are calculated, and rendered in the
+    background, so that the caller can carry on with its calculations:
+
+        with RenderQueue(max_workers=4) as queue:
+            for cast_date in cast_dates:
+                result = tamsat_alert(..., compute_only=True)
+                queue.submit(result, outdir, cast_date, ...)
+    '''
+
+    def __init__(self, max_workers=None, use_processes=True, dpi=300, fmt='png'):
+        '''
+        :param max_workers:   The number of workers
+                              Optional, defaults to the number of processors
+        :param use_processes: If True, renders in a pool of processes, otherwise
+                              in a pool of threads
+                              Optional, defaults to True
+        :param dpi:           The resolution of raster output
+                              Optional, defaults to 300
+        :param fmt:           The output format, e.g. 'png', or 'pdf' or 'svg'
+                              for vector output
+                              Optional, defaults to 'png'
+        '''
+        if use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.dpi = dpi
+        self.fmt = fmt
+        self.futures = []
+
+    def submit(self, result, outdir, cast_date,
+               poi_start_day, poi_start_month,
+               poi_end_day, poi_end_month,
+               climastartyear, climaendyear):
+        '''
+        Queues the plots for a result to be rendered.  The arguments are as for
+        render_alert_plots.
+
+        :return: A concurrent.futures.Future, whose result is the list of
+                 paths of the files written
+        '''
+        future = self._executor.submit(render_alert_plots, result, outdir, cast_date,
+                                       poi_start_day, poi_start_month,
+                                       poi_end_day, poi_end_month,
+                                       climastartyear, climaendyear,
+                                       dpi=self.dpi, fmt=self.fmt)
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        '''
+        Waits for all of the queued plots to be rendered.  Any error raised
+        while rendering is raised here.
+
+        :return: A list of the paths of all the files written
+        '''
+        paths = []
+        for future in self.futures:
+            paths.extend(future.result())
+        self.futures = []
+        return paths
+
+    def close(self):
+        '''
+        Waits for all of the queued plots, and shuts down the workers
+        '''
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,248 @@
+"""
+An operational rainfall alert which is updated incrementally, as each new day
+of observations arrives.
+
+Between consecutive cast dates the ensemble members only differ in that one
+observed day moves from the ensemble members into the shared spinup.  So
+rather than rebuilding the ensemble, the session keeps the total of each
+ensemble member over the period of interest, and updates it with the
+difference between the new observation and each member's value for that day.
+"""
+
+import numpy as np
+import pandas as pd
+from tamsat_alert.tamsat_alert import (alert_result, default_run_period, ensemble_timeseries,
+                                       forecast_timeseries, init_ensemble_data,
+                                       sum_ensemble_members)
+from tamsat_alert.noleap import YearDoyMatrix
+
+
+class RainfallAlertSession(object):
+    '''
+    A rainfall alert for a single variable of interest, which is kept up to
+    date as new observations are appended:
+
+        session = RainfallAlertSession(fc_data, 'precipitation', data,
+                                       cast_date, 'rfe', ...)
+        result = session.result
+        ...
+        result = session.update(session.cast_date, todays_rainfall)
+
+    Each update takes O(members) time for the members which are complete.
+    Members which are cut short by the end of the data, such as the member for
+    the current year when the climatology runs to the end of the data, take
+    their continuation from the new observations, so they are recalculated at
+    each update, in O(run period) time.  The climatology is only recalculated
+    when an observation completes the period of interest of another year.  The
+    ensemble is only rebuilt when the run period changes (see
+    default_run_period), or when an observation starts a new year.
+
+    Only cumulative totals over the period of interest are supported, since
+    these are what the ensemble members are reduced to.
+    '''
+
+    def __init__(self,
+                 fc_data,
+                 met_ts_varname,
+                 data,
+                 cast_date,
+                 var_of_interest,
+                 poi_start_day, poi_start_month,
+                 poi_end_day, poi_end_month,
+                 fc_start_day, fc_start_month,
+                 fc_end_day, fc_end_month,
+                 precipitation_rate_str='pr',
+                 temperature_str='temp',
+                 tercile_weights=[1,1,1],
+                 clim_start_year=None, clim_end_year=None,
+                 poi_start_year=None, poi_end_year=None,
+                 stat_type='normal'):
+        '''
+        The parameters are as for tamsat_alert.  data should contain the
+        observations up to the day before cast_date, and var_of_interest
+        must be a single column.  The default years are those of data, and
+        do not change as observations are appended.
+        '''
+        if clim_start_year is None:
+            clim_start_year = data.index[0].year
+        if clim_end_year is None:
+            clim_end_year = data.index[-1].year
+        if poi_start_year is None:
+            poi_start_year = data.index[0].year
+        if poi_end_year is None:
+            poi_end_year = data.index[-1].year
+
+        self.poi = (poi_start_day, poi_start_month, poi_end_day, poi_end_month)
+        self.fc = (fc_start_day, fc_start_month, fc_end_day, fc_end_month)
+        self.tercile_weights = tercile_weights
+        self.clim_start_year = clim_start_year
+        self.clim_end_year = clim_end_year
+        self.poi_start_year = poi_start_year
+        self.poi_end_year = poi_end_year
+        self.stat_type = stat_type
+
+        if met_ts_varname == "precipitation":
+            tmp = fc_data[precipitation_rate_str]
+        if met_ts_varname == "temperature":
+            tmp = fc_data[temperature_str]
+        self._fc_data_no_leaps = YearDoyMatrix.from_pandas(tmp)
+
+        self._data = data[var_of_interest]
+        self._new_observations = []
+
+        self._rebuild(pd.Timestamp(cast_date))
+
+    def update(self, date, value):
+        '''
+        Appends the observation for a single day, which must be the current
+        cast date, and moves the cast date on to the following day.
+
+        :param date:  The date of the observation (pandas Timestamp)
+        :param value: The observed value
+        :return:      The AlertResult for the new cast date
+        '''
+        date = pd.Timestamp(date)
+        if date != self.cast_date:
+            raise ValueError('Observations must be appended in date order: expected %s, got %s'
+                             % (self.cast_date.date(), date.date()))
+        self._new_observations.append((date, value))
+        cast_date = date + pd.Timedelta(days=1)
+
+        # Leap days are only in the spinup, not in the history
+        leap_day = date.month == 2 and date.day == 29
+        position = None if leap_day else self._history.date_index(date)
+        if (default_run_period(cast_date, *self.poi) != self.run_period or
+                (position is not None and position >= self._history.flat.shape[0])):
+            self._rebuild(cast_date)
+            return self.result
+
+        if position is not None:
+            self._history.set_value(position, value)
+        self._spinup_observations.append((date, value))
+
+        # The observed day moves from the complete members into the spinup.
+        # Leap days are only in the spinup, so the members do not move on.
+        if self._member_positions is not None:
+            if leap_day:
+                in_poi = self._poi_started and self._poi_stop > 0
+            else:
+                in_poi = self._poi_start <= 0 < self._poi_stop
+                if in_poi:
+                    self._totals[self._incremental] -= np.nan_to_num(
+                        self._history.take_windows(self._member_positions, 1)[:, 0])
+                self._member_positions += 1
+                self._poi_start -= 1
+                self._poi_stop -= 1
+            if in_poi:
+                self._totals[self._incremental] += np.nan_to_num(float(value))
+                self._poi_started = True
+
+        self.cast_date = cast_date
+        if not np.all(self._incremental):
+            self._update_cut_short_members()
+        if position is not None and position >= self._climatology_complete:
+            self._update_climatology()
+        self.result = self._result()
+        return self.result
+
+    def update_many(self, observations):
+        '''
+        Appends consecutive days of observations, starting at the current cast date
+
+        :param observations: A pandas Series of the observed values, indexed by date
+        :return:             The AlertResult for the final cast date
+        '''
+        for date, value in observations.items():
+            self.update(date, value)
+        return self.result
+
+    @property
+    def data(self):
+        '''The observations, including any which have been appended'''
+        if self._new_observations:
+            dates, values = zip(*self._new_observations)
+            new = pd.Series(values, index=pd.DatetimeIndex(dates), name=self._data.name)
+            self._data = pd.concat([self._data, new])
+            self._new_observations = []
+        return self._data
+
+    def _rebuild(self, cast_date):
+        # Builds the ensemble for the cast date from scratch, as tamsat_alert does
+        data = self.data
+        self.cast_date = cast_date
+        self.run_period = default_run_period(cast_date, *self.poi)
+        self._history = YearDoyMatrix.from_pandas(data)
+
+        ensemble_members = init_ensemble_data(
+            data, self._history, cast_date, self.run_period[0], self.run_period[1],
+            self.clim_start_year, self.clim_end_year)
+        self._years = ensemble_members.years
+        self._totals = sum_ensemble_members(ensemble_members, *self.poi).values[:, 0].copy()
+        self._spinup = ensemble_members.spinup
+        self._spinup_observations = []
+
+        self._update_climatology()
+
+        # The members which are complete, and share the same position of the
+        # period of interest relative to the current cast date, are updated
+        # incrementally.  The others, e.g. members which have been cut short
+        # by the end of the data, are recalculated at each update instead.
+        complete = ((ensemble_members.offsets == 0) &
+                    (ensemble_members.starts + ensemble_members.lengths == ensemble_members.stops))
+        groups = {}
+        for group, lo, hi, member_lo, member_hi in ensemble_members._windows(*self.poi):
+            window = (lo, hi, member_lo, member_hi)
+            groups[window] = groups.get(window, False) | (group & complete)
+        self._incremental = np.zeros(len(self._years), dtype=bool)
+        self._member_positions = None
+        if groups:
+            window, group = max(groups.items(), key=lambda item: np.sum(item[1]))
+            if np.any(group):
+                lo, hi, member_lo, member_hi = window
+                self._poi_started = lo < len(ensemble_members.spinup_values)
+                self._poi_start = member_lo
+                self._poi_stop = member_hi
+                self._member_positions = ensemble_members.starts[group].copy()
+                self._incremental = group
+
+        self.result = self._result()
+
+    def _update_cut_short_members(self):
+        # Recalculates the members which are not updated incrementally from
+        # the history, which includes the new observations
+        spinup = self._spinup
+        if self._spinup_observations:
+            dates, values = zip(*self._spinup_observations)
+            spinup = pd.concat([spinup, pd.Series(values, index=pd.DatetimeIndex(dates),
+                                                  name=spinup.name)])
+        # As for the incremental members, the members for a cast date of 29th
+        # February start on 1st March, since there are no leap days in the history
+        cast_date = self.cast_date
+        if cast_date.month == 2 and cast_date.day == 29:
+            cast_date += pd.Timedelta(days=1)
+        years = self._years[~self._incremental]
+        ensemble_members = init_ensemble_data(
+            spinup, self._history, cast_date, self.run_period[0], self.run_period[1],
+            years[0], years[-1])
+        totals = sum_ensemble_members(ensemble_members, *self.poi).values[:, 0]
+        self._totals[~self._incremental] = totals[np.isin(ensemble_members.years, years)]
+
+    def _update_climatology(self):
+        # The climatology only includes the years whose period of interest is
+        # within the data (see window_timeseries), so it only changes when the
+        # data reach the end of the period of interest of the next year
+        self._climatological_sums = ensemble_timeseries(
+            self._history, *(self.poi + (self.poi_start_year, self.poi_end_year, np.sum)))
+        years = np.arange(self.poi_start_year, self.poi_end_year + 1)
+        _, stops = self._history.window_indices(years, *self.poi)
+        n_complete = len(self._climatological_sums)
+        self._climatology_complete = stops[n_complete] if n_complete < len(years) else np.inf
+
+    def _result(self):
+        forecast_sums = forecast_timeseries(
+            self._fc_data_no_leaps, *(self.fc + (self.poi_start_year, self.poi_end_year,
+                                                 self.cast_date, np.sum)))
+        ensemble_totals = pd.DataFrame(self._totals, self._years)
+        return alert_result(self._climatological_sums, ensemble_totals, forecast_sums,
+                            self.stat_type, self.tercile_weights,
+                            self.clim_start_year, self.clim_end_year)
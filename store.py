@@ -0,0 +1,359 @@
+"""
+A local copy of a multifile NetCDF dataset, rechunked for fast extraction.
+
+Archives such as TAMSAT are distributed as one file per day, which is the
+worst possible layout for reading the whole timeseries at a point, since
+every file has to be opened.  The store holds the same data in a Zarr store
+with long chunks in time and small tiles in space, so that a point
+timeseries only touches a handful of chunks.
+
+The store is kept in the cache directory, and is brought up to date
+incrementally from the manifest of the files (see manifest.Manifest): new
+days are appended, and days from files which have changed are rewritten.
+If files are removed, or fill a gap in the times, the store is rewritten.
+
+The store may be built from the command line:
+
+    python -m tamsat_alert.store '/data/rfe/*.nc' /data/cache
+"""
+
+import os
+import json
+import logging
+import shutil
+import argparse
+import pandas as pd
+import xarray as xr
+from tamsat_alert.cache import cache_key
+from tamsat_alert.manifest import load_manifest
+
+logger = logging.getLogger(__name__)
+
+# The default number of days in each chunk of the store
+TIME_CHUNK = 1024
+
+# The default number of cells along each spatial dimension in each chunk
+SPACE_CHUNK = 32
+
+# The file in the store listing the files it was built from
+SOURCES_FILE = 'tamsat_alert_sources.json'
+
+
+def store_path(path, cache_dir):
+    '''
+    The location of the store for a dataset
+
+    :param path:      A glob expression specifying the location of the data
+    :param cache_dir: The directory containing the cache
+    :return:          The path of the Zarr store
+    '''
+    return os.path.join(cache_dir, 'stores', cache_key(os.path.abspath(path)) + '.zarr')
+
+
+def _load_sources(store):
+    # The files the store was built from, the variables read from them, and
+    # the order of the variables in the store
+    with open(os.path.join(store, SOURCES_FILE)) as f:
+        return json.load(f)
+
+
+def _save_sources(store, sources):
+    temporary = os.path.join(store, SOURCES_FILE + '.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(sources, f)
+    os.replace(temporary, os.path.join(store, SOURCES_FILE))
+
+
+def _manifest_order(manifest, names):
+    # Orders the variables of a store as they are in the files.  Derived
+    # variables, e.g. rfe_sum, follow the variable they are derived from.
+    order = []
+    for entry in manifest.entries:
+        order.extend(name for name in entry['variables'] if name not in order)
+
+    def position(name):
+        for i, variable in enumerate(order):
+            if name == variable or name.startswith(variable + '_'):
+                return i
+        return len(order)
+    return sorted(names, key=position)
+
+
+def open_ordered(store):
+    '''
+    Opens a Zarr store created by sync_store.  Zarr lists the variables by
+    name, so they are put back in the order of the files, which is the order
+    extractions from the files return them in.
+
+    :param store: The path of the store
+    :return:      An xarray dataset
+    '''
+    dataset = xr.open_zarr(store)
+    order = _load_sources(store).get('order')
+    if order is None or set(order) != set(dataset.data_vars):
+        return dataset
+    # Coordinates which none of the variables use, e.g. the lon / lat of a
+    # summed-area cube, are kept too
+    return dataset[order].assign_coords(dataset.coords)
+
+
+def matches_files(dataset, manifest):
+    '''
+    Checks that a store holds the days of the files of a dataset, and only
+    those, so that extractions from it match extractions from the files
+
+    :param dataset:  An xarray dataset opened from a store
+    :param manifest: The manifest of the files (see manifest.Manifest)
+    :return:         True if the times of the store are those of the files
+    '''
+    times = pd.DatetimeIndex(dataset['time'].values)
+    entries = [entry for entry in manifest.entries if entry['time_start'] is not None]
+    return (sum(entry['n_times'] for entry in entries) == len(times) and
+            all(_file_positions(times, entry) is not None for entry in entries))
+
+
+def _read_files(file_list, variables):
+    # Reads a number of files into memory, concatenated in time
+    parts = []
+    for filename in file_list:
+        with xr.open_dataset(filename, decode_times=True, decode_cf=True, cache=False) as dataset:
+            if variables is not None:
+                dataset = dataset[variables]
+            parts.append(dataset.load())
+    return xr.concat(parts, dim='time')
+
+
+def update_store(path, cache_dir, variables=None,
+                 time_chunk=TIME_CHUNK, space_chunk=SPACE_CHUNK, batch_days=None):
+    '''
+    Creates the store for a dataset, or brings it up to date with the files.
+
+    Files whose times are after the end of the store are appended.  Files
+    which have changed since they were added are rewritten in place, as are
+    new files whose times are already in the store.  If files have been
+    removed, or new files fill a gap in the times, the store is rewritten.
+
+    :param path:        A glob expression specifying the location of the data
+    :param cache_dir:   The directory containing the cache
+    :param variables:   A list of the names of the variables to store.  This is
+                        only used when the store is created.
+                        Optional, defaults to all of the variables
+    :param time_chunk:  The number of days in each chunk.  This is only used
+                        when the store is created.
+                        Optional, defaults to TIME_CHUNK
+    :param space_chunk: The number of cells along each spatial dimension in each
+                        chunk.  This is only used when the store is created.
+                        Optional, defaults to SPACE_CHUNK
+    :param batch_days:  The number of days to read into memory at a time.  For
+                        large grids, reduce this to limit memory use, at the cost
+                        of rewriting partly filled chunks more often.
+                        Optional, defaults to time_chunk
+    :return:            The path of the store
+    '''
+    return sync_store(path, cache_dir, store_path(path, cache_dir), variables=variables,
+                      time_chunk=time_chunk, space_chunk=space_chunk, batch_days=batch_days)
+
+
+def sync_store(path, cache_dir, store, transform=None, variables=None,
+               time_chunk=TIME_CHUNK, space_chunk=SPACE_CHUNK, batch_days=None):
+    '''
+    Creates a Zarr store derived from the files of a dataset, or brings it up
+    to date with the files, as update_store does.
+
+    Days cannot be removed from or inserted into a Zarr store, so if files
+    have been removed, or a new file fills a gap in the times of the store,
+    the store is rewritten.  The days of the files which have not changed
+    are copied from the old store, and only the other files are read.
+
+    :param path:        A glob expression specifying the location of the data
+    :param cache_dir:   The directory containing the cache
+    :param store:       The path of the store
+    :param transform:   A function which converts an xarray dataset of a number of
+                        files to the dataset to store, keeping the time dimension
+                        Optional - if not specified, the data are stored unchanged
+    :param variables:   A list of the names of the variables to read from the files.
+                        This is only used when the store is created.
+                        Optional, defaults to all of the variables
+    :param time_chunk:  The number of days in each chunk
+    :param space_chunk: The number of cells along each other dimension in each chunk
+    :param batch_days:  The number of days to read into memory at a time
+                        Optional, defaults to time_chunk
+    :return:            The path of the store
+    '''
+    manifest = load_manifest(path, cache_dir)
+    if batch_days is None:
+        batch_days = time_chunk
+    entries = [entry for entry in manifest.entries if entry['time_start'] is not None]
+
+    def read(batch, variables):
+        dataset = _read_files([entry['path'] for entry in batch], variables)
+        return dataset if transform is None else transform(dataset)
+
+    if not os.path.exists(os.path.join(store, SOURCES_FILE)):
+        def encoding(dataset):
+            chunking = {}
+            for name, variable in dataset.data_vars.items():
+                chunks = tuple(time_chunk if dim == 'time' else min(space_chunk, size)
+                               for dim, size in zip(variable.dims, variable.shape))
+                chunking[name] = {'chunks': chunks}
+            return chunking
+        sources = {'variables': variables, 'files': {}}
+        _write_batches(store, entries, sources, read, batch_days, encoding)
+        return store
+
+    sources = _load_sources(store)
+    with xr.open_zarr(store) as existing:
+        times = pd.DatetimeIndex(existing['time'].values)
+        if 'order' not in sources:
+            # Stores created before the order was recorded
+            sources['order'] = _manifest_order(manifest, list(existing.data_vars))
+            _save_sources(store, sources)
+
+        paths = set(entry['path'] for entry in manifest.entries)
+        removed = [filename for filename in sources['files'] if filename not in paths]
+        appended = []
+        rewritten = []
+        inserted = []
+        for entry in entries:
+            if sources['files'].get(entry['path']) == [entry['mtime'], entry['size']]:
+                continue
+            if pd.Timestamp(entry['time_start']) > times[-1]:
+                appended.append(entry)
+            elif _file_positions(times, entry) is not None:
+                rewritten.append(entry)
+            else:
+                inserted.append(entry)
+
+        if removed or inserted:
+            _rebuild_store(store, existing, times, entries, sources, read, batch_days)
+            return store
+
+    for entry in rewritten:
+        dataset = read([entry], sources['variables'])
+        region = dataset.drop_vars([name for name in dataset.variables
+                                    if 'time' not in dataset[name].dims])
+        region.to_zarr(store, region={'time': _file_positions(times, entry)})
+        sources['files'][entry['path']] = [entry['mtime'], entry['size']]
+        _save_sources(store, sources)
+
+    _write_batches(store, appended, sources, read, batch_days)
+    return store
+
+
+def _file_positions(times, entry):
+    # The slice of the times of a store holding the times of a file, or None
+    # if they are not all in the store
+    start = times.get_indexer([pd.Timestamp(entry['time_start'])])[0]
+    stop = start + entry['n_times']
+    if start < 0 or stop > len(times) or times[stop - 1] != pd.Timestamp(entry['time_end']):
+        return None
+    return slice(start, stop)
+
+
+def _write_batches(store, entries, sources, read, batch_days, encoding=None):
+    # Appends the days of a number of files to a store, or creates it with
+    # the given encoding, in batches so that only batch_days days are in
+    # memory at a time
+    batch = []
+    n_days = 0
+    for i, entry in enumerate(entries):
+        batch.append(entry)
+        n_days += entry['n_times']
+        if n_days < batch_days and i < len(entries) - 1:
+            continue
+        dataset = read(batch, sources['variables'])
+        if not sources['files']:
+            dataset.to_zarr(store, mode='w', encoding=encoding(dataset))
+            sources.setdefault('order', list(dataset.data_vars))
+        else:
+            dataset.to_zarr(store, append_dim='time')
+        for e in batch:
+            sources['files'][e['path']] = [e['mtime'], e['size']]
+        _save_sources(store, sources)
+        batch = []
+        n_days = 0
+
+
+def _rebuild_store(store, existing, times, entries, sources, read, batch_days):
+    # Writes a new store holding the days of the files, copying the files
+    # which have not changed from the existing store, and replaces the
+    # existing store with it
+    def read_or_copy(batch, variables):
+        # Consecutive files which have changed are read together
+        parts = []
+        changed = []
+        for entry in batch:
+            positions = None
+            if sources['files'].get(entry['path']) == [entry['mtime'], entry['size']]:
+                positions = _file_positions(times, entry)
+            if positions is None:
+                changed.append(entry)
+                continue
+            if changed:
+                parts.append(read(changed, variables))
+                changed = []
+            parts.append(existing.isel(time=positions).load())
+        if changed:
+            parts.append(read(changed, variables))
+        return xr.concat(parts, dim='time')
+
+    def encoding(dataset):
+        return dict((name, {'chunks': existing[name].encoding['chunks']})
+                    for name in dataset.data_vars)
+
+    rebuilt = store + '.rebuild'
+    shutil.rmtree(rebuilt, ignore_errors=True)
+    rebuilt_sources = {'variables': sources['variables'], 'order': sources['order'], 'files': {}}
+    _write_batches(rebuilt, entries, rebuilt_sources, read_or_copy, batch_days, encoding)
+    existing.close()
+    shutil.rmtree(store)
+    if os.path.exists(rebuilt):
+        os.rename(rebuilt, store)
+
+
+def open_store(path, cache_dir, variables=None, update=True):
+    '''
+    Opens the store for a dataset, if it has been created
+
+    :param path:      A glob expression specifying the location of the data
+    :param cache_dir: The directory containing the cache
+    :param variables: A list of the names of the variables needed
+                      Optional, defaults to all of the variables
+    :param update:    If True, the store is brought up to date with the files first
+                      Optional, defaults to True
+    :return:          An xarray dataset, or None if there is no store, or it does
+                      not contain all of the variables needed
+    '''
+    store = store_path(path, cache_dir)
+    if not os.path.exists(os.path.join(store, SOURCES_FILE)):
+        return None
+    if update:
+        update_store(path, cache_dir)
+    dataset = open_ordered(store)
+    if update and not matches_files(dataset, load_manifest(path, cache_dir)):
+        logger.warning('The store %s does not match the files, so they are read instead', store)
+        dataset.close()
+        return None
+    if variables is not None:
+        if any(name not in dataset.data_vars for name in variables):
+            dataset.close()
+            return None
+        dataset = dataset[[name for name in dataset.data_vars if name in variables]]
+    return dataset
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds or updates the rechunked store '
+                                                 'for a multifile NetCDF dataset')
+    parser.add_argument('path', help='A glob expression specifying the location of the data')
+    parser.add_argument('cache_dir', help='The directory containing the cache')
+    parser.add_argument('--variables', nargs='+', help='The variables to store')
+    parser.add_argument('--time-chunk', type=int, default=TIME_CHUNK,
+                        help='The number of days in each chunk')
+    parser.add_argument('--space-chunk', type=int, default=SPACE_CHUNK,
+                        help='The number of cells along each spatial dimension in each chunk')
+    parser.add_argument('--batch-days', type=int,
+                        help='The number of days to read into memory at a time')
+    args = parser.parse_args()
+    update_store(args.path, args.cache_dir, args.variables,
+                 args.time_chunk, args.space_chunk, args.batch_days)
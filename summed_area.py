@@ -0,0 +1,189 @@
+"""
+A summed-area table (integral image) cube, for area means over any box.
+
+For each time step the cube holds the total of the data (and the number of
+cells with data) over every rectangle of the grid starting at its corner.
+The total over any box is then found from the four corners of the box, so
+an area mean timeseries only needs four reads per time step, however large
+the box is.  The cube may be block aggregated, keeping only every block'th
+row and column, which makes it smaller, but snaps boxes to the blocks.
+
+The cube is kept in a Zarr store in the cache directory, and brought up to
+date with the files in the same way as the rechunked store (see
+store.sync_store).
+"""
+
+import os
+import logging
+from functools import partial
+import numpy as np
+import pandas as pd
+import xarray as xr
+from tamsat_alert.cache import cache_key
+from tamsat_alert.manifest import find_lon_lat, load_manifest
+from tamsat_alert.store import (SOURCES_FILE, SPACE_CHUNK, TIME_CHUNK, matches_files,
+                                open_ordered, sync_store)
+
+logger = logging.getLogger(__name__)
+
+
+def cube_path(path, cache_dir):
+    '''
+    The location of the summed-area cube for a dataset
+
+    :param path:      A glob expression specifying the location of the data
+    :param cache_dir: The directory containing the cache
+    :return:          The path of the Zarr store
+    '''
+    return os.path.join(cache_dir, 'summed_area', cache_key(os.path.abspath(path)) + '.zarr')
+
+
+def _edges(size, block):
+    # The positions of the kept rows or columns of the table, which always
+    # include both edges of the grid
+    edges = np.arange(0, size + 1, block)
+    if edges[-1] != size:
+        edges = np.append(edges, size)
+    return edges
+
+
+def summed_area_tables(dataset, block=1):
+    '''
+    Calculates the summed-area tables of every variable on the lon / lat grid
+
+    :param dataset: An xarray dataset, with time, lon and lat dimensions
+    :param block:   Only every block'th row and column of the tables is kept
+                    Optional, defaults to 1
+    :return:        An xarray dataset, containing <variable>_sum, the total over
+                    the rectangle from the corner of the grid to each position,
+                    ignoring missing data, and <variable>_count, the number of
+                    cells with data in the rectangle, both with dimensions
+                    (time, row, col)
+    '''
+    lon_name, lat_name = find_lon_lat(dataset)
+    rows = _edges(dataset.sizes[lat_name], block)
+    cols = _edges(dataset.sizes[lon_name], block)
+
+    tables = xr.Dataset(coords={'time': dataset['time'], 'row': rows, 'col': cols,
+                                lat_name: dataset[lat_name], lon_name: dataset[lon_name]})
+    tables.attrs.update({'lon_name': lon_name, 'lat_name': lat_name, 'block': block,
+                         'variables': []})
+    for name, variable in dataset.data_vars.items():
+        if set(variable.dims) != set(['time', lat_name, lon_name]):
+            continue
+        tables.attrs['variables'].append(name)
+        values = variable.transpose('time', lat_name, lon_name).values.astype(float)
+        present = ~np.isnan(values)
+        for suffix, data, dtype in (('_sum', np.where(present, values, 0.0), float),
+                                    ('_count', present, np.int32)):
+            table = np.zeros((values.shape[0], values.shape[1] + 1, values.shape[2] + 1))
+            table[:, 1:, 1:] = np.cumsum(np.cumsum(data, axis=1), axis=2)
+            tables[name + suffix] = (('time', 'row', 'col'),
+                                     table[:, rows][:, :, cols].astype(dtype))
+        tables[name + '_sum'].attrs['source_dtype'] = str(variable.dtype)
+    return tables
+
+
+def update_summed_area_cube(path, cache_dir, block=1, variables=None,
+                            time_chunk=TIME_CHUNK, space_chunk=SPACE_CHUNK, batch_days=None):
+    '''
+    Creates the summed-area cube for a dataset, or brings it up to date with
+    the files.  The parameters other than block are as for store.update_store.
+
+    :param block: Only every block'th row and column of the tables is kept, so
+                  boxes are snapped to the nearest multiple of block cells.  This
+                  is only used when the cube is created.  An existing cube keeps
+                  the block it was created with.
+                  Optional, defaults to 1, which gives exact area means
+    :return:      The path of the cube
+    '''
+    cube = cube_path(path, cache_dir)
+    if os.path.exists(os.path.join(cube, SOURCES_FILE)):
+        with xr.open_zarr(cube) as existing:
+            block = existing.attrs['block']
+    return sync_store(path, cache_dir, cube, partial(summed_area_tables, block=block),
+                      variables, time_chunk, space_chunk, batch_days)
+
+
+def open_summed_area_cube(path, cache_dir, variables=None, update=True, block=None):
+    '''
+    Opens the summed-area cube for a dataset, if it has been created
+
+    :param path:      A glob expression specifying the location of the data
+    :param cache_dir: The directory containing the cache
+    :param variables: A list of the names of the variables needed
+                      Optional, defaults to all of the variables
+    :param update:    If True, the cube is brought up to date with the files first
+                      Optional, defaults to True
+    :param block:     The block aggregation needed.  A cube with a different
+                      block is neither updated nor opened.
+                      Optional, defaults to any block
+    :return:          An xarray dataset, or None if there is no cube, or it does
+                      not contain all of the variables needed, or has a different block
+    '''
+    cube = cube_path(path, cache_dir)
+    if not os.path.exists(os.path.join(cube, SOURCES_FILE)):
+        return None
+    if block is not None:
+        with xr.open_zarr(cube) as existing:
+            if existing.attrs['block'] != block:
+                return None
+    if update:
+        update_summed_area_cube(path, cache_dir)
+    dataset = open_ordered(cube)
+    if update and not matches_files(dataset, load_manifest(path, cache_dir)):
+        logger.warning('The cube %s does not match the files, so they are read instead', cube)
+        dataset.close()
+        return None
+    if variables is not None and any(name + '_sum' not in dataset for name in variables):
+        dataset.close()
+        return None
+    return dataset
+
+
+def _box_edges(coordinate, minimum, maximum, edges):
+    # The kept rows or columns nearest to the edges of the cells in the box
+    positions = np.flatnonzero((coordinate >= minimum) & (coordinate <= maximum))
+    if len(positions) == 0:
+        return 0, 0
+    lo = np.argmin(np.abs(edges - positions[0]))
+    hi = np.argmin(np.abs(edges - (positions[-1] + 1)))
+    if hi == lo:
+        hi = min(lo + 1, len(edges) - 1)
+    return lo, hi
+
+
+def box_means(cube, minlon, maxlon, minlat, maxlat, variables=None):
+    '''
+    Calculates the mean over a box for every time step of a summed-area cube,
+    from the four corners of the box
+
+    :param cube:      The summed-area cube, as returned by open_summed_area_cube
+    :param minlon:    The minimum longitude of the box
+    :param maxlon:    The maximum longitude of the box
+    :param minlat:    The minimum latitude of the box
+    :param maxlat:    The maximum latitude of the box
+    :param variables: A list of the names of the variables
+                      Optional, defaults to all of the variables
+    :return:          A pandas DataFrame of the means, indexed by time
+    '''
+    lon_name = cube.attrs['lon_name']
+    lat_name = cube.attrs['lat_name']
+    if variables is None:
+        variables = list(cube.attrs['variables'])
+
+    row_lo, row_hi = _box_edges(cube[lat_name].values, minlat, maxlat, cube['row'].values)
+    col_lo, col_hi = _box_edges(cube[lon_name].values, minlon, maxlon, cube['col'].values)
+    corners = {'row': [row_lo, row_hi], 'col': [col_lo, col_hi]}
+
+    means = {}
+    for name in variables:
+        box = []
+        for suffix in ('_sum', '_count'):
+            table = cube[name + suffix].isel(corners).values.astype(float)
+            box.append(table[:, 1, 1] - table[:, 0, 1] - table[:, 1, 0] + table[:, 0, 0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(box[1] > 0, box[0] / np.maximum(box[1], 1), np.nan)
+        means[name] = mean.astype(cube[name + '_sum'].attrs.get('source_dtype', 'float64'))
+    return pd.DataFrame(means, index=pd.DatetimeIndex(cube['time'].values, name='time'),
+                        columns=variables)
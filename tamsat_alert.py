@@ -1,7 +1,27 @@
+import os
+import calendar
 import numpy as np
 import pandas as pd
-from collections import OrderedDict
-from tamsat_alert.tamsat_alert_plots import risk_prob_plot
+from collections import OrderedDict, namedtuple
+from tamsat_alert.ensemble import EnsembleArray, find_window
+from tamsat_alert.metrics import get_metric
+from tamsat_alert.noleap import DAYS_PER_YEAR, YearDoyMatrix, noleap_doy, noleap_doys, reduce_windows
+from tamsat_alert.probability import calc_risk_probabilities, scenario_probabilities
+
+# The names of the quintile categories, from lowest to highest
+QUINTILE_CATEGORIES = ['very_low', 'low', 'average', 'high', 'very_high']
+
+# The results of a single TAMSAT alert run
+AlertResult = namedtuple('AlertResult', [
+    'climatological_sums',
+    'ensemble_totals',
+    'forecast_sums',
+    'projected_mean',
+    'projected_sd',
+    'quintile_probabilities',
+    'climatological_probabilities',
+    'projected_probabilities',
+])
 
 
 def tamsat_alert(fc_data,
@@ -22,7 +42,10 @@ def tamsat_alert(fc_data,
                  stat_type='normal',
                  cum_not_mean=True,
                  run_start=None, run_end=None,
-                 location_name=None):
+                 location_name=None,
+                 compute_only=False,
+                 pois=None,
+                 metric=None):
     '''
     Generates the data and plots for the cumulative rainfall part of TAMSAT Alert.
 
@@ -34,7 +57,10 @@ def tamsat_alert(fc_data,
                             the TAMSAT alert code
     :param cast_date:       The date at which to start fore/hind-cast.
                             This should be a pandas Timestamp object
-    :param var_of_interest: The variable of interest.  Must be a column in data
+    :param var_of_interest: The variable of interest.  Must be a column in data.
+                            This may also be a list of columns, in which case they
+                            share the ensemble construction and the plots for each
+                            are written to a subdirectory of output_dir named by the column
     :param output_dir:      The path at which to output data and plots
     :param poi_start_day:   The day of the month of the start of the period of interest
     :param poi_start_month: The month of the year of the start of the period of interest
@@ -76,6 +102,37 @@ def tamsat_alert(fc_data,
                             of the year after the cast_date
     :param location_name:   The name of the location to appear on the plots
                             Optional - if not specified, tries to calculate from the data
+    :param compute_only:    If True, no plots or output files are produced, and
+                            matplotlib is not used.  output_dir may be None.
+                            Optional, defaults to False
+    :param pois:            A list of periods of interest, each a tuple
+                            (start_day, start_month, end_day, end_month).  If given,
+                            these are used instead of poi_start_day, poi_start_month,
+                            poi_end_day and poi_end_month, and the ensemble members
+                            are shared by all of the periods of interest.  The plots
+                            for each are written to a subdirectory of output_dir
+                            named by poi_label.
+                            Optional
+    :param metric:          The metric of the variable over the period of interest,
+                            used for both the ensemble members and the climatology.
+                            This is the name of one of the metrics in
+                            tamsat_alert.metrics.METRICS (e.g. 'rain_days',
+                            'longest_dry_spell', 'max_5day_total' or 'onset_day'),
+                            or a function.  If specified, cum_not_mean only applies
+                            to the meteorological forecast.
+                            Optional - if not specified, the ensemble members are
+                            summed, and the climatology depends on cum_not_mean
+
+    :return:                An AlertResult containing the climatological sums,
+                            ensemble totals and forecast sums (as pandas DataFrames),
+                            the weighted mean and standard deviation of the ensemble,
+                            the probability of each quintile category (as a
+                            pandas Series), and the climatological and projected
+                            probabilities at each threshold (as numpy arrays).
+                            If var_of_interest is a list, an OrderedDict mapping each
+                            variable to its AlertResult.
+                            If pois is given, an OrderedDict mapping each period of
+                            interest to its result.
     '''
 
     # Set defaults for any missing optional args
@@ -89,40 +146,14 @@ def tamsat_alert(fc_data,
     if poi_end_year is None:
         poi_end_year = data.index[-1].year
 
-    arbitrary_year = 2000
-
-    #ECB added this section of code to detect whether the desired period crosses a year and adjust the run_start and run_end accordingingly.
-    #This is necessary later on for init_ensemble_members
-    start_date = pd.Timestamp(
-        arbitrary_year, poi_start_month, poi_start_day)
-    end_date = pd.Timestamp(
-        arbitrary_year, poi_end_month, poi_end_day)
-    poi_crosses_year = start_date > end_date
-
-
-    if run_start is None:
-        #If we cross a year boundary and we are in the first year
-        if poi_crosses_year and cast_date.month > poi_end_month:
-            run_start = pd.Timestamp(cast_date.year, 1, 1)
-
-
-        #If we cross a year boundary and we are in the second year
-        elif poi_crosses_year and cast_date.month < poi_end_month:
-            run_start = pd.Timestamp(cast_date.year-1, 1, 1)
-
-        #If we do not cross a year boundary
-        else:
-            run_start=pd.Timestamp(cast_date.year,1,1)
-
-    if run_end is None:
-        if poi_crosses_year and cast_date.month > poi_end_month:
-            run_end = pd.Timestamp(cast_date.year+1, 12, 31)
-        elif poi_crosses_year and cast_date.month < poi_end_month:
-            run_end = pd.Timestamp(cast_date.year, 12, 31)
-        else:
-            run_end=pd.Timestamp(cast_date.year+1,12,31)
-
+    single_poi = pois is None
+    if single_poi:
+        pois = [(poi_start_day, poi_start_month, poi_end_day, poi_end_month)]
+    pois = [tuple(poi) for poi in pois]
 
+    # The run period depends on the period of interest
+    run_periods = [default_run_period(cast_date, *poi, run_start=run_start, run_end=run_end)
+                   for poi in pois]
 
     if(location_name is None):
         try:
@@ -131,40 +162,32 @@ def tamsat_alert(fc_data,
             location_name = ''
 
     # Sanity check
-    if(cast_date < run_start or cast_date > run_end):
-        raise ValueError('cast_date must fall between run_start and run_end')
+    for poi_run_start, poi_run_end in run_periods:
+        if(cast_date < poi_run_start or cast_date > poi_run_end):
+            raise ValueError('cast_date must fall between run_start and run_end')
 
     # Select only the data we want to deal with
+    # If there are several variables of interest, the data is a DataFrame and all
+    # of the ensemble and window operations below work on (days, variables) arrays
+    single_variable = isinstance(var_of_interest, str)
+    if not single_variable:
+        var_of_interest = list(var_of_interest)
     data = data[var_of_interest]
     #ECB Select the the meteorological time series (precipitation or temperature) for the meteorological forecast time series
     if met_ts_varname == "precipitation":
         tmp = fc_data[precipitation_rate_str]
     if met_ts_varname == "temperature":
         tmp = fc_data[temperature_str]
-    fc_data_no_leaps = strip_leap_days(tmp)
+    fc_data_no_leaps = YearDoyMatrix.from_pandas(tmp)
 
     # Remove leap years from data
     # This is so that when we construct ensemble members from historical runs,
     # they will all be guaranteed to have the same length.
     #
-    # If there are already no leap years in the data, this will return an identical
-    # pandas dataframe
-    data_no_leaps = strip_leap_days(data)
-
-
-    # Initialise the ensemble members.  This returns an OrderedDict mapping
-    # ensemble member years (as ints) to the data
-    ensemble_members = init_ensemble_data(
-        data, data_no_leaps, cast_date, run_start,
-        run_end, clim_start_year, clim_end_year)
-
-    # Sum the ensemble members.  This returns a DataFrame with ensemble
-    # years as the index, and the variables of interest as the columns.
-    # Values are the sums of the ensemble members over the FIRST occurrence
-    # of the period of interest date range
-    ensemble_totals = sum_ensemble_members(
-        ensemble_members, poi_start_day, poi_start_month,
-        poi_end_day, poi_end_month)
+    # The data is converted once into a (years, 365) matrix on a no-leap
+    # calendar, so that all of the ensemble and window operations below
+    # are integer slicing.
+    data_no_leaps = YearDoyMatrix.from_pandas(data)
 
     # Pick which operation to perform on the ensemble members
     if cum_not_mean:
@@ -172,17 +195,15 @@ def tamsat_alert(fc_data,
     else:
         operation = np.mean
 
-    # Calculate the timeseries for the two desired periods
-    climatological_sums = ensemble_timeseries(data_no_leaps,
-                                        poi_start_day,
-                                        poi_start_month,
-                                        poi_end_day,
-                                        poi_end_month,
-                                        poi_start_year,
-                                        poi_end_year,
-                                        operation)
+    # Pick the metric over the period of interest.  Without one, the ensemble
+    # members are summed and the climatology uses the operation above.
+    if metric is None:
+        poi_operation, member_operation = operation, np.sum
+    else:
+        poi_operation = member_operation = get_metric(metric)
 
     #ECB adjusted to read in fc_data with no leap years
+    # This does not depend on the period of interest
     forecast_sums = forecast_timeseries(fc_data_no_leaps,
                                         fc_start_day,
                                         fc_start_month,
@@ -193,32 +214,330 @@ def tamsat_alert(fc_data,
                                         cast_date,
                                         operation)
 
+    # The ensemble members are only constructed once for each run period,
+    # and shared by all of the periods of interest which use it
+    ensembles = {}
+    results = OrderedDict()
+    for poi, run_period in zip(pois, run_periods):
+        start_day, start_month, end_day, end_month = poi
+
+        # Initialise the ensemble members.  This returns an EnsembleArray mapping
+        # ensemble member years (as ints) to the data
+        if run_period not in ensembles:
+            ensembles[run_period] = init_ensemble_data(
+                data, data_no_leaps, cast_date, run_period[0],
+                run_period[1], clim_start_year, clim_end_year)
+        ensemble_members = ensembles[run_period]
+
+        # Sum the ensemble members.  This returns a DataFrame with ensemble
+        # years as the index, and the variables of interest as the columns.
+        # Values are the sums of the ensemble members over the FIRST occurrence
+        # of the period of interest date range
+        ensemble_totals = sum_ensemble_members(
+            ensemble_members, start_day, start_month,
+            end_day, end_month, member_operation)
+
+        # Calculate the timeseries for the period of interest
+        climatological_sums = ensemble_timeseries(data_no_leaps,
+                                                  start_day,
+                                                  start_month,
+                                                  end_day,
+                                                  end_month,
+                                                  poi_start_year,
+                                                  poi_end_year,
+                                                  poi_operation)
+
+        # The probabilities are calculated separately for each variable
+        if single_variable:
+            variables = [(None, climatological_sums, ensemble_totals)]
+        else:
+            variables = [(variable, climatological_sums[[variable]], ensemble_totals[[variable]])
+                         for variable in var_of_interest]
+
+        poi_results = OrderedDict()
+        for variable, variable_sums, variable_totals in variables:
+            result = alert_result(variable_sums, variable_totals, forecast_sums,
+                                  stat_type, tercile_weights,
+                                  clim_start_year, clim_end_year)
+            poi_results[variable] = result
+
+            if not compute_only:
+                # matplotlib is only imported when plots are wanted
+                from tamsat_alert.tamsat_alert_plots import risk_prob_plot
+
+                # The plots for each period of interest and variable are written
+                # to their own directory, since the file names only include the cast date
+                plot_dir = output_dir if single_poi else os.path.join(output_dir, poi_label(poi))
+                if not single_variable:
+                    plot_dir = os.path.join(plot_dir, str(variable))
+
+                # This has been only very slightly modified from its original state
+                # It now takes the DataFrames rather than filenames, and and output dir,
+                # but is otherwise the same as in the old version.
+                risk_prob_plot(clim_start_year, clim_end_year,
+                               data.index[0].year, data.index[-1].year,
+                               cast_date.year, cast_date.month, cast_date.day,
+                               start_month, start_day, end_month, end_day,
+                               stat_type, location_name, tercile_weights,
+                               variable_sums, variable_totals, forecast_sums,
+                               plot_dir, result=result)
+
+        results[poi] = poi_results[None] if single_variable else poi_results
+
+    if single_poi:
+        return results[pois[0]]
+    return results
+
+
+def poi_label(poi):
+    '''
+    Makes a label for a period of interest, for use in file and directory names
+
+    :param poi: A tuple (start_day, start_month, end_day, end_month)
+    :return:    A string such as '01-Mar_to_31-May'
+    '''
+    start_day, start_month, end_day, end_month = poi
+    return '%02d-%s_to_%02d-%s' % (start_day, calendar.month_abbr[start_month],
+                                   end_day, calendar.month_abbr[end_month])
+
+def alert_result(climatological_sums, ensemble_totals, forecast_sums,
+                 stat_type, tercile_weights, clim_start_year, clim_end_year):
+    '''
+    Calculates the weighted ensemble statistics and quintile probabilities,
+    without producing any plots or output files.
+
+    :param climatological_sums: A pandas DataFrame of the climatological values of the metric
+    :param ensemble_totals:     A pandas DataFrame of the ensemble values of the metric
+    :param forecast_sums:       A pandas DataFrame of the values of the metric used for weighting
+    :param stat_type:           The probability distribution to use ('normal' or 'ecdf')
+    :param tercile_weights:     The tercile weights [low, med, hi]
+    :param clim_start_year:     The start year of the climatology
+    :param clim_end_year:       The end year of the climatology
+    :return:                    An AlertResult
+    '''
+    probabilityclim, probabilitymetric, val, projmean, projsd = calc_risk_probabilities(
+        climatological_sums.values.T[0], ensemble_totals.values.T[0],
+        forecast_sums.values.T[0], stat_type, tercile_weights,
+        clim_start_year, clim_end_year)
+
+    return AlertResult(climatological_sums=climatological_sums,
+                       ensemble_totals=ensemble_totals,
+                       forecast_sums=forecast_sums,
+                       projected_mean=float(np.ravel(projmean)[0]),
+                       projected_sd=float(projsd),
+                       quintile_probabilities=pd.Series(val, QUINTILE_CATEGORIES),
+                       climatological_probabilities=probabilityclim,
+                       projected_probabilities=probabilitymetric)
+
+
+def alert_scenarios(result, scenario_weights, stat_type, clim_start_year, clim_end_year):
+    '''
+    Calculates the quintile probabilities of a TAMSAT alert run for each of a
+    number of tercile weight scenarios, without rerunning the ensemble.
+
+    :param result:           An AlertResult, as returned by tamsat_alert
+    :param scenario_weights: The tercile weights [low, med, hi] of each scenario,
+                             as a sequence or an array of shape (scenarios, 3).  If
+                             this is a pandas DataFrame its index labels the scenarios.
+    :param stat_type:        The probability distribution to use ('normal' or 'ecdf')
+    :param clim_start_year:  The start year of the climatology
+    :param clim_end_year:    The end year of the climatology
+    :return:                 A pandas DataFrame with a row for each scenario, and columns
+                             ensemble_mean, ensemble_sd and the quintile categories
+    '''
+    index = scenario_weights.index if isinstance(scenario_weights, pd.DataFrame) else None
+    val, projmean, projsd = scenario_probabilities(
+        result.climatological_sums.values.T[0], result.ensemble_totals.values.T[0],
+        result.forecast_sums.values.T[0], stat_type, np.asarray(scenario_weights),
+        clim_start_year, clim_end_year)
+
+    scenarios = pd.DataFrame(val, index=index, columns=QUINTILE_CATEGORIES)
+    scenarios.insert(0, 'ensemble_mean', projmean)
+    scenarios.insert(1, 'ensemble_sd', projsd)
+    return scenarios
+
+def tamsat_alert_hindcast(fc_data,
+                          met_ts_varname,
+                          data,
+                          cast_dates,
+                          var_of_interest,
+                          poi_start_day, poi_start_month,
+                          poi_end_day, poi_end_month,
+                          fc_start_day, fc_start_month,
+                          fc_end_day, fc_end_month,
+                          precipitation_rate_str='pr',
+                          temperature_str='temp',
+                          tercile_weights=[1,1,1],
+                          clim_start_year=None, clim_end_year=None,
+                          poi_start_year=None, poi_end_year=None,
+                          stat_type='normal',
+                          cum_not_mean=True,
+                          metric=None):
+    '''
+    Runs the cumulative rainfall part of TAMSAT Alert for many cast dates.
+
+    The leap day stripping and the climatological sums are calculated once,
+    and only the ensemble members and forecast sums, which depend on the
+    observed data up to each cast date, are calculated for each cast date.
+    No plots or output files are produced.
+
+    :param cast_dates:      An iterable of dates at which to start the hind-casts.
+                            These should be pandas Timestamp objects (e.g. a
+                            pandas DatetimeIndex from pandas.date_range)
+
+    All other parameters are as for tamsat_alert, except that var_of_interest
+    must be a single column.  The run_start and run_end are always the defaults
+    for each cast date.
+
+    :return:                A pandas DataFrame indexed by cast date, with the
+                            weighted mean and standard deviation of the ensemble,
+                            the climatological mean, and the probability of each
+                            quintile category
+    '''
+    if clim_start_year is None:
+        clim_start_year = data.index[0].year
+    if clim_end_year is None:
+        clim_end_year = data.index[-1].year
+
+    if poi_start_year is None:
+        poi_start_year = data.index[0].year
+    if poi_end_year is None:
+        poi_end_year = data.index[-1].year
+
+    data = data[var_of_interest]
+    if met_ts_varname == "precipitation":
+        tmp = fc_data[precipitation_rate_str]
+    if met_ts_varname == "temperature":
+        tmp = fc_data[temperature_str]
+
+    # These are the same for every cast date
+    fc_data_no_leaps = YearDoyMatrix.from_pandas(tmp)
+    data_no_leaps = YearDoyMatrix.from_pandas(data)
+
+    if cum_not_mean:
+        operation = np.sum
+    else:
+        operation = np.mean
 
-    # This has been only very slightly modified from its original state
-    # It now takes the DataFrames rather than filenames, and and output dir,
-    # but is otherwise the same as in the old version.
+    if metric is None:
+        poi_operation, member_operation = operation, np.sum
+    else:
+        poi_operation = member_operation = get_metric(metric)
 
+    climatological_sums = ensemble_timeseries(data_no_leaps,
+                                              poi_start_day,
+                                              poi_start_month,
+                                              poi_end_day,
+                                              poi_end_month,
+                                              poi_start_year,
+                                              poi_end_year,
+                                              poi_operation)
+    climametric = climatological_sums.values.T[0]
+
+    cast_dates = [pd.Timestamp(cast_date) for cast_date in cast_dates]
+    rows = []
+    for cast_date in cast_dates:
+        run_start, run_end = default_run_period(cast_date,
+                                                poi_start_day, poi_start_month,
+                                                poi_end_day, poi_end_month)
+
+        ensemble_members = init_ensemble_data(
+            data, data_no_leaps, cast_date, run_start,
+            run_end, clim_start_year, clim_end_year)
+        ensemble_totals = sum_ensemble_members(
+            ensemble_members, poi_start_day, poi_start_month,
+            poi_end_day, poi_end_month, member_operation)
+        forecast_sums = forecast_timeseries(fc_data_no_leaps,
+                                            fc_start_day,
+                                            fc_start_month,
+                                            fc_end_day,
+                                            fc_end_month,
+                                            poi_start_year,
+                                            poi_end_year,
+                                            cast_date,
+                                            operation)
+
+        result = alert_result(climatological_sums, ensemble_totals, forecast_sums,
+                              stat_type, tercile_weights,
+                              clim_start_year, clim_end_year)
+        rows.append([result.projected_mean, result.projected_sd, np.mean(climametric)]
+                    + list(result.quintile_probabilities))
+
+    return pd.DataFrame(rows,
+                        index=pd.DatetimeIndex(cast_dates, name='cast_date'),
+                        columns=['ensemble_mean', 'ensemble_sd', 'clim_mean']
+                        + QUINTILE_CATEGORIES)
+
+
+def default_run_period(cast_date,
+                       poi_start_day, poi_start_month,
+                       poi_end_day, poi_end_month,
+                       run_start=None, run_end=None):
+    '''
+    Calculates the default start and end dates for the runs, for a given
+    cast date and period of interest.
 
-    risk_prob_plot(clim_start_year, clim_end_year,
-                   data.index[0].year, data.index[-1].year,
-                   cast_date.year, cast_date.month, cast_date.day,
-                   poi_start_month, poi_start_day,poi_end_month,poi_end_day,
-                   stat_type, location_name, tercile_weights,
-                   climatological_sums, ensemble_totals, forecast_sums,
-                   output_dir)
+    :param cast_date:       The (fore/hind)cast date
+    :param poi_start_day:   The day of the month of the start of the period of interest
+    :param poi_start_month: The month of the year of the start of the period of interest
+    :param poi_end_day:     The day of the month of the end of the period of interest
+    :param poi_end_month:   The month of the year of the end of the period of interest
+    :param run_start:       The start date for the runs.
+                            Optional - if specified, this is returned unchanged
+    :param run_end:         The end date for the runs.
+                            Optional - if specified, this is returned unchanged
+    :return:                A tuple of pandas Timestamps (run_start, run_end)
+    '''
+    arbitrary_year = 2000
+
+    #ECB added this section of code to detect whether the desired period crosses a year and adjust the run_start and run_end accordingingly.
+    #This is necessary later on for init_ensemble_members
+    start_date = pd.Timestamp(
+        arbitrary_year, poi_start_month, poi_start_day)
+    end_date = pd.Timestamp(
+        arbitrary_year, poi_end_month, poi_end_day)
+    poi_crosses_year = start_date > end_date
+
+
+    if run_start is None:
+        #If we cross a year boundary and we are in the first year
+        if poi_crosses_year and cast_date.month > poi_end_month:
+            run_start = pd.Timestamp(cast_date.year, 1, 1)
+
+
+        #If we cross a year boundary and we are in the second year
+        elif poi_crosses_year and cast_date.month < poi_end_month:
+            run_start = pd.Timestamp(cast_date.year-1, 1, 1)
+
+        #If we do not cross a year boundary
+        else:
+            run_start=pd.Timestamp(cast_date.year,1,1)
+
+    if run_end is None:
+        if poi_crosses_year and cast_date.month > poi_end_month:
+            run_end = pd.Timestamp(cast_date.year+1, 12, 31)
+        elif poi_crosses_year and cast_date.month < poi_end_month:
+            run_end = pd.Timestamp(cast_date.year, 12, 31)
+        else:
+            run_end=pd.Timestamp(cast_date.year+1,12,31)
+
+    return run_start, run_end
 
 
 def strip_leap_days(data):
     '''
     Removes leap days from a dataset
 
-    :param data: A pandas DataFrame containing the data to remove leap years from
+    :param data: A pandas DataFrame containing the data to remove leap years from.
+                 This may also be a YearDoyMatrix, which is returned unchanged
+                 since it never contains leap days.
     :return: A copy of the same pandas DataFrame, with all values occurring
              on the 29th February removed
     '''
-    stripped_data = data.drop(
-        [date for date in data.index
-            if (date.month == 2 and date.day == 29)])
+    if isinstance(data, YearDoyMatrix):
+        return data
+
+    stripped_data = data[~((data.index.month == 2) & (data.index.day == 29))]
 
     return stripped_data
 
@@ -237,7 +556,8 @@ def init_ensemble_data(data, no_leap_data, cast_date, run_start, run_end, ensemb
     from the (fore/hind)cast date
 
     :param data:                The timeseries data
-    :param no_leap_data:        The timeseries data, with leap days removed
+    :param no_leap_data:        The timeseries data, with leap days removed.
+                                This may be a pandas DataFrame or a YearDoyMatrix
     :param cast_date:           The (fore/hind)cast date
     :param run_start:           The date to start ensemble runs
     :param run_end:             The date to end ensemble runs
@@ -248,20 +568,19 @@ def init_ensemble_data(data, no_leap_data, cast_date, run_start, run_end, ensemb
     :param retain_leaps:        If True, keeps leap days in the spinup data
                                 Optional, defaults to True
 
-    :return:                    An OrderedDict whose keys are the ensemble years
+    :return:                    An EnsembleArray whose keys are the ensemble years
                                 and whose values are pandas DataFrames containing
-                                the ensemble data
+                                the ensemble data.  The spinup data is stored once,
+                                and the member data as a single numpy array.
     '''
 
+    no_leap_data = YearDoyMatrix.from_pandas(no_leap_data)
 
+    spinupdata = data if retain_leaps else no_leap_data.to_pandas()
 
-    spinupdata = data if retain_leaps else no_leap_data
-
-    spinup = spinupdata.loc[np.logical_and(
-        spinupdata.index >= run_start, spinupdata.index < cast_date)]
-
-    # Return an ordered dictionary of ensemble members (i.e. years) to pandas dataframes
-    ret = OrderedDict()
+    # The data is in time order, so the spinup can be found by bisection
+    spinup = spinupdata.iloc[spinupdata.index.searchsorted(run_start):
+                             spinupdata.index.searchsorted(cast_date)]
 
     # Calculate number of days to run after cast date
     n_days = (run_end - cast_date).days
@@ -269,38 +588,43 @@ def init_ensemble_data(data, no_leap_data, cast_date, run_start, run_end, ensemb
     # MY: Have to check if cast_date crosses year
     crosses_year = cast_date.year > run_start.year
 
-    for year in np.arange(ensemble_start_year, ensemble_end_year + 1):
-        # For every ensemble year, take subset of no leap data FROM:
-        # The cast date in ensemble year
-        # TO
-        # The run_end date in ensemble year
-        # MY: Need to check if cast date crosses year to obtain correct data
-        #  when cast date after year boundary
-        # If cast date before year boundary, the data is already representative
-        # of year to year + 1
-        # However, if cast date after the year boundary, need to shift start
-        # date from ensemble_year to ensemble_year + 1 to get correct data.
-        if crosses_year == False:
-          start_date = pd.Timestamp(year, cast_date.month, cast_date.day)
-        elif crosses_year == True:
-          start_date = pd.Timestamp(year+1,cast_date.month,cast_date.day)
-        # start_date = pd.Timestamp(year, cast_date.month, cast_date.day)
-        end_date = start_date + pd.Timedelta(days=n_days)
-        ensemble_range = np.logical_and(
-            no_leap_data.index >= start_date,
-            no_leap_data.index <  end_date
-        )
-        ret[year] = pd.concat([spinup, no_leap_data.loc[ensemble_range]])
-    return ret
-
-
-def sum_ensemble_members(members, start_day, start_month, end_day, end_month):
+    years = np.arange(ensemble_start_year, ensemble_end_year + 1)
+
+    # For every ensemble year, take subset of no leap data FROM:
+    # The cast date in ensemble year
+    # TO
+    # The run_end date in ensemble year
+    # MY: Need to check if cast date crosses year to obtain correct data
+    #  when cast date after year boundary
+    # If cast date before year boundary, the data is already representative
+    # of year to year + 1
+    # However, if cast date after the year boundary, need to shift start
+    # date from ensemble_year to ensemble_year + 1 to get correct data.
+    if crosses_year == False:
+        start_years = years
+    elif crosses_year == True:
+        start_years = years + 1
+    start_dates = pd.DatetimeIndex([pd.Timestamp(year, cast_date.month, cast_date.day)
+                                    for year in start_years])
+    end_dates = start_dates + pd.Timedelta(days=n_days)
+
+    starts = (start_years - no_leap_data.first_year) * DAYS_PER_YEAR + \
+        noleap_doy(cast_date.month, cast_date.day)
+    stops = (np.asarray(end_dates.year) - no_leap_data.first_year) * DAYS_PER_YEAR + \
+        noleap_doys(end_dates)
+
+    return EnsembleArray(spinup, no_leap_data, years, starts, stops)
+
+
+def sum_ensemble_members(members, start_day, start_month, end_day, end_month, operation=np.sum):
     '''
     Calculates the sum of the values in each ensemble member ranging
     from the first occurrence of (start_day, start_month) to the next
-    occurrence of (end_day, end_month), inclusive.
+    occurrence of (end_day, end_month), inclusive.  Another operation, such
+    as one of the metrics in the metrics module, may be performed instead.
 
-    :param members:     An OrderedDict containing ensemble years mapped to
+    :param members:     An EnsembleArray, as returned by init_ensemble_data,
+                        or an OrderedDict containing ensemble years mapped to
                         pandas DataFrames with ensemble data
     :start_day:         The day of the month at which to start the sum over
     :start_month:       The month of the year at which to start the sum over
@@ -308,34 +632,34 @@ def sum_ensemble_members(members, start_day, start_month, end_day, end_month):
                         end the sum
     :end_month:         The month of the year at whose first occurrence to
                         end the sum
+    :operation:         The operation to perform.  Should be a function (e.g. np.sum)
+                        Optional, defaults to np.sum
 
     :return:            A DataFrame whose index is the keys of members, and
                         whose values are the calculated sums
     '''
 
+    if isinstance(members, EnsembleArray):
+        # The shared spinup is summed once, and the members in a single reduction
+        return pd.DataFrame(
+            members.window_total(start_day, start_month, end_day, end_month, operation),
+            members.years, columns=members.columns)
+
     values = []
     for member in members:
         data = members[member]
 
         # Calculate the indices within this dataframe to sum over
-        start_index = 0
-        end_index = 0
-        # We want the first date matching the start day & month
-        for i, date in enumerate(data.index):
-            if(date.month == start_month and date.day == start_day):
-                start_index = i
-                break
-        # We want the next date matching the end day & month,
-        # hence we slice the data from the start_index
-        for i, date in enumerate(data.index[start_index:]):
-            if(date.month == end_month and date.day == end_day):
-                # We need to add the start_index to i,
-                # since enumerate() will start the index from 0
-                end_index = i + start_index
-                break
-
-        # Now slice the data between the desired indices, and sum
-        values.append(data[start_index : end_index].sum())
+        start_index, end_index = find_window(np.asarray(data.index.month),
+                                             np.asarray(data.index.day),
+                                             start_day, start_month,
+                                             end_day, end_month)
+
+        # Now sum the data between the desired indices, ignoring missing data
+        # (as pandas does)
+        member_values = np.asarray(data.values, dtype=float)
+        values.append(reduce_windows(member_values[np.newaxis, start_index:end_index],
+                                     operation, getattr(data, 'columns', None))[0])
     return pd.DataFrame(values, members)
 
 
@@ -348,7 +672,7 @@ def ensemble_timeseries(data_no_leaps, start_day, start_month, end_day, end_mont
     If the start-end dates cross the year boundary, the year is defined as the
     year at the start date.
 
-    :param data_no_leaps:   A pandas DataFrame containing the data, with leap days removed
+    :param data_no_leaps:   A pandas DataFrame or YearDoyMatrix containing the data, with leap days removed
     :param start_day:       The day of the month to start operating on
     :param start_month:     The month of the year to start operating on
     :param end_day:         The day of the month to stop operating on (exclusive)
@@ -382,34 +706,10 @@ def ensemble_timeseries(data_no_leaps, start_day, start_month, end_day, end_mont
     #    years = np.arange(start_year, end_year + 1)
 
     years = np.arange(start_year,end_year+1)
-    values = []
-    for year in years:
-        start = pd.Timestamp(year, start_month, start_day)
-
-        # We need to increment the year if the dates cross the year boundary
-        before_end_year = year
-        if crosses_year:
-            before_end_year = year + 1
-        end = pd.Timestamp(
-            before_end_year, end_month, end_day)
-
-        if(end > data_no_leaps.index[-1]):
-            # In this case, the end point falls outside the data range
-            # This would lead to truncated data, so we do not perform the
-            # operation.  This will also be true for all following years,
-            # hence we use break, rather than continue
-            break
-
-        # Subset the data to extract the desired period for the current year
-        subset = data_no_leaps.loc[np.logical_and(
-            data_no_leaps.index >= start,
-            data_no_leaps.index < end,
-        )]
-
-        # Perform the operation (usually np.sum() or np.mean() on the subset)
-        values.append(operation(subset))
-
-    return pd.DataFrame(values, years)
+
+    return window_timeseries(data_no_leaps, years,
+                             start_day, start_month, end_day, end_month,
+                             crosses_year, operation)
 
 def forecast_timeseries(data_no_leaps, start_day, start_month, end_day, end_month, start_year, end_year, cast_date, operation):
     '''
@@ -420,13 +720,14 @@ def forecast_timeseries(data_no_leaps, start_day, start_month, end_day, end_mont
     If the start-end dates cross the year boundary, the year is defined as the
     year at the start date.
 
-    :param data_no_leaps:   A pandas DataFrame containing the data, with leap days removed
+    :param data_no_leaps:   A pandas DataFrame or YearDoyMatrix containing the data, with leap days removed
     :param start_day:       The day of the month to start operating on
     :param start_month:     The month of the year to start operating on
     :param end_day:         The day of the month to stop operating on (exclusive)
     :param end_month:       The month of the year to stop operating on (exclusive)
     :param start_year:      The first year to perform the operation on
     :param end_year:        The last year to perform the operation on.
+    :param cast_date:       The (fore/hind)cast date
     :param operation:       The operation to perform.  Should be a function (e.g. np.sum)
 
     :return:                A pandas DataFrame containing years as the index, and
@@ -469,31 +770,56 @@ def forecast_timeseries(data_no_leaps, start_day, start_month, end_day, end_mont
         if cast_date >= end_date:
             years = years+1
 
-    values = []
-    for year in years:
-        start = pd.Timestamp(year, start_month, start_day)
-
-        # We need to increment the year if the dates cross the year boundary
-        before_end_year = year
-        if crosses_year:
-            before_end_year = year + 1
-        end = pd.Timestamp(
-            before_end_year, end_month, end_day)
-
-        if(end > data_no_leaps.index[-1]):
-            # In this case, the end point falls outside the data range
-            # This would lead to truncated data, so we do not perform the
-            # operation.  This will also be true for all following years,
-            # hence we use break, rather than continue
-            break
-
-        # Subset the data to extract the desired period for the current year
-        subset = data_no_leaps.loc[np.logical_and(
-            data_no_leaps.index >= start,
-            data_no_leaps.index < end,
-        )]
-
-        # Perform the operation (usually np.sum() or np.mean() on the subset)
-        values.append(operation(subset))
-
-    return pd.DataFrame(values, years)
+    return window_timeseries(data_no_leaps, years,
+                             start_day, start_month, end_day, end_month,
+                             crosses_year, operation)
+
+
+def window_timeseries(data_no_leaps, years, start_day, start_month, end_day, end_month, crosses_year, operation):
+    '''
+    For each year, performs the operation on data ranging from the start date
+    (start_day/start_month) of that year, to the end date (end_day/end_month)
+    of that year, or of the following year if crosses_year is True.
+
+    The data is converted to a YearDoyMatrix (if it is not one already), so that
+    the window for each year is found by integer arithmetic on the day of year.
+
+    :param data_no_leaps:   A pandas DataFrame or YearDoyMatrix containing the data, with leap days removed
+    :param years:           The years to perform the operation on
+    :param start_day:       The day of the month to start operating on
+    :param start_month:     The month of the year to start operating on
+    :param end_day:         The day of the month to stop operating on (exclusive)
+    :param end_month:       The month of the year to stop operating on (exclusive)
+    :param crosses_year:    Whether the end date is in the year after the start date
+    :param operation:       The operation to perform.  Should be a function (e.g. np.sum)
+
+    :return:                A pandas DataFrame containing years as the index, and
+                            the results of the operation as the values
+    '''
+    matrix = YearDoyMatrix.from_pandas(data_no_leaps)
+
+    years = np.asarray(years)
+    starts = (years - matrix.first_year) * DAYS_PER_YEAR + noleap_doy(start_month, start_day)
+    ends = (years + int(crosses_year) - matrix.first_year) * DAYS_PER_YEAR + noleap_doy(end_month, end_day)
+
+    # Where the end point falls outside the data range, this would lead to
+    # truncated data, so we do not perform the operation.  This will also be
+    # true for all following years.
+    beyond_data = np.flatnonzero(ends > matrix.last_index)
+    if len(beyond_data) > 0:
+        years = years[:beyond_data[0]]
+        starts = starts[:beyond_data[0]]
+        ends = ends[:beyond_data[0]]
+
+    if operation in (np.sum, np.nansum):
+        # Sums and means are answered from the cached prefix sums of the data
+        values = matrix.window_sum(starts, ends)
+    elif operation in (np.mean, np.nanmean):
+        values = matrix.window_mean(starts, ends)
+    else:
+        # Every window has the same length, so they can be extracted together
+        length = 0 if len(years) == 0 else ends[0] - starts[0]
+        windows = matrix.take_windows(starts, length)
+        values = reduce_windows(windows, operation, matrix.columns)
+
+    return pd.DataFrame(values, years, columns=matrix.columns)
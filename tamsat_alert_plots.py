@@ -11,20 +11,20 @@ code is untouched.
 
 import os
 import warnings
-import matplotlib.pyplot as plt
-import scipy.stats as sps
-from statsmodels.distributions.empirical_distribution import ECDF
-import seaborn as sns
-import matplotlib.mlab as mlab
 import numpy as np
 import datetime as dt
 import calendar
+from tamsat_alert.render import draw_distribution_figure, draw_quintile_figure
+# The probability calculations have been moved into their own module,
+# so that they can be used without matplotlib.  They are imported here so that
+# existing code which imports them from this module still works.
+from tamsat_alert.probability import calc_risk_probabilities, weight_forecast
 def risk_prob_plot(climastartyear, climaendyear,
                    datastartyear, dataendyear,
                    forecastyear, forecastmonth,forecastday,
                    poi_start_month,poi_start_day,poi_end_month,poi_end_day,
                    stat, sta_name, weights,
-                   climatology, forecast_vals, weightings, outdir = './'):
+                   climatology, forecast_vals, weightings, outdir = './', result=None):
     """
     This function plot the probability estimates for a given risk metric for a single date
     forecast given in the configuration file.
@@ -50,6 +50,8 @@ def risk_prob_plot(climastartyear, climaendyear,
     :param climatology: pandas DataFrame containg a climatology (i.e. historical time series) of the metric under investigation.
     :param forecast_vals: pandas DataFrame containg ensembles forecast values of the metric under investigation (i.e. each value is the ensemble member associated with the weather future for the year in column 1).
     :param weightings: pandas DataFrame containg the values of the metric being used for weighting.
+    :param result: An AlertResult for these values, as returned by tamsat_alert.alert_result.
+                   Optional - if not specified, the probabilities are calculated here.
     """
 
     #------------------------------------------------------------------#
@@ -85,75 +87,23 @@ def risk_prob_plot(climastartyear, climaendyear,
     forecametric = forecast_vals.values.T[0]
     Wmetric = weightings.values.T[0]
 
-    #----------------------------------------------------------------#
-    # calculating probability distribution
-    #----------------------------------------------------------------#
-    # threshold probability
-    thresholds = np.arange(0.01, 1.01, 0.01)
-
-    # calculate the mean and sd of the climatology
-    climamean = np.mean(climametric)
-    climasd = np.std(climametric)
-
-    # calcualte the mean and sd of the the projected
-    # metric based on climatology weather data
-    # we need the weighted metric frorecast
-
-    fdate = f_date
-    yr = forecastyear
-    # print(forecastfile,weightfile)
-
-    # GG Changed the arguments here - they were previously links to the files
-    # which got read in exactly the same way as above (again)
-    projmean, projsd = weight_forecast(
-        forecametric, Wmetric, weights, climastartyear, climaendyear)
-    projsd = np.maximum(projsd, 0.001)  # avoid division by zero
-
-    if stat == 'normal':
-        # calculate the normal distribution
-        probabilitymetric = []
-        probabilityclim = []
-        for z in range(0, len(thresholds)):
-            thres = sps.norm.ppf(thresholds[z], climamean, climasd)
-            # print(thres)
-            # (climamean,climasd)
-            # print(projmean,projsd)
-            #probmetric = sps.norm.cdf(thres,climamean,climasd)
-            # print(probmetric)
-            probclim = sps.norm.cdf(thres, climamean, climasd)
-            probmetric = sps.norm.cdf(thres, projmean, projsd)
-            # print(probmetric)
-            probabilitymetric = np.append(probabilitymetric, probmetric)
-            probabilityclim = np.append(probabilityclim, probclim)
-
-            del probmetric
-
-        out = np.vstack((probabilityclim, probabilitymetric))
-        # GG - Added output dir
-        np.savetxt(outdir+'/prob_normal.txt', out.T, fmt='%0.2f')
-
-    elif stat == 'ecdf':
-        # calculate the emperical distribution
-        ecdf_clima = ECDF(climametric)
-        probabilitymetric = []
-        probabilityclim = []
-
-        for z in range(0, len(ecdf_clima.x)):
-            thres = ecdf_clima.x[z]  # (thresholds[z])
-            ecdf_proj = ECDF(forecametric)
-            probclim = ecdf_clima(thres)
-            probmetric = ecdf_proj(thres)
-            probabilitymetric = np.append(probabilitymetric, probmetric)
-            probabilityclim = np.append(probabilityclim, probclim)
-
-            del probmetric
-
-        out = np.vstack((probabilityclim, probabilitymetric))
-
-        # GG - Added output dir
-        np.savetxt(outdir+'/prob_ecdf.txt', out.T, fmt='%0.2f')
+    # The probability calculations have been moved into
+    # calc_risk_probabilities, so that they can be run without plotting
+    if result is None:
+        (probabilityclim, probabilitymetric, val,
+         projmean, projsd) = calc_risk_probabilities(
+            climametric, forecametric, Wmetric, stat, weights,
+            climastartyear, climaendyear)
     else:
-        raise ValueError('Please use only "normal" or "ecdf" stat method')
+        # The probabilities have already been calculated
+        probabilityclim = result.climatological_probabilities
+        probabilitymetric = result.projected_probabilities
+        val = list(result.quintile_probabilities)
+        projmean, projsd = result.projected_mean, result.projected_sd
+
+    out = np.vstack((probabilityclim, probabilitymetric))
+    # GG - Added output dir
+    np.savetxt(outdir+'/prob_'+stat+'.txt', out.T, fmt='%0.2f')
 
     #-------------------------------------------------------------------#
     # Plots of results
@@ -230,51 +180,10 @@ def risk_prob_plot(climastartyear, climaendyear,
 
     #-------------------------------------------------------------------------#
     # Risk probability plot (Pentile bar plot format DA)
+    # The figures are drawn with the object oriented matplotlib API
+    # (see tamsat_alert.render), so that no global pyplot state is used
     pp = []
-    sns.set_style("ticks")
-    fig = plt.figure(figsize=(5,5))
-    if stat == 'normal':
-        verylow = probabilitymetric[19]
-        low = probabilitymetric[39] - verylow
-        average = probabilitymetric[59] - (verylow + low)
-        high = probabilitymetric[79] - (verylow + low + average)
-        veryhigh = 1 - (verylow + low + average + high)
-    elif stat == 'ecdf':
-        # identifying the index for the critical points
-        nn = int(round(len(climayears) / 5., 0))  # this should be an intiger
-        wba_i = nn
-        ba_i = (nn * 2)
-        a_i = (nn * 3)
-        av_i = (nn * 4)
-
-        verylow = probabilitymetric[wba_i]
-        low = probabilitymetric[ba_i] - probabilitymetric[wba_i]  # verylow
-        average = probabilitymetric[a_i] - \
-            probabilitymetric[ba_i]  # (verylow+low)
-        high = probabilitymetric[av_i] - \
-            probabilitymetric[a_i]  # (verylow+low+average)
-        veryhigh = 1 - probabilitymetric[av_i]  # (verylow+low+average+high)
-    else:
-        raise ValueError('Please use only "normal" or "ecdf" stat method')
-
-    val = [verylow, low, average, high, veryhigh]   # the bar lengths
-    pos = np.arange(5) + .5        # the bar centers on the y axis
-
-    for ptl in np.arange(0,5):
-      plt.barh(pos[ptl], val[ptl] * 100, align='center',
-               color='grey',edgecolor='black',linewidth=3)
-      plt.annotate(str(round(val[ptl] * 100, 1)) + '%', ((val[ptl] * 100) + 1,
-                   pos[ptl]), xytext=(0, 1), textcoords='offset points', fontsize=20)
-
-    plt.yticks(pos, ('Very low\n(0-20%)', 'Low\n(20-40%)', 'Average\n(40-60%)',
-                     'High\n(60-80%)', 'Very high\n(80-100%)'), fontsize=14)
-    plt.xticks(fontsize=14)
-    plt.xlabel('Probability (%)', fontsize=14)
-    plt.ylabel('Quintile category',fontsize=14)
-    plt.title('Forecast date: ' + f_date + '\nPeriod of interest: '+poi_start_date+' to '+poi_end_date, loc='left', fontsize=14)
-    plt.xlim(0, 101)
-    #plt.legend()
-    plt.tight_layout()
+    fig = draw_quintile_figure(val, f_date, poi_start_date, poi_end_date)
     if stat == 'normal':
         # GG - Added outdir
         #ECB - got rid of directory structure
@@ -292,8 +201,7 @@ def risk_prob_plot(climastartyear, climaendyear,
     pp = np.append(pp, round(val[3] * 100, 1))
     pp = np.append(pp, round(val[4] * 100, 1))
 
-    plt.savefig(path +str('/') +'pentile_' + f_date + '.png', dpi=300)
-    plt.close()
+    fig.savefig(path +str('/') +'pentile_' + f_date + '.png', dpi=300)
 
     # save the probabilities of each category on a text file
     headval = '1 = Very low(0-20%)  2 = Low(20-40%)   3 = Average(40-60%)  4 = High(60-80%)  5 = Very high(80-100%)\n\
@@ -347,58 +255,10 @@ Category    RiskProbability'
     # plt.savefig(path + sta_name + '_' + f_date + '_ked_plot.png', dpi=300)
     # plt.close()
 
-    fig2 = plt.figure(figsize=(6,6))
-
-    alldata = np.append(climametric, forecametric)
-    #binBoundaries = np.linspace(min(forecametric), max(forecametric),10)
-
-    binBoundaries = np.linspace(min(alldata), max(alldata), 10)
-
-    thres = np.zeros(len(binBoundaries))
-    probclim = np.zeros(len(binBoundaries))
-    modfreqclim = np.zeros(len(binBoundaries))
-    probclim[0] = sps.norm.cdf(binBoundaries[0], climamean, climasd)
-    for z in range(1, len(binBoundaries)):
-        thres[z] = binBoundaries[z]
-
-        probclim[z] = sps.norm.cdf(thres[z], climamean, climasd)
-        modfreqclim[z] = (probclim[z] - probclim[z - 1])
-
-        #probmetric = sps.norm.cdf(thres,projmean,projsd)
-        #probabilitymetric = np.append(probabilitymetric,probmetric)
-        #probabilityclim = np.append(probabilityclim,probclim)
-
-    #plt.hist(forecametric, bins=binBoundaries, color = 'b',lw=3)
-    n, bins, patches = plt.hist((climametric, forecametric), bins=binBoundaries, lw=3, color=[
-                                 "blue", "green"], label=["Climatology", "Ensemble"], normed=True,alpha=0.9)
-    plt.clf() # clears bars but keeps plt.hist output
-    # plt.plot(binBoundaries,modfreqclim)
-    # https://plot.ly/matplotlib/histograms/
-    y = mlab.normpdf(bins, climamean, climasd)
-    plt.plot(bins, y, color="black",linewidth=3,label="Climatological distribution")
-    plt.fill_between(bins,y,np.zeros(len(y)),color="grey",alpha=0.8)
-    #forecamean = np.mean(forecametric)
-    #forecasigma = np.std(forecametric)
-    # y2 = mlab.normpdf(bins, np.mean(forecametric), np.std(forecametric))
-    # plt.plot(bins, y2, color="black",ls='-',linewidth=3,marker="s",markersize=10,label="Current distribution (without meteorological forecast)")
-
-    y3 = mlab.normpdf(bins, projmean, projsd)
-    plt.plot(bins, y3, color="black",ls="-",linewidth=3,marker="o",markersize=10,
-             label="Predicted distribution",alpha=0.9)
-
-    plt.xlabel('Metric value', fontsize=14)
-    plt.ylabel('Probability density', fontsize=14)
-    plt.title('Comparison of prediction against \n' + str(climastartyear) + '-' + str(climaendyear) +
-              ' climatology'+'\nForecast date: ' + f_date+'\nPeriod of interest: '+poi_start_date+' to '+poi_end_date, loc='left', fontsize=14)
-    plt.xticks(fontsize=14)
-    plt.yticks(fontsize=14)
-    plt.xlim(min(alldata), max(alldata))
-    plt.gca().set_ylim(bottom=0)
-    plt.legend(loc=8,fontsize=12,framealpha=0.5)
-    plt.tight_layout()
-
-    plt.savefig(path + str("/")+ 'hist_plot'+ '_' + f_date + '.png', dpi=300)
-    plt.close()
+    fig2 = draw_distribution_figure(climametric, forecametric, projmean, projsd,
+                                    climastartyear, climaendyear,
+                                    f_date, poi_start_date, poi_end_date)
+    fig2.savefig(path + str("/")+ 'hist_plot'+ '_' + f_date + '.png', dpi=300)
 
     return pp
 
@@ -430,66 +290,3 @@ def highlight_point(ax, line, point, c, linestyle=':'):
     ax.plot([point[0], point[0]], [ymin, point[1]],
             color=c, linestyle=linestyle)
     return None
-
-#-------------------------------------------------------------------------------#
-
-
-# GG - Modified to take the data, rather than rereading the files
-def weight_forecast(forecametric, Wmetric, weights, climastartyear, climaendyear):
-    # Need to implement weights for ecdf. https://stackoverflow.com/questions/21844024/weighted-percentile-using-numpy
-
-    fy_wmean = []
-
-    # GG - Code calling np.genfromtxt again was removed, since it is unnecessary.
-
-    # the metric for ordering the true metric(forecametric)
-    # is total precipitation of JJA.
-
-    # ECB: Note that if we have fewer years for the weighting metric, which can happen if we go over the year boundary, zip will cut out the end of the ensembles time series. This should be sorted out now. The onus is on the user to specify the correct years.
-    # ECB: Note that when we cross the year boundary in either ensemble period of interest or weighting metric period of interest, we reference the FIRST year in the period. So if we are using a DJF weighting metric period of interest, for a MAM ensemble period of interest, we will be weighting a using a metric AFTER the period of interest.  This needs to be resolved. The user needs to specify whether our forecast period starts in the same year, the year before or the year after.
-    climayears = np.arange(climastartyear, climaendyear + 1)
-
-    #----------------------------------------------------------------#
-    # warning that certain number of years have been removed from the
-    # climatology to make the length divisioble by len(weight)
-    #-----------------------------------------------------------------#
-    ny_del = len(climayears) % len(weights)
-    # print(len(climayears))
-    if ny_del != 0:
-        climayears = climayears[:(len(climayears) - ny_del)]
-        # warnings.warn("The last%s ,"year of climatology years has been removed!" % ny_del)
-        # print "Only", %s, "ensembles are used!" % len(climayears)
-    else:
-        climayears = climayears
-
-    forecametric = forecametric[0:len(climayears)]
-    Wmetric = Wmetric[0:len(climayears)]
-
-    # put the metric with true metric (forecametric)
-    out = zip(Wmetric, forecametric)
-
-    out = sorted(out)  # sort in  ascending order based on the metric
-    out = np.array(out)  # convert it to array
-    # print(out)
-    # weighting forecast metric with the weighting metric
-    n_reps = np.shape(out)[0] / len(weights)
-    allweights = []
-
-    for j in range(0, len(weights)):
-        allweights = np.append(allweights, np.repeat(weights[j], n_reps))
-    allweights = (allweights / sum(allweights))
-
-    # weighted average of forecasted metric after being sorted by the metric
-
-    # print(allweights)
-    # print(zip(out[:,1],allweights))
-    a = np.average(out[:, 1], weights=allweights)
-
-    fy_wmean = np.append(fy_wmean, a)  # projected weighted mean
-
-    # projected weighted standard deviation
-    variance = np.average((forecametric - fy_wmean)**2, weights=allweights)
-    fy_wsd = np.sqrt(variance)
-
-    del allweights
-    return fy_wmean, fy_wsd
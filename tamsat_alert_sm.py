@@ -1,8 +1,10 @@
+import os
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import tamsat_alert.utils_sm as utils_sm
-from tamsat_alert.tamsat_alert import ensemble_timeseries, strip_leap_days
-from tamsat_alert.tamsat_alert_plots import risk_prob_plot
+from tamsat_alert.tamsat_alert import QUINTILE_CATEGORIES, alert_result, ensemble_timeseries, poi_label, strip_leap_days
 
 def tamsat_alert_sm(data,
                     fc_data,
@@ -49,7 +51,9 @@ def tamsat_alert_sm(data,
                         'dr': 0.0,
                         'h': 0.0,
                     },
-                    data_period=86400):
+                    data_period=86400,
+                    compute_only=False,
+                    pois=None):
     '''
     Generates the data and plots for the soil moisture aspect of TAMSAT ALERT.
 
@@ -79,10 +83,12 @@ def tamsat_alert_sm(data,
                             Optional - if not specified, uses the first year in the data
     :param clim_end_year:   The end year of the climatology
                             Optional - if not specified, uses the last year in the data
-    :param poi_start_year:  The first year of interest
-                            Optional - if not specified, uses the first year in the data
-    :param poi_end_year:    The last year of interest
-                            Optional - if not specified, uses the last year in the data
+    :param poi_start_year:  The year of the start of the period of interest
+                            Optional - if not specified, the first period of interest
+                            which ends on or after the cast date is used (see next_poi)
+    :param poi_end_year:    The year of the end of the period of interest
+                            Optional - if not specified, the first period of interest
+                            which ends on or after the cast date is used (see next_poi)
     :param norm_not_ecdf:   The probability distribution to use for percentile calculations
                             True is normal, False is ECDF
                             Optional, defaults to True
@@ -153,6 +159,24 @@ def tamsat_alert_sm(data,
                                 'h' - plant height (m)
                                        (default 0.0)
     :param data_period: An integer specifying the number of seconds for each time step in the input data (default 86400)
+    :param compute_only: If True, no plots or output files are produced, matplotlib is not
+                            used, and an AlertResult is returned.  output_dir may be None.
+                            Optional, defaults to False
+    :param pois:            A list of periods of interest, each a tuple
+                            (start_day, start_month, end_day, end_month).  If given,
+                            these are used instead of poi_start_day, poi_start_month,
+                            poi_end_day and poi_end_month, and the model is only run
+                            once for all of them.  For each, the first period of
+                            interest which ends on or after the cast date is used
+                            (see next_poi), rather than poi_start_year and poi_end_year.
+                            The plots for each are written to a subdirectory of
+                            output_dir named by poi_label.
+                            Optional
+
+    :return:                A tuple of pandas DataFrames (ensemble values, climatological values),
+                            or an AlertResult if compute_only is True.
+                            If pois is given, an OrderedDict mapping each period of
+                            interest to its result.
     '''
 
     # GG Hacks to generate required but redundant variables
@@ -160,30 +184,328 @@ def tamsat_alert_sm(data,
         stat='normal'
     else:
         stat='ecdf'
-    datastartyear = data.index[0].year
-    dataendyear = data.index[-1].year
-    operation = np.sum
     # GG End
 
     #ECB changed tmp so that the met forecast data can come from a different source to the SM driving data.
     #ECB added in variable met_ts_varname, which indicates whether we are using the temperature or precipitation from the fc_data pandas dataframe as our meteorological forecast variable.
+    forecast_sums = sm_forecast_timeseries(fc_data, met_ts_varname,
+                                           fc_start_day, fc_start_month,
+                                           fc_end_day, fc_end_month,
+                                           clim_start_year, clim_end_year,
+                                           fc_temp_str=fc_temp_str,
+                                           fc_precip_str=fc_precip_str)
+
+    # Everything which does not depend on the cast date (interpolation of the
+    # driving data, soil parameters, spinup and the historical run)
+    run = prepare_sm_run(data, soil_texture_str,
+                         spinup=spinup,
+                         initial_conditions=initial_conditions,
+                         data_period=data_period,
+                         precipitation_rate_str=precipitation_rate_str,
+                         temperature_str=temperature_str,
+                         pressure_str=pressure_str,
+                         wind_u_comp_str=wind_u_comp_str,
+                         wind_v_comp_str=wind_v_comp_str,
+                         humidity_str=humidity_str,
+                         temperature_range_str=temperature_range_str)
+
+    climayears = np.arange(clim_start_year, clim_end_year+1)
+
+    single_poi = pois is None
+    if single_poi:
+        pois = [(poi_start_day, poi_start_month, poi_end_day, poi_end_month)]
+    pois = [tuple(poi) for poi in pois]
+
+    #Calculate ensemble mean soil moisture over the periods of interest
+    #The model is run once, for all of the periods of interest
+    if single_poi and poi_start_year is not None and poi_end_year is not None:
+        poi_dates = [(pd.Timestamp(poi_start_year, poi_start_month, poi_start_day),
+                      pd.Timestamp(poi_end_year, poi_end_month, poi_end_day))]
+    else:
+        # The years of each period of interest are found separately, since
+        # some may cross the year boundary and others not
+        poi_dates = [next_poi(cast_date, *poi) for poi in pois]
+    all_values = run_sm_ensemble_pois(run, cast_date, lead_time_days, climayears,
+                                      poi_dates)
+
+    years = list(run['years'][0:len(climayears)])
+
+    results = OrderedDict()
+    for poi, values in zip(pois, all_values):
+        start_day, start_month, end_day, end_month = poi
+        climvalues = sm_climatology(run, climayears,
+                                    start_day, start_month,
+                                    end_day, end_month)
+
+        ensemble_totals=pd.DataFrame(values,years)
+        climatological_sums=pd.DataFrame(climvalues,years)
+
+        #forecast_sums=ensemble_totals #placeholder
+
+        result = alert_result(climatological_sums, ensemble_totals, forecast_sums,
+                              stat, tercile_weights, clim_start_year, clim_end_year)
+        if compute_only:
+            results[poi] = result
+            continue
+
+        # matplotlib is only imported when plots are wanted
+        from tamsat_alert.tamsat_alert_plots import risk_prob_plot
+
+        # The plots for each period of interest are written to their own directory
+        poi_dir = output_dir if single_poi else os.path.join(output_dir, poi_label(poi))
+
+        risk_prob_plot(clim_start_year, clim_end_year,
+                       data.index[0].year, data.index[-1].year,
+                       cast_date.year, cast_date.month, cast_date.day,
+                       start_month, start_day, end_month, end_day,
+                       stat, location_name, tercile_weights,
+                       climatological_sums, ensemble_totals, forecast_sums,
+                       poi_dir, result=result)
+
+        results[poi] = (pd.DataFrame(values,years),pd.DataFrame(climvalues,years))
+
+    if single_poi:
+        return results[pois[0]]
+    return results
+
+def tamsat_alert_sm_hindcast(data,
+                             fc_data,
+                             met_ts_varname,
+                             cast_dates,
+                             soil_texture_str,
+                             poi_start_day, poi_start_month,
+                             poi_end_day, poi_end_month,
+                             fc_start_day, fc_start_month,
+                             fc_end_day, fc_end_month,
+                             lead_time_days,
+                             tercile_weights=[1,1,1],
+                             clim_start_year=None, clim_end_year=None,
+                             norm_not_ecdf=True,
+                             n_jobs=1,
+                             shortwave_radiation_str='sw',
+                             longwave_radiation_str='lw',
+                             precipitation_rate_str='pr',
+                             snow_str='snow',
+                             temperature_str='temp',
+                             pressure_str='P',
+                             wind_u_comp_str='uwind',
+                             wind_v_comp_str='vwind',
+                             humidity_str='q',
+                             temperature_range_str='Trange',
+                             fc_temp_str='temp',
+                             fc_precip_str='rfe',
+                             spinup={
+                                 'num_spin_year': 2,
+                                 'spin_cyc': 5,
+                                 'data_period': 86400,
+                                 'model_t_step': 3600
+                             },
+                             initial_conditions={
+                                 'su_init': [0.749, 0.743, 0.754, 0.759],
+                                 'fa_init': 0.0,
+                                 'LAI': 0.0,
+                                 'er': 1.0,
+                                 'I_v': 0.5,
+                                 'dz': [0.1, 0.25, 0.65, 2.0],
+                                 'dr': 0.0,
+                                 'h': 0.0,
+                             },
+                             data_period=86400):
+    '''
+    Runs the soil moisture aspect of TAMSAT ALERT for many cast dates.
+
+    The driving data interpolation, soil parameters, spinup, historical run and
+    climatology are calculated once, and only the ensemble forecast is run for
+    each cast date.  No plots or output files are produced.
+
+    For each cast date, the period of interest is the first one which ends on or
+    after the cast date.
+
+    :param data:            A pandas DataFrame containing the data to use for running the TAMSAT alert code
+    :param fc_data:         A pandas DataFrame containing the data to use for providing meteorological forecast time series to inform the allocation of ensemble member weights
+    :param met_ts_varname:  A string indicating whether the meteorological forecast is for temperature or for precipitation. Acceptable values are:
+                            'precipitation','temperature'
+    :param cast_dates:      An iterable of dates at which to start the hind-casts.
+                            These should be pandas Timestamp objects (e.g. a
+                            pandas DatetimeIndex from pandas.date_range)
+    :param n_jobs:          The number of processes to use to run the ensembles
+                            for different cast dates in parallel.
+                            Optional, defaults to 1 (i.e. run in serial)
+
+    All other parameters are as for tamsat_alert_sm
+
+    :return:                A pandas DataFrame indexed by cast date, with the
+                            start and end of the period of interest, the weighted
+                            mean and standard deviation of the ensemble, the
+                            climatological mean, and the probability of each
+                            quintile category
+    '''
+    if clim_start_year is None:
+        clim_start_year = data.index[0].year
+    if clim_end_year is None:
+        clim_end_year = data.index[-1].year
+
+    if(norm_not_ecdf):
+        stat='normal'
+    else:
+        stat='ecdf'
+
+    forecast_sums = sm_forecast_timeseries(fc_data, met_ts_varname,
+                                           fc_start_day, fc_start_month,
+                                           fc_end_day, fc_end_month,
+                                           clim_start_year, clim_end_year,
+                                           fc_temp_str=fc_temp_str,
+                                           fc_precip_str=fc_precip_str)
+
+    run = prepare_sm_run(data, soil_texture_str,
+                         spinup=spinup,
+                         initial_conditions=initial_conditions,
+                         data_period=data_period,
+                         precipitation_rate_str=precipitation_rate_str,
+                         temperature_str=temperature_str,
+                         pressure_str=pressure_str,
+                         wind_u_comp_str=wind_u_comp_str,
+                         wind_v_comp_str=wind_v_comp_str,
+                         humidity_str=humidity_str,
+                         temperature_range_str=temperature_range_str)
+
+    climayears = np.arange(clim_start_year, clim_end_year+1)
+    climvalues = sm_climatology(run, climayears,
+                                poi_start_day, poi_start_month,
+                                poi_end_day, poi_end_month)
+
+    cast_dates = [pd.Timestamp(cast_date) for cast_date in cast_dates]
+    pois = [next_poi(cast_date, poi_start_day, poi_start_month,
+                     poi_end_day, poi_end_month)
+            for cast_date in cast_dates]
+    tasks = [(cast_date, lead_time_days, climayears, start, end)
+             for cast_date, (start, end) in zip(cast_dates, pois)]
+
+    if n_jobs == 1:
+        all_values = [run_sm_ensemble(run, *task) for task in tasks]
+    else:
+        # Each worker receives the prepared run once, rather than once per cast date
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_init_hindcast_worker,
+                                 initargs=(run,)) as executor:
+            all_values = list(executor.map(_hindcast_worker, tasks))
+
+    years = list(run['years'][0:len(climayears)])
+    climatological_sums = pd.DataFrame(climvalues, years)
+
+    rows = []
+    for (start, end), values in zip(pois, all_values):
+        result = alert_result(climatological_sums, pd.DataFrame(values, years),
+                              forecast_sums, stat, tercile_weights,
+                              clim_start_year, clim_end_year)
+        rows.append([start, end,
+                     result.projected_mean, result.projected_sd, np.nanmean(climvalues)]
+                    + list(result.quintile_probabilities))
+
+    return pd.DataFrame(rows,
+                        index=pd.DatetimeIndex(cast_dates, name='cast_date'),
+                        columns=['poi_start', 'poi_end',
+                                 'ensemble_mean', 'ensemble_sd', 'clim_mean']
+                        + QUINTILE_CATEGORIES)
+
+
+def next_poi(cast_date, poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    Finds the first period of interest which ends on or after the cast date
+
+    :param cast_date:       The (fore/hind)cast date
+    :param poi_start_day:   The day of the month of the start of the period of interest
+    :param poi_start_month: The month of the year of the start of the period of interest
+    :param poi_end_day:     The day of the month of the end of the period of interest
+    :param poi_end_month:   The month of the year of the end of the period of interest
+    :return:                A tuple of pandas Timestamps (start, end)
+    '''
+    end = pd.Timestamp(cast_date.year, poi_end_month, poi_end_day)
+    if end < cast_date:
+        end = pd.Timestamp(cast_date.year + 1, poi_end_month, poi_end_day)
+    start = pd.Timestamp(end.year, poi_start_month, poi_start_day)
+    if start > end:
+        start = pd.Timestamp(end.year - 1, poi_start_month, poi_start_day)
+    return start, end
+
+
+def sm_forecast_timeseries(fc_data, met_ts_varname,
+                           fc_start_day, fc_start_month,
+                           fc_end_day, fc_end_month,
+                           clim_start_year, clim_end_year,
+                           fc_temp_str='temp', fc_precip_str='rfe'):
+    '''
+    Calculates the meteorological forecast metric used for weighting the
+    soil moisture ensemble members, for each climatological year.
+
+    :param fc_data:         A pandas DataFrame containing the meteorological forecast time series
+    :param met_ts_varname:  'precipitation' or 'temperature'
+    :param fc_start_day:    The day of the month of the start of the meteorological forecast
+    :param fc_start_month:  The month of the year of the start of the meteorological forecast
+    :param fc_end_day:      The day of the month of the end of the meteorological forecast
+    :param fc_end_month:    The month of the year of the end of the meteorological forecast
+    :param clim_start_year: The start year of the climatology
+    :param clim_end_year:   The end year of the climatology
+    :param fc_temp_str:     The column name of the temperature in fc_data
+    :param fc_precip_str:   The column name of the precipitation in fc_data
+    :return:                A pandas DataFrame containing years as the index, and
+                            the forecast metric as the values
+    '''
     if met_ts_varname == "precipitation":
         tmp = fc_data[fc_precip_str]
     if met_ts_varname == "temperature":
         tmp = fc_data[fc_temp_str]
     met_ts = strip_leap_days(tmp)
 
-    forecast_sums = ensemble_timeseries(met_ts,
-                                        fc_start_day,
-                                        fc_start_month,
-                                        fc_end_day,
-                                        fc_end_month,
-                                        clim_start_year,
-                                        clim_end_year,
-                                        operation)
-
+    return ensemble_timeseries(met_ts,
+                               fc_start_day,
+                               fc_start_month,
+                               fc_end_day,
+                               fc_end_month,
+                               clim_start_year,
+                               clim_end_year,
+                               np.sum)
+
+
+def prepare_sm_run(data, soil_texture_str,
+                   spinup={
+                       'num_spin_year': 2,
+                       'spin_cyc': 5,
+                       'data_period': 86400,
+                       'model_t_step': 3600
+                   },
+                   initial_conditions={
+                       'su_init': [0.749, 0.743, 0.754, 0.759],
+                       'fa_init': 0.0,
+                       'LAI': 0.0,
+                       'er': 1.0,
+                       'I_v': 0.5,
+                       'dz': [0.1, 0.25, 0.65, 2.0],
+                       'dr': 0.0,
+                       'h': 0.0,
+                   },
+                   data_period=86400,
+                   precipitation_rate_str='pr',
+                   temperature_str='temp',
+                   pressure_str='P',
+                   wind_u_comp_str='uwind',
+                   wind_v_comp_str='vwind',
+                   humidity_str='q',
+                   temperature_range_str='Trange'):
+    '''
+    Performs all of the soil moisture calculations which do not depend on the
+    cast date: interpolation of the driving data, the soil parameters, the
+    spinup, the historical run, and reshaping the driving data into years.
 
+    :param data:             A pandas DataFrame containing the driving data
+    :param soil_texture_str: A string representing the soil texture
+    :return:                 A dictionary containing the prepared run, to be
+                             passed to run_sm_ensemble and sm_climatology
 
+    All other parameters are as for tamsat_alert_sm
+    '''
+    datastartyear = data.index[0].year
+    dataendyear = data.index[-1].year
 
     # reading driving data.
     #ECB note. Check that the units require this conversion.
@@ -200,13 +522,8 @@ def tamsat_alert_sm(data,
     # fixed value
     gl = 10**-2  # leaf (stomata) conductance
 
-
-
     #time indices. Note that we should use pandas for this.
     years = np.arange(datastartyear, dataendyear + 1)
-    fy_ind = sorted(years).index(cast_date.year)
-    climayears = np.arange(clim_start_year, clim_end_year+1)
-
 
     # The hydraulic parameters of the soil based on the sand, silt, clay
     # content of the soil.
@@ -214,9 +531,6 @@ def tamsat_alert_sm(data,
     # theta_w(m3/m3)
     b, psi_s, Ks, theta_s, theta_c, theta_w = utils_sm.pedoclass(soil_texture_str)
 
-    tmp=cast_date-pd.Timestamp(cast_date.year,1,1)
-    ind=tmp.days
-
     # interpolating daily data to hourly values
     if data_period == 86400:
         P, p, u, q1, T, dt = utils_sm.interp_data(P, p, u, q1, T, dt, data_period, spinup['model_t_step'])
@@ -241,70 +555,115 @@ def tamsat_alert_sm(data,
     smcl_histdata = M
     Su_histdata = Su
 
-    rk = utils_sm.root_frac(initial_conditions['dr'], initial_conditions['dz'])
+    # driving data need to be reshaped to pick any climatology year
+    P_resh, p_resh, u_resh, q1_resh, T_resh = utils_sm.reshape_drive_data(P, p, u, q1, T, years)
 
-    #    calculate the beta values of each layer (Normal beta value as that of JULES)
-    # Beta with readily avilabel soil moisture (using field capacity)(for seedlings)
-    #To ask DA: Why is this not an interactive part of the smcl calculation? It is. We re-output beta for the metrics.
+    #Adding up only the top 3 layers of soil.
+    smcl_histdata_total=np.sum(smcl_histdata[0:3],axis=0)
+    smcl_histdata=np.vstack((smcl_histdata,smcl_histdata_total))
+
+    rng = pd.date_range(pd.Timestamp(datastartyear,1,1), periods=smcl_histdata.shape[1], freq='D')
+    smcl_histdata_df=pd.DataFrame(smcl_histdata.T)
+    smcl_histdata_df=smcl_histdata_df.set_index(rng)
+    smcl_histdata_df.columns=['layer_1','layer_2','layer_3','layer_4','total']
+
+    return {
+        'datastartyear': datastartyear,
+        'years': years,
+        'soil_params': (psi_s, theta_s, theta_c, theta_w, b, Ks),
+        'gl': gl,
+        'dt': dt,
+        'fa_val': main_run_init[1],
+        'smcl_histdata': smcl_histdata[0:4],
+        'Su_histdata': Su_histdata,
+        'smcl_histdata_df': smcl_histdata_df,
+        'drive_resh': (P_resh, p_resh, u_resh, q1_resh, T_resh),
+        'spinup': spinup,
+        'initial_conditions': initial_conditions,
+    }
+
+
+def run_sm_ensemble(run, cast_date, lead_time_days, climayears, poi_start, poi_end):
+    '''
+    Runs the soil moisture ensemble forecast from a single cast date, and
+    calculates the mean total soil moisture of each ensemble member over
+    the period of interest.
+
+    :param run:            A prepared run, as returned by prepare_sm_run
+    :param cast_date:      The date at which to start fore/hind-cast.
+                           This should be a pandas Timestamp object
+    :param lead_time_days: The number of days to run each ensemble member for
+    :param climayears:     The climatological years to construct ensemble
+                           members from
+    :param poi_start:      The start date of the period of interest (pandas Timestamp)
+    :param poi_end:        The end date of the period of interest (pandas Timestamp)
+    :return:               A list of the mean total soil moisture over the period
+                           of interest, one for each ensemble member
+    '''
+    return run_sm_ensemble_pois(run, cast_date, lead_time_days, climayears,
+                                [(poi_start, poi_end)])[0]
 
 
-    #beta, none_weigh_beta, pfc = utils_sm.cal_av_beta_fc(theta_s, theta_c, theta_w, Su, rk)
+def run_sm_ensemble_pois(run, cast_date, lead_time_days, climayears, pois):
+    '''
+    Runs the soil moisture ensemble forecast from a single cast date, and
+    calculates the mean total soil moisture of each ensemble member over
+    each of a number of periods of interest.  The model is only run once
+    for each ensemble member, however many periods of interest there are.
+
+    :param run:            A prepared run, as returned by prepare_sm_run
+    :param cast_date:      The date at which to start fore/hind-cast.
+                           This should be a pandas Timestamp object
+    :param lead_time_days: The number of days to run each ensemble member for
+    :param climayears:     The climatological years to construct ensemble
+                           members from
+    :param pois:           A list of periods of interest, each a tuple of
+                           pandas Timestamps (start, end)
+    :return:               A list with an entry for each period of interest,
+                           each a list of the mean total soil moisture over the
+                           period of interest, one for each ensemble member
+    '''
+    psi_s, theta_s, theta_c, theta_w, b, Ks = run['soil_params']
+    spinup = run['spinup']
+    initial_conditions = run['initial_conditions']
+    years = run['years']
+    gl = run['gl']
+    dt = run['dt']
+    datastartyear = run['datastartyear']
+    P_resh, p_resh, u_resh, q1_resh, T_resh = run['drive_resh']
+    smcl_histdata_df = run['smcl_histdata_df']
+
+    fy_ind = sorted(years).index(cast_date.year)
+    tmp=cast_date-pd.Timestamp(cast_date.year,1,1)
+    ind=tmp.days
 
     # ------------------------------------------------------------------- #
     # Forecast for soil moisture based on historical driving data
-    # The forecast starts from the beginind of the season (day 91 of the year)
-    # and run till the end of the next year (remaining plus 365).
-    # the results will be written on a netCDF file (out_<forcaststartday>.nc)
-    # For the moment we are interested in the first 14 days therefore we
-    # run the model from day 58 to day 149.
 
     # extract the initial soil moisture fraction to start forecast
-    initi_su = utils_sm.extract_initial_cond(smcl_histdata, Su_histdata, years, fy_ind, ind)
-    fa_val = main_run_init[1]
-    main_run_init = np.array([initi_su, fa_val])
-
+    initi_su = utils_sm.extract_initial_cond(run['smcl_histdata'], run['Su_histdata'], years, fy_ind, ind)
+    main_run_init = (initi_su, run['fa_val'])
 
     # the start and end date of the required data for forecast
     plantingdates = np.arange(0, 730) #taken from utils.climyears_pdates
     startdate = plantingdates[ind] * 24  # begining of forecast (Just first date since it is a single date forecast, the rest of the date is used for plotting)
     enddate = (plantingdates[ind] + lead_time_days) * 24  # 90 days from the start of forecast this allows to have full coverage of SM forecast in the planting window
 
-    # driving data need to be reshaped to pick any climatology year
-    P_resh, p_resh, u_resh, q1_resh, T_resh = utils_sm.reshape_drive_data(P, p, u, q1, T, years)
-
-    #Adding up only the top 3 layers of soil.
-    smcl_histdata_total=np.sum(smcl_histdata[0:3],axis=0)
-    smcl_histdata=np.vstack((smcl_histdata,smcl_histdata_total))
-
-
-    rng = pd.date_range(pd.Timestamp(datastartyear,1,1), periods=smcl_histdata.shape[1], freq='D')
-    smcl_histdata_df=pd.DataFrame(smcl_histdata.T)
-    smcl_histdata_df=smcl_histdata_df.set_index(rng)
-    smcl_histdata_df.columns=['layer_1','layer_2','layer_3','layer_4','total']
+    #Make dataframe of historical data up to the day of the forecast
+    smcl_histdata_splice=smcl_histdata_df[pd.Timestamp(datastartyear,1,1):pd.Timestamp(cast_date.year,cast_date.month,cast_date.day)][:][0:-1]
+    smcl_ensemble_rng=pd.date_range(pd.Timestamp(cast_date.year,cast_date.month,cast_date.day), periods=lead_time_days, freq='D')
 
-    values=[]
-    yearout=[]
+    values=[[] for _ in pois]
     for g in range(0, len(climayears)):
         # pick the index of the climatological year
         clima_ind = sorted(years).index(climayears[g])
         # add the next year values to make the lenght 2 years incase season goes to next calendar year
-        P1 = P_resh[:, clima_ind]  # precipitation (Kg m-2 s-1)
-        p1 = p_resh[:, clima_ind]  # pressure (Pa)
-        T1 = T_resh[:, clima_ind]  # temperature (K)
-        q11 = q1_resh[:, clima_ind]  # specific humidity (Kg Kg-1)
-        u1 = u_resh[:, clima_ind]  # wind speed (m s-1)
-        # the next year
-        P2 = P_resh[:, clima_ind+1]  # precipitation (Kg m-2 s-1)
-        p2 = p_resh[:, clima_ind+1]  # pressure (Pa)
-        T2 = T_resh[:, clima_ind+1]  # temperature (K)
-        q12 = q1_resh[:, clima_ind+1]  # specific humidity (Kg Kg-1)
-        u2 = u_resh[:, clima_ind+1]  # wind speed (m s-1)
         # merge the two year data
-        P_merg = np.hstack([P1,P2])
-        p_merg = np.hstack([p1,p2])
-        T_merg = np.hstack([T1,T2])
-        q1_merg = np.hstack([q11,q12])
-        u_merg = np.hstack([u1,u2])
+        P_merg = np.hstack([P_resh[:, clima_ind], P_resh[:, clima_ind+1]])
+        p_merg = np.hstack([p_resh[:, clima_ind], p_resh[:, clima_ind+1]])
+        T_merg = np.hstack([T_resh[:, clima_ind], T_resh[:, clima_ind+1]])
+        q1_merg = np.hstack([q1_resh[:, clima_ind], q1_resh[:, clima_ind+1]])
+        u_merg = np.hstack([u_resh[:, clima_ind], u_resh[:, clima_ind+1]])
         # extract the required driving data for the forecast
         P = P_merg[startdate:enddate]  # precipitation (Kg m-2 s-1)
         p = p_merg[startdate:enddate]  # pressure (Pa)
@@ -312,29 +671,17 @@ def tamsat_alert_sm(data,
         q1 = q1_merg[startdate:enddate]  # specific humidity (Kg Kg-1)
         u = u_merg[startdate:enddate]  # wind speed (m s-1)
 
-
         # run soil moisture forecast
         Su, M, Evap, EvapT , runoff = utils_sm.calc_smcl(main_run_init, psi_s, theta_s, theta_c, theta_w, b, Ks, initial_conditions['dz'],
                                        initial_conditions['dr'],q1, p, T, initial_conditions['h'], u, dt, initial_conditions['LAI'], spinup['model_t_step'], spinup['data_period'],P,
                                        initial_conditions['er'],initial_conditions['I_v'],gl)
 
-        # root fraction at each soil layer
-        rk = utils_sm.root_frac(initial_conditions['dr'], initial_conditions['dz'])
-
-        # calculate the beta values of each layer (Normal beta value as that of JULES)
-        # calculate the beta values of each layer (use calc_beta_fc)
-        #beta, none_weigh_beta, pfc = utils_sm.cal_av_beta_fc(theta_s, theta_c, theta_w, Su, rk)
-
         smcl_ensemble_member=M
         #Adding up only the top 3 layers of soil.
         smcl_ensemble_member_total=np.sum(M[0:3],axis=0) #Calculate total soil moisture content of the soil column
         smcl_ensemble_member=np.vstack((smcl_ensemble_member,smcl_ensemble_member_total))
 
-        smcl_ensemble_member_df=pd.DataFrame(smcl_ensemble_member)
-        #Make dataframe of historical data up to the day of the forecast
-        smcl_histdata_splice=smcl_histdata_df[pd.Timestamp(datastartyear,1,1):pd.Timestamp(cast_date.year,cast_date.month,cast_date.day)][:][0:-1]
         #Make dataframe of ensemble forecast data from the point of forecast until the end of the run
-        smcl_ensemble_rng=pd.date_range(pd.Timestamp(cast_date.year,cast_date.month,cast_date.day), periods=lead_time_days, freq='D')
         smcl_ensemble_member_df=pd.DataFrame(smcl_ensemble_member.T)
         smcl_ensemble_member_df=smcl_ensemble_member_df.set_index(smcl_ensemble_rng)
         smcl_ensemble_member_df.columns=['layer_1','layer_2','layer_3','layer_4','total']
@@ -342,14 +689,29 @@ def tamsat_alert_sm(data,
         #Splice the historical and ensemble forecast together
         smcl_ensemble_member_df=pd.concat([smcl_histdata_splice,smcl_ensemble_member_df])
 
-        #Calculate ensemble mean soil moisture over the period of interest
+        #Calculate ensemble mean soil moisture over each period of interest
+        for poi_values, (poi_start, poi_end) in zip(values, pois):
+            poi_values.append(np.nanmean(smcl_ensemble_member_df[poi_start:poi_end]['total']))
+
+    return values
 
 
-        start=pd.Timestamp(poi_start_year,poi_start_month,poi_start_day)
-        end=pd.Timestamp(poi_end_year,poi_end_month,poi_end_day)
+def sm_climatology(run, climayears, poi_start_day, poi_start_month, poi_end_day, poi_end_month):
+    '''
+    Calculates the mean total soil moisture of the historical run over the
+    period of interest, for each climatological year.
 
-        yearout.append(years[g])
-        values.append(np.nanmean(smcl_ensemble_member_df[start:end]['total']))
+    :param run:             A prepared run, as returned by prepare_sm_run
+    :param climayears:      The climatological years
+    :param poi_start_day:   The day of the month of the start of the period of interest
+    :param poi_start_month: The month of the year of the start of the period of interest
+    :param poi_end_day:     The day of the month of the end of the period of interest
+    :param poi_end_month:   The month of the year of the end of the period of interest
+    :return:                A list of the mean total soil moisture over the period
+                            of interest, one for each climatological year
+    '''
+    years = run['years']
+    smcl_histdata_df = run['smcl_histdata_df']
 
     climvalues=[]
     for g in range(0, len(climayears)):
@@ -360,24 +722,21 @@ def tamsat_alert_sm(data,
         else:
             end=pd.Timestamp(years[g]+1,poi_end_month,poi_end_day)
         climvalues.append(np.nanmean(smcl_histdata_df[start:end]['total']))
+    return climvalues
 
-    years=yearout
-
-    ensemble_totals=pd.DataFrame(values,years)
-    climatological_sums=pd.DataFrame(climvalues,years)
 
-    #forecast_sums=ensemble_totals #placeholder
+# The prepared run for each hindcast worker process.  This is set once per
+# process, so that it does not need to be sent with every cast date.
+_hindcast_run = None
 
-    risk_prob_plot(clim_start_year, clim_end_year,
-                   data.index[0].year, data.index[-1].year,
-                   cast_date.year, cast_date.month, cast_date.day,
-                   stat, location_name, tercile_weights,
-                   climatological_sums, ensemble_totals, forecast_sums,
-                   output_dir)
 
-    return pd.DataFrame(values,years),pd.DataFrame(climvalues,years)
+def _init_hindcast_worker(run):
+    global _hindcast_run
+    _hindcast_run = run
 
 
+def _hindcast_worker(task):
+    return run_sm_ensemble(_hindcast_run, *task)
 
 
 #if __name__ == '__main__':
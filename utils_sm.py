@@ -249,6 +249,9 @@ def extract_initial_cond(smcl_histdata, Su_histdata, years, fy_ind, ind):
 
     # reshape the historical soil moisture for extracting the initial soil moisture
     extra_date = len(smcl_histdata[0]) % 365
+    if extra_date == 0:
+        # the data are whole years already, so nothing is added
+        extra_date = 365
 
     sudovals = np.repeat(-99., ((365 - extra_date) * 4))
 
@@ -286,6 +289,9 @@ def reshape_drive_data(P, p, u, q1, T, years):
     Tmean = np.mean(np.reshape(T[:10*365*24],(10,365*24)), axis=0)
 
     extra_date = len(p) % (365 * 24)
+    if extra_date == 0:
+        # the data are whole years already, so nothing is added
+        extra_date = 365 * 24
     # add pseudo values to make the reshape work
     P = np.hstack([P, Pmean[extra_date:]])
     p = np.hstack([p, pmean[extra_date:]])
@@ -386,22 +392,24 @@ def tf_runoff_inf(P_val, LAI , model_t_step, er, Ks, I_v, Ec):
         fa_vals = np.append(fa_vals, fa)
 
     # amount of water infliterating to the soil
+    # (the values for this time step are used, since numpy no longer allows
+    # one element arrays to be stored in the soil moisture arrays)
     if LAI == 0.0:
-        Wo = P_val - Y # if no vegetation throuhfall = Precipitation
+        Wo = P_val - y # if no vegetation throuhfall = Precipitation
         # controling negative values
         if Wo < 0.0:
             Wo = 0.0
         else:
             Wo = Wo
     else:
-        Wo = Tf - Y
+        Wo = tf - y
         # controling negative values
         if Wo < 0.0:
             Wo = 0.0
         else:
             Wo = Wo
 
-    return Tf, Y, Wo, fa_vals, C
+    return Tf, Y, Wo, fa, C
 
 def calc_smcl(main_run_init, psi_s, theta_s, theta_c, theta_w, b, Ks, dz,
             dr,q1, p, T, h, u, dt, LAI, model_t_step, data_period,P,
@@ -759,13 +767,19 @@ def interp_data(P, p, u, q1, T, dt, data_period, model_t_step):
     # variables and data is kept similar at all the
     # model time step for flux variables.
 
+    # the data are indexed by position, so pandas Series are converted
+    P, p, u, q1, T, dt = [np.asarray(x, dtype=float) for x in (P, p, u, q1, T, dt)]
+
+    # the number of model time steps in each data period
+    num_rep = int(data_period / model_t_step)
+
     # flux variables (precipitation and wind speed)
-    P = np.repeat(P, (data_period / model_t_step)).values
-    u = np.repeat(u, (data_period / model_t_step)).values
+    P = np.repeat(P, num_rep)
+    u = np.repeat(u, num_rep)
 
     # instantaneous variables (pressure, temperature, humidity)
     xp = np.arange(0, len(p))
-    xvals = np.linspace(0, len(p), (len(p) * (data_period / model_t_step)))
+    xvals = np.linspace(0, len(p), len(p) * num_rep)
     p = np.interp(xvals, xp, p)
     q1 = np.interp(xvals, xp, q1)
     # ---------------------------------------------------------------#
@@ -785,7 +799,7 @@ def interp_data(P, p, u, q1, T, dt, data_period, model_t_step):
 
     # temperature range dissagregation to be used in qsat calc.
 
-    dt = np.repeat(dt, (data_period / model_t_step))
+    dt = np.repeat(dt, num_rep)
 
     return P, p, u, q1, T, dt
 
@@ -0,0 +1,133 @@
+"""
+Zonal statistics: the means of gridded data over many regions at once.
+
+The regions are described by a sparse (regions, cells) matrix of weights,
+which is the area of each cell (proportional to the cosine of its latitude)
+multiplied by the fraction of the cell in each region.  The matrix is built
+once for each grid and set of regions, and may be cached on disk.  The means
+over every region for a time step are then a single sparse matrix product.
+"""
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+import xarray as xr
+from tamsat_alert.cache import cache_key
+
+
+def region_masks(lons, lats, regions, lon_name='lon', lat_name='lat'):
+    '''
+    Converts descriptions of regions to masks on a grid
+
+    :param lons:     A numpy array of the longitudes of the grid
+    :param lats:     A numpy array of the latitudes of the grid
+    :param regions:  Either a mapping of region names to regions, each of which
+                     is a box (minlon, maxlon, minlat, maxlat) or a mask of shape
+                     (lats, lons), such as a rasterised polygon, holding the
+                     fraction of each cell in the region;
+                     or a single raster of shape (lats, lons) of region labels,
+                     e.g. admin unit codes, in which cells labelled with NaN or
+                     a negative value are in no region.
+                     Masks and rasters may be xarray DataArrays with lon_name
+                     and lat_name dimensions.
+    :param lon_name: The name of the lon dim, for DataArray regions
+                     Optional, defaults to 'lon'
+    :param lat_name: The name of the lat dim, for DataArray regions
+                     Optional, defaults to 'lat'
+    :return:         A tuple (list of region names, list of numpy arrays of
+                     shape (lats, lons))
+    '''
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+
+    def as_grid(values):
+        if isinstance(values, xr.DataArray):
+            values = values.transpose(lat_name, lon_name).values
+        values = np.asarray(values)
+        if values.shape != (len(lats), len(lons)):
+            raise ValueError('Region rasters must be of shape %s, not %s'
+                             % ((len(lats), len(lons)), values.shape))
+        return values
+
+    if not hasattr(regions, 'items'):
+        labels = as_grid(regions).astype(float)
+        with np.errstate(invalid='ignore'):
+            present = np.unique(labels[~np.isnan(labels) & (labels >= 0)])
+        names = [int(label) if label == int(label) else label for label in present]
+        return names, [(labels == label).astype(float) for label in present]
+
+    names = []
+    masks = []
+    for name, region in regions.items():
+        if isinstance(region, tuple) and len(region) == 4:
+            minlon, maxlon, minlat, maxlat = region
+            mask = np.outer((lats >= minlat) & (lats <= maxlat),
+                            (lons >= minlon) & (lons <= maxlon)).astype(float)
+        else:
+            mask = np.nan_to_num(as_grid(region).astype(float))
+        names.append(name)
+        masks.append(mask)
+    return names, masks
+
+
+def region_weights(lons, lats, regions, lon_name='lon', lat_name='lat', cache_dir=None):
+    '''
+    Builds the sparse matrix of the weights of each cell in each region.  The
+    weight is the fraction of the cell in the region, multiplied by the cosine
+    of the latitude of the cell.
+
+    :param lons:      A numpy array of the longitudes of the grid
+    :param lats:      A numpy array of the latitudes of the grid
+    :param regions:   The regions, as for region_masks
+    :param lon_name:  The name of the lon dim, for DataArray regions
+                      Optional, defaults to 'lon'
+    :param lat_name:  The name of the lat dim, for DataArray regions
+                      Optional, defaults to 'lat'
+    :param cache_dir: A directory in which to cache the matrix, keyed by the
+                      grid and the regions
+                      Optional - if not specified, the matrix is not cached
+    :return:          A tuple (list of region names, scipy.sparse CSR matrix of
+                      shape (regions, lats * lons), with the cells in C order)
+    '''
+    names, masks = region_masks(lons, lats, regions, lon_name, lat_name)
+
+    filename = None
+    if cache_dir is not None:
+        digest = hashlib.sha1()
+        for values in [lons, lats] + masks:
+            digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+        filename = os.path.join(cache_dir, 'zonal',
+                                cache_key(names, digest.hexdigest()) + '.npz')
+        if os.path.exists(filename):
+            return names, scipy.sparse.load_npz(filename).tocsr()
+
+    area = np.cos(np.deg2rad(np.asarray(lats, dtype=float)))[:, np.newaxis]
+    rows = [scipy.sparse.csr_matrix((mask * area).reshape((1, -1))) for mask in masks]
+    weights = scipy.sparse.vstack(rows, format='csr') if rows else \
+        scipy.sparse.csr_matrix((0, len(lats) * len(lons)))
+
+    if filename is not None:
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporary = filename + '.%d.tmp.npz' % os.getpid()
+        scipy.sparse.save_npz(temporary, weights)
+        os.replace(temporary, filename)
+    return names, weights
+
+
+def zonal_means(values, weights):
+    '''
+    Calculates the weighted mean over every region, ignoring missing data
+
+    :param values:  A numpy array of shape (times, cells)
+    :param weights: A sparse matrix of shape (regions, cells), as returned by region_weights
+    :return:        A numpy array of shape (times, regions).  Regions with no data are NaN.
+    '''
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    totals = np.asarray((weights @ np.where(present, values, 0.0).T).T)
+    norms = np.asarray((weights @ present.T.astype(float)).T)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(norms > 0, totals / norms, np.nan)